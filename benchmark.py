@@ -0,0 +1,215 @@
+import argparse
+from contextlib import redirect_stderr, redirect_stdout
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import textwrap
+import time
+from typing import Callable, Dict, List, Optional
+
+from corpus_gen import make_osu, make_tja, write_osz, write_tja_song
+from osu2tja.osu2tja import GAMEMODE_MANIA, GAMEMODE_STD, osu2tja
+from tja2osu.tja2osu import tja2osu
+from tja2osu.tja2osu_file_dvide import tja2osus
+from osz2tja import batch_convert_osz2tja, batch_convert_tja2osz, convert_osz2tja
+
+CORPUS_VERSION = 3
+"""Bump when the generated corpus changes; results of different corpus versions are not comparable."""
+
+# ----------------------
+# fixed corpus
+# ----------------------
+
+# case name -> generator arguments; cases are run in this order
+osu2tja_cases: Dict[str, Dict[str, object]] = {
+    "taiko-1k": dict(n_notes=1000),
+    "taiko-10k": dict(n_notes=10000),
+    "taiko-2k-sv2": dict(n_notes=2000, n_red=20, sv_density=2),
+    "std-2k": dict(n_notes=2000, mode=GAMEMODE_STD, slider_ratio=0.3),
+    "mania4k-5k": dict(n_notes=5000, mode=GAMEMODE_MANIA, columns=4),
+    "mania7k-5k": dict(n_notes=5000, mode=GAMEMODE_MANIA, columns=7),
+    "mania10k-5k": dict(n_notes=5000, mode=GAMEMODE_MANIA, columns=10),
+}
+tja2osu_cases: Dict[str, Dict[str, object]] = {
+    "1k": dict(n_notes=1000),
+    "10k": dict(n_notes=10000),
+    "2k-cmd2k": dict(n_notes=2000, n_commands=2000, measure_ratio=0.2, delay_ratio=0.1),
+}
+# converted into a real .osu file, to include the cost of writing the output
+tja2osu_file_cases: Dict[str, Dict[str, object]] = {
+    "24k": dict(n_notes=24000),
+}
+osz_cases: Dict[str, List[Dict[str, object]]] = {
+    "1diff": [dict(n_notes=2000)],
+    "4diffs": [dict(n_notes=1000), dict(n_notes=2000),
+        dict(n_notes=3000, mode=GAMEMODE_MANIA, columns=4), dict(n_notes=3000, mode=GAMEMODE_MANIA, columns=7)],
+}
+tja_song_cases: Dict[str, Dict[str, object]] = {
+    "1course": dict(n_notes=2000),
+    "4courses-branch": dict(n_notes=2000, courses=4, branches=True),
+}
+N_BATCH_SONGS = 4
+
+def build_corpus(corpus_dir: str) -> None:
+    os.makedirs(os.path.join(corpus_dir, "osu"), exist_ok=True)
+    for i, (name, kwargs) in enumerate(osu2tja_cases.items()):
+        with open(os.path.join(corpus_dir, "osu", f"{name}.osu"), "w", encoding="utf-8") as f:
+            f.write(make_osu(100 + i, **kwargs))
+    os.makedirs(os.path.join(corpus_dir, "tja"), exist_ok=True)
+    for i, (name, kwargs) in enumerate(tja2osu_cases.items()):
+        with open(os.path.join(corpus_dir, "tja", f"{name}.tja"), "wb") as f:
+            f.write(make_tja(200 + i, **kwargs))
+    for i, (name, kwargs) in enumerate(tja2osu_file_cases.items()):
+        with open(os.path.join(corpus_dir, "tja", f"{name}-file.tja"), "wb") as f:
+            f.write(make_tja(250 + i, **kwargs))
+    os.makedirs(os.path.join(corpus_dir, "osz"), exist_ok=True)
+    for i, (name, diffs) in enumerate(osz_cases.items()):
+        write_osz(os.path.join(corpus_dir, "osz", f"{name}.osz"), 300 + 10 * i, diffs)
+    for i, (name, kwargs) in enumerate(tja_song_cases.items()):
+        write_tja_song(os.path.join(corpus_dir, "tja_song", name), name, 400 + i, **kwargs)
+    os.makedirs(os.path.join(corpus_dir, "batch_osz"), exist_ok=True)
+    for i in range(N_BATCH_SONGS):
+        write_osz(os.path.join(corpus_dir, "batch_osz", f"song{i}.osz"), 500 + 10 * i,
+            [dict(n_notes=1500), dict(n_notes=1500), dict(n_notes=1500, mode=GAMEMODE_MANIA, columns=4)])
+        write_tja_song(os.path.join(corpus_dir, "batch_tja", f"song{i}"), f"song{i}", 600 + i, n_notes=1500, courses=3)
+
+# ----------------------
+# running & comparing
+# ----------------------
+
+def get_cases(corpus_dir: str, out_dir: str, jobs: int) -> Dict[str, Callable[[], object]]:
+    """Return the benchmark cases; each is run with an empty `out_dir`."""
+    cases: Dict[str, Callable[[], object]] = {}
+
+    def run_osu2tja(fpath: str) -> object:
+        with open(fpath, encoding="utf-8") as fp:
+            return osu2tja(fp, "Oni", None, None)
+
+    for name in osu2tja_cases:
+        cases[f"osu2tja/{name}"] = lambda fpath=os.path.join(corpus_dir, "osu", f"{name}.osu"): run_osu2tja(fpath)
+    for name in tja2osu_cases:
+        cases[f"tja2osu/{name}"] = lambda fpath=os.path.join(corpus_dir, "tja", f"{name}.tja"): tja2osu(fpath, io.StringIO())
+    def run_tja2osu_file(fpath: str) -> object:
+        with open(os.path.join(out_dir, "out.osu"), "w", encoding="utf-8") as fout:
+            return tja2osu(fpath, fout)
+
+    for name in tja2osu_file_cases:
+        cases[f"tja2osu-file/{name}"] = lambda fpath=os.path.join(corpus_dir, "tja", f"{name}-file.tja"): run_tja2osu_file(fpath)
+    for name in osz_cases:
+        cases[f"convert_osz2tja/{name}"] = lambda fpath=os.path.join(corpus_dir, "osz", f"{name}.osz"): convert_osz2tja(fpath, out_dir)
+    for name in tja_song_cases:
+        cases[f"tja2osus/{name}"] = lambda fpath=os.path.join(corpus_dir, "tja_song", name, f"{name}.tja"): tja2osus(fpath, out_dir)
+    cases["batch_convert_osz2tja"] = lambda: batch_convert_osz2tja(os.path.join(corpus_dir, "batch_osz"), out_dir, jobs)
+    cases["batch_convert_tja2osz"] = lambda: batch_convert_tja2osz(os.path.join(corpus_dir, "batch_tja"), out_dir, jobs)
+    return cases
+
+def run_benchmarks(repeat: int = 3, jobs: int = 1, filter_: Optional[str] = None) -> Dict[str, object]:
+    """Return the results with the wall time of each run of each case in seconds."""
+    results: Dict[str, Dict[str, object]] = {}
+    with tempfile.TemporaryDirectory(prefix="osu2tja-bench-") as dir_tmp:
+        corpus_dir = os.path.join(dir_tmp, "corpus")
+        out_dir = os.path.join(dir_tmp, "out")
+        build_corpus(corpus_dir)
+        for name, case in get_cases(corpus_dir, out_dir, jobs).items():
+            if filter_ is not None and filter_ not in name:
+                continue
+            times: List[float] = []
+            for _ in range(repeat):
+                shutil.rmtree(out_dir, ignore_errors=True)
+                os.makedirs(out_dir)
+                # the conversion messages are not part of the results
+                with redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()):
+                    t_begin = time.perf_counter()
+                    case()
+                    times.append(time.perf_counter() - t_begin)
+            results[name] = {"best": min(times), "median": statistics.median(times), "times": times}
+            print(f"{name:<40} best {min(times):8.4f}s  median {statistics.median(times):8.4f}s", file=sys.stderr)
+    try:
+        import numpy
+        numpy_version: Optional[str] = numpy.__version__
+    except ImportError:
+        numpy_version = None
+    return {
+        "corpus_version": CORPUS_VERSION,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "numpy": numpy_version,
+        "repeat": repeat,
+        "jobs": jobs,
+        "results": results,
+    }
+
+def compare_results(base: Dict, new: Dict, threshold: float = 10.0) -> List[str]:
+    """Print a comparison of the best times and return the regressed cases, slower by more than `threshold`%."""
+    if base.get("corpus_version") != new.get("corpus_version"):
+        print(f"Warning: Comparing results of different corpus versions ({base.get('corpus_version')} vs {new.get('corpus_version')}).",
+            file=sys.stderr)
+    regressed: List[str] = []
+    print(f"{'case':<40} {'base':>10} {'new':>10} {'change':>8}")
+    for name, res_new in new["results"].items():
+        res_base = base["results"].get(name)
+        if res_base is None:
+            print(f"{name:<40} {'-':>10} {res_new['best']:9.4f}s {'new':>8}")
+            continue
+        change = (res_new["best"] / res_base["best"] - 1) * 100
+        flag = ""
+        if change > threshold:
+            regressed.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<40} {res_base['best']:9.4f}s {res_new['best']:9.4f}s {change:+7.1f}%{flag}")
+    for name, res_base in base["results"].items():
+        if name not in new["results"]:
+            print(f"{name:<40} {res_base['best']:9.4f}s {'-':>10} {'not run':>8}")
+    return regressed
+
+def benchmark_main() -> None:
+    parser = argparse.ArgumentParser(
+        description=textwrap.dedent('''\
+        Benchmark osu2tja, tja2osu, and the batch converters over a generated fixed corpus, offline.
+          run: time each case and write the results as JSON
+          compare: compare 2 results and flag the cases slower by more than the threshold
+        '''),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    parser_run = subparsers.add_parser("run", help="run the benchmarks")
+    parser_run.add_argument("-o", "--output", metavar="FILE",
+        help="write the results to FILE instead of the standard output")
+    parser_run.add_argument("-r", "--repeat", type=int, default=3, metavar="N",
+        help="run each case N times (default: 3)")
+    parser_run.add_argument("-j", "--jobs", type=int, default=1, metavar="N",
+        help="number of parallel jobs for the batch converters (default: 1)")
+    parser_run.add_argument("-k", "--filter", metavar="TEXT",
+        help="run only the cases whose names contain TEXT")
+    parser_compare = subparsers.add_parser("compare", help="compare 2 results")
+    parser_compare.add_argument("base", help="results of the baseline")
+    parser_compare.add_argument("new", help="results to check")
+    parser_compare.add_argument("-t", "--threshold", type=float, default=10.0, metavar="PERCENT",
+        help="flag the cases whose best time is more than PERCENT%% slower (default: 10)")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        results = run_benchmarks(max(1, args.repeat), args.jobs, args.filter)
+        if args.output is None:
+            json.dump(results, sys.stdout, indent=2)
+            print()
+        else:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+        return
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    regressed = compare_results(base, new, args.threshold)
+    if len(regressed) > 0:
+        print(f"{len(regressed)} regression(s) beyond {args.threshold}%: {', '.join(regressed)}", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    benchmark_main()
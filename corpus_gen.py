@@ -0,0 +1,227 @@
+import argparse
+import os
+import random
+import sys
+import textwrap
+from typing import Dict, List, Sequence
+from zipfile import ZIP_DEFLATED, ZipFile
+
+from osu2tja.osu2tja import GAMEMODE_MANIA, GAMEMODE_TAIKO, GAMEMODE_TO_STR, OSU_VER_MAX, OSU_VER_STR_PREFIX, OSU_VER_SUPPORT
+
+DUMMY_AUDIO = b"OggS" + b"\0" * 1020 # not playable; the converters only copy it
+AUDIO_NAME = "audio.ogg" # already .ogg; no ffmpeg needed
+
+# ----------------------
+# .osu & .osz
+# ----------------------
+
+def make_osu(seed: int, n_notes: int = 1000, mode: int = GAMEMODE_TAIKO, columns: int = 4,
+        n_red: int = 2, sv_density: float = 0.1, slider_ratio: float = 0.07, spinner_ratio: float = 0.02,
+        hold_ratio: float = 0.15, format_ver: int = OSU_VER_MAX, version: str = "Oni", od: float = 8,
+        audio_name: str = AUDIO_NAME) -> str:
+    """Return the contents of a valid .osu file with `n_notes` objects, reproducible from `seed`.
+
+    `columns`: osu!mania key count; ignored for other game modes.
+    `n_red`: number of uninherited (red) timing points.
+    `sv_density`: number of inherited (green) timing points per beat.
+    `slider_ratio` & `spinner_ratio`: ratios of sliders and spinners; ignored for osu!mania.
+    `hold_ratio`: ratio of osu!mania holds; ignored for other game modes.
+    """
+    if mode not in GAMEMODE_TO_STR:
+        raise ValueError(f"Unknown game mode {mode}")
+    if format_ver not in OSU_VER_SUPPORT:
+        raise ValueError(f"Unsupported osu file format v{format_ver}")
+    rng = random.Random(seed)
+    is_mania = (mode == GAMEMODE_MANIA)
+    bpm = rng.choice([150, 175.5, 200])
+    mspb = 60000 / bpm
+    t_begin = 1000
+    # 1/4 beats; chords for osu!mania
+    t_step = mspb / 2 if is_mania else mspb / 4
+    t_end = t_begin + t_step * (n_notes + 8) * (2 if not is_mania else 1)
+
+    lines = [f"{OSU_VER_STR_PREFIX}{format_ver}", "",
+        "[General]", f"AudioFilename: {audio_name}", "AudioLeadIn: 0", "PreviewTime: 1000", f"Mode: {mode}", "",
+        "[Metadata]", f"Title:Synthetic {seed}", f"TitleUnicode:Synthetic {seed}", "Artist:osu2tja",
+        "Creator:corpus_gen", f"Version:{version}", "Source:", "",
+        "[Difficulty]", "HPDrainRate:5", f"CircleSize:{columns if is_mania else 4}", f"OverallDifficulty:{od}",
+        "ApproachRate:5", f"SliderMultiplier:{rng.choice([1.4, 1.4, 1.8])}", f"SliderTickRate:{rng.choice([1, 2, 4])}", "",
+        "[Events]", "",
+        "[TimingPoints]"]
+    offsets_red = sorted({t_begin, *(int(t_begin + rng.random() * (t_end - t_begin)) for _ in range(n_red - 1))})
+    # (sort key, line); a red timing point comes before the green one at the same offset
+    timing_points = [(t, f"{t},{mspb if t == t_begin else 60000 / rng.choice([120, 150, 175.5, 200, 240])},"
+        f"{rng.choice([3, 4, 4, 4, 7])},1,0,100,1,0") for t in offsets_red]
+    for _ in range(int(sv_density * (t_end - t_begin) / mspb)):
+        t = rng.choice(offsets_red) if rng.random() < 0.05 else int(t_begin + rng.random() * (t_end - t_begin))
+        timing_points.append((t + 0.5, f"{t},{-100 / rng.uniform(0.5, 2)},4,1,0,100,0,{rng.choice([0, 0, 1])}"))
+    lines.extend(line for _, line in sorted(timing_points))
+    lines += ["", "[HitObjects]"]
+
+    t = t_begin
+    i_note = 0
+    while i_note < n_notes:
+        t += t_step * rng.choice([1, 1, 2, 3])
+        k = rng.random()
+        sound = rng.choice([0, 0, 2, 4, 8, 12])
+        if is_mania:
+            for column in rng.sample(range(columns), min(columns, rng.choice([1, 1, 2, 3]), n_notes - i_note)):
+                x = int((column + 0.5) * 512 / columns)
+                if rng.random() < hold_ratio:
+                    lines.append(f"{x},192,{int(t)},128,{sound},{int(t + mspb * rng.choice([0.5, 1, 2, 4]))}:0:0:0:0:")
+                else:
+                    lines.append(f"{x},192,{int(t)},1,{sound},0:0:0:0:")
+                i_note += 1
+            continue
+        x, y = (256, 192) if mode == GAMEMODE_TAIKO else (rng.randint(0, 512), rng.randint(0, 384))
+        if k < slider_ratio:
+            n_slides = rng.choice([1, 1, 2, 3])
+            length = rng.choice([70, 140, 280, 560])
+            edge_sounds = "|".join(str(rng.choice([0, 2, 4, 8])) for _ in range(n_slides + 1))
+            lines.append(f"{x},{y},{int(t)},{rng.choice([2, 6])},{sound},L|{min(512, x + 100)}:{y},{n_slides},{length},{edge_sounds}")
+            t += mspb * n_slides * length / 140
+        elif k < slider_ratio + spinner_ratio:
+            duration = mspb * rng.choice([1, 2, 4])
+            lines.append(f"256,192,{int(t)},{rng.choice([8, 12])},0,{int(t + duration)},0:0:0:0:")
+            t += duration
+        else:
+            lines.append(f"{x},{y},{int(t)},{rng.choice([1, 1, 5])},{sound},0:0:0:0:")
+        i_note += 1
+    return "\n".join(lines) + "\n"
+
+def osu_filename(title: str, version: str) -> str:
+    return f"osu2tja - {title} (corpus_gen) [{version}].osu"
+
+def write_osz(fpath: str, seed: int, diffs: Sequence[Dict[str, object]], audio_name: str = AUDIO_NAME) -> None:
+    """Write an .osz mapset with dummy audio and a difficulty for the `make_osu()` keyword arguments of each item of `diffs`."""
+    with ZipFile(fpath, "w", ZIP_DEFLATED) as osz:
+        for i, kwargs in enumerate(diffs):
+            kwargs = {"version": f"Diff{i}", "od": min(10, 2 + 2 * i), "audio_name": audio_name, **kwargs}
+            osz.writestr(osu_filename(f"Synthetic {seed}", str(kwargs["version"])), make_osu(seed + i, **kwargs))
+        osz.writestr(audio_name, DUMMY_AUDIO)
+
+# ----------------------
+# .tja
+# ----------------------
+
+TJA_COURSES = ["Oni", "Hard", "Normal", "Easy", "Edit"]
+
+def make_tja_bar(rng: random.Random, balloons: List[int]) -> str:
+    k = rng.random()
+    if k < 0.04: # drumroll
+        return rng.choice("56") + "0" * 14 + "8,"
+    if k < 0.06: # balloon
+        balloons.append(rng.randint(3, 20))
+        return "7" + "0" * 14 + "8,"
+    return "".join(rng.choice("11220034") if j % 2 == 0 else "0" for j in range(16)) + ","
+
+def make_tja(seed: int, n_notes: int = 1000, courses: int = 1, n_commands: int = 20, branches: bool = False,
+        measure_ratio: float = 0.0, delay_ratio: float = 0.0, audio_name: str = AUDIO_NAME) -> bytes:
+    """Return the contents of a .tja file with `courses` notecharts of about `n_notes` notes each, reproducible from `seed`.
+
+    `n_commands`: number of `#SCROLL`, `#BPMCHANGE`, `#GOGOSTART`/`#GOGOEND`, and `#BARLINEOFF`/`#BARLINEON` per notechart.
+    `branches`: put every 4 of 16 bars in `#BRANCHSTART` sections.
+    `measure_ratio` & `delay_ratio`: ratios of bars after a `#MEASURE` and a `#DELAY` command.
+    """
+    if not 1 <= courses <= len(TJA_COURSES):
+        raise ValueError(f"The number of courses should be 1 to {len(TJA_COURSES)}")
+    rng = random.Random(seed)
+    lines = [f"TITLE:Synthetic {seed}", "SUBTITLE:--osu2tja", "BPM:180", f"WAVE:{audio_name}", "OFFSET:-1.0",
+        "DEMOSTART:0", "SONGVOL:100", "SEVOL:100", ""]
+    for course in TJA_COURSES[:courses]:
+        n_bars = max(1, n_notes // 6)
+        bars_cmd = sorted(rng.choices(range(n_bars), k=n_commands))
+        idx_cmd = 0
+        balloons: List[int] = []
+        chart: List[str] = ["#START"]
+        for i_bar in range(n_bars):
+            while idx_cmd < len(bars_cmd) and bars_cmd[idx_cmd] == i_bar:
+                chart.append(rng.choice([f"#SCROLL {rng.choice([0.5, 1, 1.5, 2])}", f"#BPMCHANGE {rng.choice([150, 180, 200])}",
+                    "#GOGOSTART", "#GOGOEND", "#BARLINEOFF", "#BARLINEON"]))
+                idx_cmd += 1
+            if rng.random() < measure_ratio:
+                chart.append(f"#MEASURE {rng.choice([3, 4, 5, 7])}/{rng.choice([4, 4, 8])}")
+            if rng.random() < delay_ratio:
+                chart.append(f"#DELAY {rng.choice([0.001, 0.01, 0.05, -0.01])}")
+            if branches and i_bar % 16 == 0:
+                chart.append("#BRANCHSTART p,50,80")
+                for branch in ["#N", "#E", "#M"]:
+                    chart.append(branch)
+                    chart.extend(make_tja_bar(rng, balloons) for _ in range(4))
+                chart.append("#BRANCHEND")
+                continue
+            chart.append(make_tja_bar(rng, balloons))
+        chart.append("#END")
+        lines += [f"COURSE:{course}", f"LEVEL:{rng.randint(1, 10)}", f"BALLOON:{','.join(map(str, balloons))}", ""]
+        lines += chart
+        lines.append("")
+    return "\n".join(lines).encode("utf-8")
+
+def write_tja_song(dir_song: str, name: str, seed: int, **kwargs) -> str:
+    """Write "<dir_song>/<name>.tja" with the `make_tja()` keyword arguments `kwargs` and its dummy audio.
+    Return the path of the .tja file."""
+    os.makedirs(dir_song, exist_ok=True)
+    audio_name = kwargs.setdefault("audio_name", AUDIO_NAME)
+    fpath_tja = os.path.join(dir_song, f"{name}.tja")
+    with open(fpath_tja, "wb") as f:
+        f.write(make_tja(seed, **kwargs))
+    with open(os.path.join(dir_song, audio_name), "wb") as f:
+        f.write(DUMMY_AUDIO)
+    return fpath_tja
+
+def corpus_gen_main() -> None:
+    parser = argparse.ArgumentParser(
+        description=textwrap.dedent('''\
+        Generate reproducible synthetic .osu, .osz, and .tja files for stress testing the converters.
+          osu: write a single .osu file
+          osz: write an .osz mapset of N difficulties with dummy audio
+          tja: write a .tja file with dummy audio in the same folder
+        '''),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("kind", choices=["osu", "osz", "tja"])
+    parser.add_argument("output", help="output file path")
+    parser.add_argument("-s", "--seed", type=int, default=0, help="random seed (default: 0)")
+    parser.add_argument("-n", "--notes", type=int, default=1000, metavar="N", help="notes per difficulty (default: 1000)")
+    group_osu = parser.add_argument_group("osu & osz")
+    group_osu.add_argument("--mode", type=int, choices=sorted(GAMEMODE_TO_STR), default=GAMEMODE_TAIKO,
+        help=f"game mode ({', '.join(f'{k}: {v}' for k, v in GAMEMODE_TO_STR.items())}; default: {GAMEMODE_TAIKO})")
+    group_osu.add_argument("--columns", type=int, default=4, metavar="N", help="osu!mania key count (default: 4)")
+    group_osu.add_argument("--red", type=int, default=2, metavar="N", help="uninherited (red) timing points (default: 2)")
+    group_osu.add_argument("--sv-density", type=float, default=0.1, metavar="X",
+        help="inherited (green) timing points per beat (default: 0.1)")
+    group_osu.add_argument("--sliders", type=float, default=0.07, metavar="RATIO", help="ratio of sliders (default: 0.07)")
+    group_osu.add_argument("--spinners", type=float, default=0.02, metavar="RATIO", help="ratio of spinners (default: 0.02)")
+    group_osu.add_argument("--holds", type=float, default=0.15, metavar="RATIO", help="ratio of osu!mania holds (default: 0.15)")
+    group_osu.add_argument("--format-ver", type=int, choices=OSU_VER_SUPPORT, default=OSU_VER_MAX, metavar="V",
+        help=f"osu file format version ({OSU_VER_SUPPORT[0]} to {OSU_VER_SUPPORT[-1]}; default: {OSU_VER_MAX})")
+    group_osu.add_argument("--diffs", type=int, default=4, metavar="N", help="difficulties of the .osz mapset (default: 4)")
+    group_tja = parser.add_argument_group("tja")
+    group_tja.add_argument("--courses", type=int, default=4, metavar="N", help="notecharts (default: 4)")
+    group_tja.add_argument("--commands", type=int, default=20, metavar="N",
+        help="scroll, BPM, gogo-time, and bar line commands per notechart (default: 20)")
+    group_tja.add_argument("--branches", action="store_true", help="add #BRANCHSTART sections")
+    group_tja.add_argument("--measures", type=float, default=0.0, metavar="RATIO", help="ratio of bars after #MEASURE (default: 0)")
+    group_tja.add_argument("--delays", type=float, default=0.0, metavar="RATIO", help="ratio of bars after #DELAY (default: 0)")
+    args = parser.parse_args()
+
+    dir_out = os.path.dirname(args.output)
+    if dir_out:
+        os.makedirs(dir_out, exist_ok=True)
+    osu_kwargs = dict(n_notes=args.notes, mode=args.mode, columns=args.columns, n_red=args.red, sv_density=args.sv_density,
+        slider_ratio=args.sliders, spinner_ratio=args.spinners, hold_ratio=args.holds, format_ver=args.format_ver)
+    if args.kind == "osu":
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(make_osu(args.seed, **osu_kwargs))
+    elif args.kind == "osz":
+        write_osz(args.output, args.seed, [osu_kwargs] * args.diffs)
+    else:
+        name, ext = os.path.splitext(os.path.basename(args.output))
+        if ext != ".tja":
+            print("Output file should be a .tja file!", file=sys.stderr)
+            sys.exit(1)
+        write_tja_song(dir_out or ".", name, args.seed, n_notes=args.notes, courses=args.courses, n_commands=args.commands,
+            branches=args.branches, measure_ratio=args.measures, delay_ratio=args.delays)
+    print(f"Generated `{args.output}`.")
+
+if __name__ == "__main__":
+    corpus_gen_main()
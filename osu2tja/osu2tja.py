@@ -6,19 +6,25 @@ import sys
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 
 from common.utils import print_with_pended
+from timings import StageTimings, lap_timer, print_timings_table, write_timings
 
 from array import array
 from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
 from functools import reduce
 import itertools
 import sys
 import argparse
-import copy
 import codecs
 from fractions import Fraction
 import os
 import math
-from typing import IO, Dict, List, Optional, Tuple, Union
+from typing import IO, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+try:
+    import numpy as np
+except ImportError: # optional; for vectorized offset snapping
+    np = None
 
 OSU_VER_STR_PREFIX = "osu file format v"
 
@@ -105,19 +111,84 @@ def format_time(t):
     return t//T_MINUTE*100000+t % T_MINUTE
 
 
-def get_base_timing_point(timing_points, t):
-    assert len(timing_points) > 0, "Need at least one timing point"
-    # A note can appear even the first timing point
-    if int(math.floor(t)) < timing_points[0]["offset"]:
-        return copy.copy(timingpoints[0])
+class TimingPoint:
+    """A timing point; `mspb`, `bpm`, and `beats` are of the last uninherited (red) timing point for inherited ones."""
+    __slots__ = ("offset", "GGT", "mspb", "bpm", "beats", "scroll", "redline")
+
+    def __init__(self, offset: float = 0.0, GGT: bool = False, mspb: Optional[float] = None, bpm: Optional[float] = None,
+            beats: Optional[int] = None, scroll: float = 1.0, redline: bool = False) -> None:
+        self.offset = offset
+        self.GGT = GGT
+        self.mspb = mspb
+        self.bpm = bpm
+        self.beats = beats
+        self.scroll = scroll
+        self.redline = redline
+
+    def copy(self) -> "TimingPoint":
+        return TimingPoint(*(getattr(self, name) for name in self.__slots__))
+
+    def __repr__(self) -> str:
+        return "TimingPoint(%s)" % ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+
+
+class HitObjects:
+    """Hit objects `(note type, offset, column)` stored in parallel arrays."""
+    __slots__ = ("types", "offsets", "columns")
+
+    def __init__(self) -> None:
+        self.types = array('B') # code points of the `ONP_*` note types
+        self.offsets = array('d')
+        self.columns = array('H')
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def __getitem__(self, idx: int) -> Tuple[str, float, int]:
+        return (chr(self.types[idx]), self.offsets[idx], self.columns[idx])
+
+    def append(self, note: str, offset: float, column: int) -> None:
+        self.types.append(ord(note))
+        self.offsets.append(offset)
+        self.columns.append(column)
 
-    idx_tm = bisect_right(timing_points, t, key=lambda tm: tm["offset"]) - 1
-    return copy.copy(timing_points[idx_tm])
+    def reorder(self, order: Sequence[int]) -> None:
+        self.types = array('B', (self.types[i] for i in order))
+        self.offsets = array('d', (self.offsets[i] for i in order))
+        self.columns = array('H', (self.columns[i] for i in order))
 
 
-def get_base_red_timing_point(timing_points, t):
-    red_timing_points = [d for d in timing_points if d["redline"] == True]
-    return get_base_timing_point(red_timing_points, t)
+class TimingIndex:
+    """Timing points with pre-built offset arrays for O(log n) look-up.
+
+    Timing points are expected to be appended in increasing offset order, as in `[TimingPoints]`.
+    """
+    def __init__(self, timing_points: Iterable[TimingPoint] = ()) -> None:
+        self.points: List[TimingPoint] = []
+        self.offsets = array('d')
+        self.red_points: List[TimingPoint] = []
+        self.red_offsets = array('d')
+        for tm in timing_points:
+            self.append(tm)
+
+    def append(self, tm: TimingPoint) -> None:
+        self.points.append(tm)
+        self.offsets.append(tm.offset)
+        if tm.redline:
+            self.red_points.append(tm)
+            self.red_offsets.append(tm.offset)
+
+    @staticmethod
+    def _lookup(points: List[TimingPoint], offsets: array, t: Union[int, float]) -> TimingPoint:
+        assert len(points) > 0, "Need at least one timing point"
+        # A note can appear even the first timing point
+        return points[max(0, bisect_right(offsets, t) - 1)]
+
+    def at(self, t: Union[int, float]) -> TimingPoint:
+        return self._lookup(self.points, self.offsets, t)
+
+    def red_at(self, t: Union[int, float]) -> TimingPoint:
+        return self._lookup(self.red_points, self.red_offsets, t)
 
 # ----------------------
 # parse single line
@@ -132,6 +203,25 @@ def get_section_name(str):
     return ""
 
 
+def read_osu_sections(fp: Iterable[str]) -> Iterator[Tuple[str, str]]:
+    """Lazily yield (section name, line) for each non-empty stripped line in `fp` other than section names.
+
+    Lines before the first section have the section name "".
+    """
+    curr_sec = ""
+    for line in fp:
+        line = line.strip()
+        if line == "":
+            continue
+
+        # new section? Update section name.
+        new_sec = get_section_name(line)
+        if new_sec:
+            curr_sec = new_sec
+            continue
+        yield curr_sec, line
+
+
 def get_var(str: str) -> Tuple[str, str]:
     if str is None:
         return "", ""
@@ -171,104 +261,10 @@ def get_event(line: str) -> Dict:
     return res
 
 
-def get_timing_point(str, prev_timing_point=None):
-    if str is None:
-        return {}
-
-    # in case new items are added to osu format
-    ps = str.split(',')
-    if len(ps) < 7:
-        return {}
-
-    offset, rawbpmv, beats = ps[:3]
-    is_ggt = (len(ps) > 7 and ps[7] != '0')
-
-    # fill a timing point dict
-    ret = {}
-    try:
-        ret["offset"] = float(offset)  # time
-        ret["GGT"] = is_ggt
-        if float(rawbpmv) > 0: # BPM change
-            mspb = ret["mspb"] = float(rawbpmv)
-            bpm = ret["bpm"] = 60 * 1000.0 / mspb
-            ret["beats"] = int(beats) # measure change
-            ret["scroll"] = 1.0
-            ret["redline"] = True
-        elif float(rawbpmv) < 0: # SCROLL speed change
-            assert prev_timing_point is not None
-            if (prev_timing_point["offset"] == ret["offset"]
-                and prev_timing_point["redline"]
-                and prev_timing_point["GGT"] == is_ggt
-                ):
-                ret = prev_timing_point # merge uninherited (red) + inherited (green) timing points
-            else:
-                ret["mspb"] = prev_timing_point.get("mspb", None)
-                ret["bpm"] = prev_timing_point.get("bpm", None)
-                ret["beats"] = prev_timing_point.get("beats", None) # ignored for inherited timing points
-                ret["redline"] = False
-                ret["offset"] = get_real_offset(ret["offset"])
-            ret["scroll"] = -100.0 / float(rawbpmv)
-        else:
-            assert False
-
-    except:
-        print_with_pended("Osu file Error, at [TimingPoints] section, please check", file=sys.stderr)
-        return {}
-
-    return ret
-
-chart_resources: Dict[str, str] # {'filename': 'type', ...}
-
-def init_globals() -> None:
-    global timingpoints, balloons, slider_multiplier, slider_tick_rate, column_count, tail_fix, gamemode_idx, osu_format_ver, commands_within
-    # global variables
-    timingpoints = []
-    balloons = []
-    slider_multiplier = None
-    slider_tick_rate = None
-    column_count = 1
-    tail_fix = False
-    gamemode_idx = GAMEMODE_STD
-    osu_format_ver = 0
-    commands_within = []
-
-    global chart_resources
-    chart_resources = {}
-
-def init_debug_globals() -> None:
-    global show_head_info, combo_cnt, guess_measure
-    # debug args
-    show_head_info = False
-    combo_cnt = 0
-    guess_measure = False
-
-init_debug_globals()
-
 # get fixed beat count
 def get_real_beat_cnt(tm, beat_cnt):
     return round(beat_cnt * 24, 2) / 24
 
-# get fixed offset base by the nearest base timing point
-# step 1: find the base timing point around t
-# step 2: calculate the fixed beat count from t to the base timing point
-# step 3: get fixed offset from fixed beat count and bpm
-
-
-def get_real_offset(int_offset: Union[int, float]) -> float:
-    int_offset = int(math.floor(int_offset))
-
-    tm = get_base_red_timing_point(timingpoints, int_offset)
-    int_delta = abs(int_offset - tm["offset"])
-    sign = (int_offset - tm["offset"] > 0 and 1 or -1)
-
-    t_unit_cnt = round(int_delta * tm["bpm"] * 24 / T_MINUTE)
-
-    beat_cnt = t_unit_cnt / 24
-
-    ret = tm["offset"] + beat_cnt * T_MINUTE * sign / tm["bpm"]
-
-    return ret
-
 
 def get_slider_sound(str):
     ps = str.split(',')
@@ -279,16 +275,31 @@ def get_slider_sound(str):
         return [int(x) for x in ps[8].split('|')]
 
 
-def get_hitnote_type(sound: int, column: int):
-    is_dai = bool(sound & HITSND_FINISH)
-    if column_count <= 1: # Purely keysounded
-        is_katsu = bool(sound & (HITSND_CLAP | HITSND_WHISTLE))
-    else: # Donkey Konga (KD) / Taiko (KDDK) layout
-        n_cols_ka_l = int(math.ceil(column_count / 4))
-        n_cols_ka_r = int(column_count / 4)
-        is_katsu = (column < n_cols_ka_l or column_count - 1 - column < n_cols_ka_r)
-    return ((ONP_KATSU_DAI if is_katsu else ONP_DON_DAI) if is_dai
-        else ONP_KATSU if is_katsu else ONP_DON)
+def merge_hitobject_runs(hitobjects: HitObjects, run_ends: Sequence[int]) -> None:
+    """Merge the runs `hitobjects[run_ends[i-1]:run_ends[i]]` of each source object by offset,
+    keeping the reading order for objects at the same offset.
+    A run out of offset order, e.g., of a malformed object, is sorted by itself first."""
+    offsets = hitobjects.offsets
+    is_sorted = True
+    unsorted_runs: List[Tuple[int, int]] = []
+    idx_begin = 0
+    for idx_end in run_ends:
+        if idx_begin > 0 and offsets[idx_begin - 1] > offsets[idx_begin]:
+            is_sorted = False
+        for i in range(idx_begin, idx_end - 1):
+            if offsets[i] > offsets[i + 1]:
+                unsorted_runs.append((idx_begin, idx_end))
+                break
+        idx_begin = idx_end
+    if is_sorted and not unsorted_runs:
+        return
+
+    order = list(range(len(offsets)))
+    for idx_begin, idx_end in unsorted_runs:
+        order[idx_begin:idx_end] = sorted(order[idx_begin:idx_end], key=offsets.__getitem__)
+    # stable, so the same as the k-way merge of the runs; linear for the mostly-sorted input
+    order.sort(key=offsets.__getitem__)
+    hitobjects.reorder(order)
 
 
 # https://github.com/ppy/osu/blob/master/osu.Game.Rulesets.Taiko/Beatmaps/TaikoBeatmapConverter.cs
@@ -336,132 +347,7 @@ def get_precision_adjusted_beat_length(sliderVelocity: float, timingControlPoint
         if sliderVelocityAsBeatLength < 0
         else 1)
 
-    return timingControlPoint["mspb"] * bpmMultiplier
-
-
-def should_convert_slider_to_hits(tm, curve_len: float, reverse_cnt: int) -> Tuple[bool, int, float]:
-    isForCurrentRuleset = (gamemode_idx == GAMEMODE_TAIKO)
-
-    # DO NOT CHANGE OR REFACTOR ANYTHING IN HERE WITHOUT TESTING AGAINST _ALL_ BEATMAPS.
-    # Some of these calculations look redundant, but they are not - extremely small floating point errors are introduced to maintain 1:1 compatibility with stable.
-    # Rounding cannot be used as an alternative since the error deltas have been observed to be between 1e-2 and 1e-6.
-
-    # The true distance, accounting for any repeats. This ends up being the drum roll distance later
-    spans: int = reverse_cnt or 1
-    distance: float = curve_len
-
-    # Do not combine the following two lines!
-    distance *= VELOCITY_MULTIPLIER
-    distance *= spans
-
-    timingPoint = tm
-
-    beatLength: float
-
-    if timingPoint["scroll"] != 1.0:
-        beatLength = get_precision_adjusted_beat_length(timingPoint["scroll"], timingPoint)
-    else:
-        beatLength = timingPoint["mspb"]
-
-    assert slider_multiplier is not None and slider_tick_rate is not None
-    sliderScoringPointDistance: float = osu_base_scoring_distance * (slider_multiplier * VELOCITY_MULTIPLIER) / slider_tick_rate
-
-    # The velocity and duration of the taiko hit object - calculated as the velocity of a drum roll.
-    taikoVelocity: float = sliderScoringPointDistance * slider_tick_rate
-    taikoDuration = int(distance / taikoVelocity * beatLength)
-
-    if isForCurrentRuleset:
-        tickSpacing = 0
-        return (False, taikoDuration, tickSpacing)
-
-    osuVelocity: float = taikoVelocity * (1000.0 / beatLength)
-
-    # osu-stable always uses the speed-adjusted beatlength to determine the osu! velocity, but only uses it for conversion if beatmap version < 8
-    if osu_format_ver >= 8:
-        beatLength = timingPoint["mspb"]
-
-    # If the drum roll is to be split into hit circles, assume the ticks are 1/8 spaced within the duration of one beat
-    tickSpacing = min(beatLength / slider_tick_rate, float(taikoDuration) / spans)
-
-    return (tickSpacing > 0
-            and distance / osuVelocity * 1000 < 2 * beatLength,
-            taikoDuration, tickSpacing)
-
-
-def get_note(str_: str, od: float) -> List[Tuple[str, float, int]]:
-    global timing_point
-    global gamemode_idx
-    ret: List[Tuple[str, float, int]] = []
-
-    if str_ is None:
-        return ret
-    ps = str_.split(',')
-    if len(ps) < 5:
-        return ret
-
-    column = (min(max(math.floor(float(ps[0]) * column_count / 512), 0), column_count - 1)
-        if gamemode_idx == GAMEMODE_MANIA
-        else 0)
-    type = int(ps[3])
-    sound = int(ps[4])
-    offset = get_real_offset(float(ps[2]))
-
-    if type & OSU_NOTE_CIRCLE:  # circle
-        ret.append((get_hitnote_type(sound, column), offset, column))
-    elif type & OSU_NOTE_SLIDER:  # slider, reverse??
-        tm = get_base_timing_point(timingpoints, offset)
-        curve_len = float(ps[7])
-        reverse_cnt = int(ps[6])
-        (should_convert, taiko_duration, tick_spacing) = should_convert_slider_to_hits(tm, curve_len, reverse_cnt)
-
-        assert reverse_cnt + 1 == len(get_slider_sound(str_))
-        if should_convert:
-            slider_sounds = get_slider_sound(str_)
-            i = 0
-            j = offset
-            while j <= offset + taiko_duration + tick_spacing / 8:
-                point_offset = get_real_offset(j)
-                ret.append((get_hitnote_type(slider_sounds[i], column), point_offset, column))
-
-                j += tick_spacing
-                i = (i + 1) % len(slider_sounds)
-
-                if math.isclose(tick_spacing, 0, rel_tol=0, abs_tol=1e-7):
-                    break
-        else:
-            if sound & HITSND_FINISH:
-                ret.append((ONP_RENDA_DAI, offset, column))
-            else:
-                ret.append((ONP_RENDA, offset, column))
-            ret.append((ONP_END, offset + taiko_duration, column))
-
-    elif type & OSU_NOTE_HOLD:  # hold, converted to circle because overlapping notes are not supported
-        tmr = get_base_red_timing_point(timingpoints, offset)
-        offset_end = int(ps[5].split(':', 1)[0])
-        taiko_duration = offset_end - offset
-        tick_spacing = min(tmr["mspb"] / slider_tick_rate, float(taiko_duration))
-        j = offset
-        while j <= offset + taiko_duration + tick_spacing / 8:
-            point_offset = get_real_offset(j)
-            ret.append((get_hitnote_type(sound, column), point_offset, column))
-
-            j += tick_spacing
-
-            if math.isclose(tick_spacing, 0, rel_tol=0, abs_tol=1e-7):
-                break
-
-    elif type & OSU_NOTE_SPINNER:  # spinner
-        ret.append((ONP_BALLOON, offset, column))
-        ret.append((ONP_END, get_real_offset(int(ps[5])), column))
-        # how many hit will break a ballon
-        global balloons
-        hit_multiplier = (5 - 2 * (5 - od) / 5 if od < 5
-            else 5 + 2.5 * (od - 5) / 5 if od > 5
-            else 5) * swell_hit_multiplier
-        hits = int(max(1, (ret[-1][1] - ret[-2][1]) / 1000 * hit_multiplier))
-        balloons.append(hits)
-
-    return ret
+    return timingControlPoint.mspb * bpmMultiplier
 
 
 # BEAT - MEASURE TABLE: (beat_cnt, numerator, denominator)
@@ -495,138 +381,12 @@ def get_tsign(tsign_raw: Fraction) -> Tuple[int, int]:
 
     return (numerator, denominator)
 
-# handle an incomplete bar
-# use #MEASURE to write a bar, and use #DELAY to fix the remaining time error.
-
-
-def write_incomplete_bar(tm, bar_data, begin, end, tja_contents):
-    if int(math.floor(begin)) == int(math.floor(end)) and len(bar_data) == 0 and len(commands_within) == 0:
-        return
-
-    mspb = T_MINUTE / tm["bpm"]
-    my_beat_cnt = 1.0 * (end - begin) * tm["bpm"] / T_MINUTE
-
-    # this is accurate
-    time_bar_data_last = bar_data[-1][1] if len(bar_data) > 0 else begin
-    min_beat_cnt = 1.0 * tm["bpm"] * (time_bar_data_last - begin) / T_MINUTE
-
-    # force guess measure?
-    global guess_measure
-    for beat_cnt, numerator, denominator in (measure_table if not guess_measure else []):
-        if beat_cnt > min_beat_cnt and \
-                abs(beat_cnt - my_beat_cnt) < 1 / 384 and \
-                abs(int(math.floor(begin + 1.0 * beat_cnt * mspb)) - int(math.floor(end))) <= 25:
-            break
-    else:
-        # Missing all, guess a measure here!
-        fraction = Fraction(my_beat_cnt / 4).limit_denominator(48 * 48)
-        (numerator, denominator) = get_tsign(fraction)
-
-        # avoid the last note to be divided into the next bar
-        if min_beat_cnt > 0 and numerator <= min_beat_cnt * denominator:
-            numerator = int(min_beat_cnt * denominator) + 1
-            # re-simplify the fraction
-            (numerator, denominator) = get_tsign(Fraction(numerator, denominator))
-        # TaikoJiro does not support 0/x measures. Use a <= 1ms measure instead.
-        # Note: numerator and denominator can both have decimal places
-        elif numerator == 0:
-            (numerator, denominator) = (1, 4 * max(1, mspb))
-
-        beat_cnt = 4 * numerator / denominator
-
-    tja_contents.append(make_cmd(FMT_MEASURECHANGE, numerator, denominator))
-    write_bar_data(tm, bar_data, begin, begin + beat_cnt * mspb, tja_contents)
-    delay_time = int(math.floor(end)) - int(math.floor(begin + beat_cnt * mspb))
-    # Note: #DELAY value can be in any sign
-
-    # jiro will ignore delays shorter than 0.001s
-    if abs(delay_time) >= 1:
-        tja_contents.append(make_cmd(FMT_DELAY, delay_time / 1000.0))
-
 
 def get_dt_unit_cnt(t_unit: float, offset0: Union[float, int], offset1: Union[float, int]) -> int:
     delta = (offset1 - offset0) / t_unit
     return int(round(delta))
 
 
-def write_bar_data(tm, bar_data, begin, end, tja_contents):
-    global show_head_info
-    global combo_cnt, tail_fix
-    global commands_within
-
-    if int(math.floor(begin)) == int(math.floor(end)) and len(bar_data) == 0 and len(commands_within) == 0:
-        return
-
-    # ms per 1/96th note; quantize to 1/96th
-    t_unit = 60.0 * 1000 / tm["bpm"] / 24
-
-    # ignore past-end notes
-    if len(bar_data) > 0 and get_dt_unit_cnt(t_unit, bar_data[-1][1], int(math.floor(end))) <= 0:
-        tail_fix = True
-        write_bar_data(tm, bar_data[:-1], begin, end, tja_contents)
-        return
-
-    # ignore past-end commands
-    idx_cmd_limit = bisect_left(commands_within, int(math.floor(end)), key=lambda cmd: cmd[0])
-
-    # build offset data
-    offset_list = sorted(set(itertools.chain(
-        [int(math.floor(begin))],
-        (cmd[0] for _, cmd in zip(range(idx_cmd_limit), commands_within)), # in-range commands
-        (datum[1] for datum in bar_data),
-        [int(math.floor(end))],
-    )))
-
-    # calculate beat division (no known efficient general solution exists (integer factor problem); do heuristics here)
-    delta_list = [get_dt_unit_cnt(t_unit, offset_list[i], offset_list[i + 1])
-        for i in range(len(offset_list) - 1)]
-    delta_list_non_zero = [d for d in delta_list if d != 0] # ignore sub-quantization intervals
-    delta_gcd = gcd_of_list(delta_list_non_zero) if len(delta_list_non_zero) != 0 else 1
-
-    # build notechart definition bar string
-    bar_strs: List[str] = []
-    idx_cmd = 0
-    idx_bar_data = 0
-    # floating number offset should match exactly here since they are in the list as-is
-    # use <= in case bad things happen
-    for offset, delta_n_symbols in zip(offset_list, delta_list): # in range(len(offset_list) - 1)
-        # Insert commands
-        while idx_cmd < len(commands_within) and commands_within[idx_cmd][0] <= offset:
-            bar_strs.append("\n")
-            bar_strs.append(make_cmd(*commands_within[idx_cmd][1:]))
-            bar_strs.append("\n")
-            idx_cmd += 1
-
-        if delta_n_symbols > 0:
-            # Insert a note (simultaneous notes are not supported)
-            note = ONP_NONE
-            while idx_bar_data < len(bar_data) and bar_data[idx_bar_data][1] <= offset:
-                note = bar_data[idx_bar_data][0]
-                idx_bar_data += 1
-            if note in (ONP_DON, ONP_KATSU, ONP_DON_DAI, ONP_KATSU_DAI):
-                combo_cnt += 1
-            bar_strs.append(note)
-
-            # Insert blanks (if needed)
-            bar_strs.append("0" * int(delta_n_symbols / delta_gcd - 1))
-
-    # remove processed notechart objects
-    commands_within = commands_within[idx_cmd:]
-    # bar_data = bar_data[idx_bar_data:] # useless
-
-    # bar-terminating symbol (1-symbol beat length if comes solely, otherwise zero length)
-    bar_strs.append(',')
-    bar_str = ''.join(bar_strs)
-
-    head = "%4d %6d %s %2d " % (combo_cnt,
-                                  format_time(int(math.floor(begin))), repr(delta_gcd/24.0), len(bar_str))
-
-    if show_head_info:  # show debug info?
-        print_with_pended(head + bar_str, file=sys.stderr)
-
-    tja_contents.append(bar_str)
-
-
 def osu2tja_level(star_osu: float) -> float:
     # 0 to 13 distribution, only a preliminary approximant
     # osu! 0 -> Taiko 1 (OpenTaiko 0)
@@ -650,310 +410,730 @@ MS_OSU_PRE_V5_MUSIC_OFFSET = -24
 <https://github.com/ppy/osu/discussions/26133>
 """
 
-def osu2tja(fp: IO[str], course: Union[str, int], level: Union[int, float], audio_name: Optional[str]) -> Tuple[
-        List[str], List[str], List[str], List[str], Dict[str, str]
-    ]:
-    init_globals()
-    global slider_multiplier, slider_tick_rate, column_count, timingpoints
-    global balloons, tail_fix
-    global osu_format_ver
-    global commands_within
-    global gamemode_idx
-
-    tja_heads_meta: List[str] = []
-    tja_heads_sync: List[str] = []
-    tja_heads_diff: List[str] = []
-    tja_contents: List[str] = []
-
-    # data structures to hold information
-    audio = ""
-    title = ""
-    subtitle = ""
-    creator = ""
-    artist = ""
-    version = ""
-    preview = 0
-    hitobjects: List[Tuple[str, float, int]] = []
-
-    preimage = None
-    bgmovie = None
-    movieoffset = 0.0
-
-    # state vars
-    osu_ver_str = ""
-    curr_sec = ""
-    # read data
-    lines = fp.readlines()
-    for line in lines:
-        line = line.strip()
-        if line == "":
-            continue
+MAX_TICKS_PER_OBJECT = 10000
+"""Default limit of the notes converted from a single slider or hold.
+Broken beatmaps with tiny tick spacing or huge repeat counts can otherwise produce millions of notes.
+"""
 
-        # check osu file format version
-        if osu_ver_str == "":
-            osu_ver_str = line
-            osu_format_ver = int(line.partition(OSU_VER_STR_PREFIX)[2])
-            if osu_format_ver not in OSU_VER_SUPPORT:
-                str_vers_support = "/".join((str(i) for i in OSU_VER_SUPPORT))
-                print_with_pended(f"Warning: found osu file format v{osu_format_ver}, but only v{str_vers_support} are supported at this moment. The conversion will be performed but might fail.",
-                      file=sys.stderr)
 
-        # new section? Update section name.
-        new_sec = get_section_name(line)
-        if new_sec:
-            curr_sec = new_sec
-            continue
+chart_resources_t = Dict[str, str] # {'filename': 'type', ...}
+osu2tja_result_t = Tuple[List[str], List[str], List[str], List[str], chart_resources_t]
 
-        # varible? Parse variable
-        vname, vval = get_var(line)
-
-        # read in useful infomation in following sections
-        if curr_sec == "General":
-            if vname == "AudioFilename":
-                root, ext = os.path.splitext(vval)
-                if ext.lower() not in [".ogg", ".mp3"]:
-                    vval = root+".ogg"
-                audio = vval
-            elif vname == "PreviewTime":
-                preview = int(vval)
-            elif vname == "Mode":
-                gamemode_idx = int(vval)
-
-        elif curr_sec == "Metadata":
-            if vname in ("Title", "TitleUnicode"):
-                title = vval or title
-            elif vname == "Creator":
-                creator = vval
-            elif vname == "Version":
-                version = vval
-            elif vname == "Source":
-                subtitle = vval
-            elif vname in ("Artist", "ArtistUnicode"):
-                artist = vval or artist
-        elif curr_sec == "Difficulty":
-            if vname == "CircleSize":
-                if gamemode_idx == GAMEMODE_MANIA:
-                    column_count = int(vval)
-            elif vname == "SliderMultiplier":
-                slider_multiplier = float(vval)
-            elif vname == "SliderTickRate":
-                slider_tick_rate = float(vval)
-            elif vname == "OverallDifficulty":
-                overall_difficulty = math.floor(float(vval)) # accuracy, not the actual star rating
-        elif curr_sec == "Events":
-            data = get_event(line)
-            if data:
-                if data["event_type"] == OSU_EVENT_BG:
-                    if preimage is None and data["x_offset"] == 0 and data["y_offset"] == 0:
-                        preimage = data["filename"]
-                elif data["event_type"] == OSU_EVENT_VIDEO:
-                    if bgmovie is None and data["x_offset"] == 0 and data["y_offset"] == 0:
-                        bgmovie = data["filename"]
-                        movieoffset = data["start_time"] / 1000
-        elif curr_sec == "TimingPoints":
-            prev_timing_point = timingpoints and timingpoints[-1] or None
-            data = get_timing_point(line, prev_timing_point)
-            if data:
-                timingpoints.append(data)
-        elif curr_sec == "HitObjects":
-            data = get_note(line, overall_difficulty)
-            idx_last = 0
-            for obj in data:
-                # fix out-of-order objects for converted osu!mania holds
-                idx_last = bisect_right(hitobjects, obj[1], lo=idx_last, key=lambda x: x[1])
-                hitobjects.insert(idx_last, obj)
-
-    assert len(hitobjects) > 0
-
-    # The music starts at 0ms and the bar line starts too.
-    # add an initial timing point at whole beats non-after the music
-    if timingpoints[0]["offset"] > 0:
-        tm_first = timingpoints[0]
-        init_beats = int(math.ceil(tm_first["offset"] / tm_first["mspb"]))
-        (init_whole_bars, init_frac_bar_beats) = divmod(init_beats, tm_first["beats"])
-        new_tms = []
-
-        # timing point for the first beat, if not a whole bar
-        if init_frac_bar_beats != 0:
-            new_tm_first_frac = dict(tm_first)
-            new_tm_first_frac["offset"] = get_real_offset(
-                tm_first["offset"] - init_beats * tm_first["mspb"])
-            new_tm_first_frac["beats"] = init_frac_bar_beats
-            new_tms.append(new_tm_first_frac)
-
-        # timing point for the first whole bar, if any
-        if init_whole_bars != 0:
-            new_tm_first_whole = dict(tm_first)
-            new_tm_first_whole["offset"] = get_real_offset(
-                tm_first["offset"] - init_whole_bars * tm_first["beats"] * tm_first["mspb"])
-            new_tm_first_whole["beats"] = tm_first["beats"]
-            new_tms.append(new_tm_first_whole)
-
-        if len(new_tms) != 0:
-            timingpoints = new_tms + timingpoints
-
-    # collect all #SCROLL #GOGOSTART #GOGOEND commands
-    # these commands will not be broken by #BPMCHANGE or # MEASURE
-    assert slider_multiplier is not None
-    sv_err_max = 0.00025
-    # Ranked osu!taiko beatmaps uses SV 1.40. tja2osu uses SV 1.44. Allows up-to SV 1.47.
-    base_scroll = (1.0 if 1.40 - sv_err_max <= slider_multiplier <= 1.47 + sv_err_max
-        else slider_multiplier / 1.40)
-    cur_scroll = 1.0
-    cur_ggt = False
-    for tm in timingpoints:
-        scroll = tm["scroll"] * base_scroll
-        if scroll != cur_scroll:
-            commands_within.append(
-                (tm["offset"], FMT_SCROLLCHANGE, scroll))
-        if tm["GGT"] != cur_ggt:
-            commands_within.append((tm["offset"],
-                                    tm["GGT"] and FMT_GOGOSTART or FMT_GOGOEND))
-        cur_scroll = scroll
-        cur_ggt = tm["GGT"]
-
-    BPM = timingpoints[0]["bpm"]
-    ms_osu_total_offset = MS_OSU_MUSIC_OFFSET
-    if osu_format_ver < 5:
-        ms_osu_total_offset += MS_OSU_PRE_V5_MUSIC_OFFSET
-    OFFSET = (-timingpoints[0]["offset"] - ms_osu_total_offset) / 1000.0
-    DEMOSTART = (preview + ms_osu_total_offset) / 1000.0
-    MOVIEOFFSET = (movieoffset + ms_osu_total_offset) / 1000.0
-
-    scroll = timingpoints[0]["scroll"]
-    tm_idx = 0  # current timing point index
-    obj_idx = 0  # current hit object index
-    measure = timingpoints[0]["beats"]  # current measure
-    curr_bpm = BPM  # current bpm
-
-    bar_data = []  # current bar data
-
-    bar_offset_begin = timingpoints[0]["offset"]
-    bar_max_length = 1.0 * measure * T_MINUTE / curr_bpm  # current bar length
-
-    bar_cnt = 1
-    tja_heads_meta.append(WATER_MARK)
-    tja_heads_meta.append("TITLE:%s" % title)
-    if subtitle != "" and artist != "":
-        subtitle = f"{artist} ｢{subtitle}｣より"
-    tja_heads_meta.append("SUBTITLE:--%s" % (subtitle or artist))
-    tja_heads_meta.append("WAVE:%s" % (audio_name or audio))
-    tja_heads_meta.append("MAKER:%s" % creator) # for TJAP2fPC-based sims
-    tja_heads_meta.append("AUTHOR:%s" % creator) # for Malody
-
-    tja_heads_meta.append("DEMOSTART:%s" % repr(DEMOSTART))
-
-    if preimage:
-        tja_heads_meta.append("PREIMAGE:%s" % preimage)
-        chart_resources[preimage] = 'preview image'
-    if bgmovie:
-        tja_heads_meta.append("BGMOVIE:%s" % bgmovie)
-        tja_heads_meta.append("MOVIEOFFSET:%s" % repr(MOVIEOFFSET))
-        chart_resources[bgmovie] = 'background video'
-
-    tja_heads_sync.append("BPM:%s" % repr(timingpoints[0]["bpm"]))
-    tja_heads_sync.append("OFFSET:%s" % repr(OFFSET))
-
-    str_info_diff_orig = f"// osu! difficulty: {version}"
-    if gamemode_idx != GAMEMODE_TAIKO:
-        str_mode = GAMEMODE_TO_STR.get(gamemode_idx, f"game mode {gamemode_idx}")
-        str_info_diff_orig += f" ({str_mode} convert)"
-    tja_heads_diff.append(str_info_diff_orig)
-    tja_heads_diff.append(f"COURSE:{course}") # TODO: GUESS DIFFICULTY
-    if level is None:
-        level = osu2tja_level(overall_difficulty)
-    tja_heads_diff.append(f"LEVEL:{level}")  # TODO: GUESS LEVEL
-
-    # don't write score init and score diff
-    # taiko jiro will calculate score automatically
-    tja_heads_diff.append("BALLOON:%s" % ','.join(map(repr, balloons)))
-
-    tja_contents.append("#START")
-
-    def is_new_measure(timing_point):
-        bpm = timing_point["bpm"]
-        _measure = timing_point["beats"]
-        return bpm != curr_bpm or measure != _measure or timing_point["redline"]
-
-    # check if all notes align ok
-    for i, (ho1, ho2) in enumerate(zip(hitobjects[:-1], hitobjects[1:])):
-        # allows simultaneous notes in different columns
-        if ho1[1] > ho2[1] or (ho1[1] == ho2[1] and ho1[2] == ho2[2]):
-            print_with_pended(f"Warning: Hit object {i}: {ho1} occurs non-before hit object {i + 1}: {ho2}.", file=sys.stderr)
-
-    while obj_idx < len(hitobjects):
-        # get next object to process
-        next_obj = hitobjects[obj_idx]
-        next_obj_offset = int(math.floor(next_obj[1]))
-
-        # get next measure offset to compare
-        if tm_idx < len(timingpoints):
-            next_measure_offset = timingpoints[tm_idx]["offset"]
-        else:
-            next_measure_offset = bar_offset_begin + bar_max_length + 1
 
-        # skip volumn change and kiai
-        if tm_idx < len(timingpoints) and \
-                not is_new_measure(timingpoints[tm_idx]):
-            tm_idx += 1
-            continue
+class Osu2TjaConverter:
+    """Holds the state of a single .osu to .tja conversion.
 
-        # check if this object falls into this measure
-        end = min(bar_offset_begin + bar_max_length, next_measure_offset)
-
-        if next_obj_offset >= int(math.floor(end)):
-            # write_a_measure()
-            if int(math.floor(end)) == int(math.floor(bar_offset_begin + bar_max_length)):
-                tm = get_base_timing_point(timingpoints, bar_offset_begin)
-                write_bar_data(tm, bar_data, bar_offset_begin,
-                               end, tja_contents)
-                bar_data = []
-                bar_cnt += 1
-                bar_offset_begin = get_real_offset(end)
-                bar_max_length = measure * time_per_beat
-            elif int(math.floor(end)) == int(math.floor(next_measure_offset)):  # collect an incomplete bar?
-                if tm_idx > 0: # not the start of the initial bar
-                    write_incomplete_bar(get_base_timing_point(timingpoints, bar_offset_begin),
-                                         bar_data, bar_offset_begin, end, tja_contents)
-                bar_data = []
-                measure = timingpoints[tm_idx]["beats"]
-                if timingpoints[tm_idx]["redline"]:
-                    curr_bpm = timingpoints[tm_idx]["bpm"]
-                    bar_offset_begin = next_measure_offset
-                    tja_contents.append(make_cmd(FMT_BPMCHANGE, curr_bpm))
+    Each instance is independent, so separate instances can convert in parallel.
+    """
+    def __init__(self, show_head_info: bool = False, guess_measure: bool = False,
+            max_ticks: int = MAX_TICKS_PER_OBJECT, timings: Optional[StageTimings] = None) -> None:
+        # debug args
+        self.show_head_info = show_head_info
+        self.guess_measure = guess_measure
+        assert max_ticks >= 1, f"max_ticks should be at least 1, got {max_ticks}"
+        self.max_ticks = max_ticks
+        self.timings = timings
+        self.reset()
+
+    def reset(self) -> None:
+        self.timingpoints: List[TimingPoint] = []
+        self.timing_index = TimingIndex()
+        self.balloons: List[int] = []
+        self.slider_multiplier: Optional[float] = None
+        self.slider_tick_rate: Optional[float] = None
+        self.column_count = 1
+        self.tail_fix = False
+        self.gamemode_idx = GAMEMODE_STD
+        self.osu_format_ver = 0
+        self.commands_within: List[Tuple] = []
+        self.idx_cmd_next = 0 # commands before it in `commands_within` are written
+        self.chart_resources: chart_resources_t = {}
+        self.combo_cnt = 0
+
+    def get_timing_point(self, str, prev_timing_point: Optional[TimingPoint] = None) -> Optional[TimingPoint]:
+        if str is None:
+            return None
+
+        # in case new items are added to osu format
+        ps = str.split(',')
+        if len(ps) < 7:
+            return None
+
+        offset, rawbpmv, beats = ps[:3]
+        is_ggt = (len(ps) > 7 and ps[7] != '0')
+
+        # fill a timing point
+        ret = TimingPoint()
+        try:
+            ret.offset = float(offset)  # time
+            ret.GGT = is_ggt
+            if float(rawbpmv) > 0: # BPM change
+                mspb = ret.mspb = float(rawbpmv)
+                bpm = ret.bpm = 60 * 1000.0 / mspb
+                ret.beats = int(beats) # measure change
+                ret.scroll = 1.0
+                ret.redline = True
+            elif float(rawbpmv) < 0: # SCROLL speed change
+                assert prev_timing_point is not None
+                if (prev_timing_point.offset == ret.offset
+                    and prev_timing_point.redline
+                    and prev_timing_point.GGT == is_ggt
+                    ):
+                    ret = prev_timing_point # merge uninherited (red) + inherited (green) timing points
                 else:
-                    bar_offset_begin = end
-                time_per_beat = (60 * 1000) / curr_bpm
-                bar_max_length = measure * time_per_beat
+                    ret.mspb = prev_timing_point.mspb
+                    ret.bpm = prev_timing_point.bpm
+                    ret.beats = prev_timing_point.beats # ignored for inherited timing points
+                    ret.redline = False
+                    ret.offset = self.get_real_offset(ret.offset)
+                ret.scroll = -100.0 / float(rawbpmv)
+            else:
+                assert False
 
-                if tail_fix:
-                    tail_fix = False
-                    obj_idx -= 1
-                    new_obj = (hitobjects[obj_idx][0], bar_offset_begin, hitobjects[obj_idx][2])
-                    hitobjects[obj_idx] = new_obj
+        except:
+            print_with_pended("Osu file Error, at [TimingPoints] section, please check", file=sys.stderr)
+            return None
 
-                # add new commands
-                tja_contents.append(make_cmd(FMT_MEASURECHANGE, measure, 4))
+        return ret
 
-                tm_idx += 1
+    # get fixed offset base by the nearest base timing point
+    # step 1: find the base timing point around t
+    # step 2: calculate the fixed beat count from t to the base timing point
+    # step 3: get fixed offset from fixed beat count and bpm
+    def get_real_offset(self, int_offset: Union[int, float]) -> float:
+        int_offset = int(math.floor(int_offset))
+
+        tm = self.timing_index.red_at(int_offset)
+        int_delta = abs(int_offset - tm.offset)
+        sign = (int_offset - tm.offset > 0 and 1 or -1)
+
+        t_unit_cnt = round(int_delta * tm.bpm * 24 / T_MINUTE)
+
+        beat_cnt = t_unit_cnt / 24
+
+        ret = tm.offset + beat_cnt * T_MINUTE * sign / tm.bpm
+
+        return ret
+
+    def get_tick_offsets(self, str_: str, offset: float, duration: float, tick_spacing: float) -> List[float]:
+        """Return the raw offsets of the ticks from `offset` to `offset + duration` for the object line `str_`,
+        accumulated by `tick_spacing` and at most `self.max_ticks`."""
+        end = offset + duration + tick_spacing / 8
+        if not offset <= end:
+            return []
+        if math.isclose(tick_spacing, 0, rel_tol=0, abs_tol=1e-7):
+            return [offset]
+
+        # accumulated as `j += tick_spacing` in the C iterators; stops at `end` or never if `tick_spacing` < 0
+        ticks = list(itertools.islice(
+            itertools.takewhile(end.__ge__, itertools.accumulate(itertools.repeat(tick_spacing), initial=offset)),
+            self.max_ticks + 1))
+        if len(ticks) > self.max_ticks:
+            print_with_pended(f"Warning: Object `{str_}` has more than {self.max_ticks} ticks. Only the first {self.max_ticks} ticks are converted.",
+                file=sys.stderr)
+            del ticks[self.max_ticks:]
+        return ticks
+
+    def snap_offsets(self, offsets: array, mask: array) -> None:
+        """Batch version of `get_real_offset()` for `offsets[i]` where `mask[i]`, in-place.
+        Vectorized with NumPy if available; gives identical results."""
+        if np is None:
+            for i in itertools.compress(range(len(offsets)), mask):
+                offsets[i] = self.get_real_offset(offsets[i])
+            return
+
+        if len(offsets) == 0:
+            return
+        values = np.frombuffer(offsets, dtype=np.float64)
+        selected = np.frombuffer(mask, dtype=np.uint8).astype(bool)
+        int_offsets = np.floor(values[selected])
+
+        # split by the uninherited (red) timing segments
+        assert len(self.timing_index.red_points) > 0, "Need at least one timing point"
+        red_offsets = np.frombuffer(self.timing_index.red_offsets, dtype=np.float64)
+        red_bpms = np.array([tm.bpm for tm in self.timing_index.red_points], dtype=np.float64)
+        idxs_tm = np.maximum(np.searchsorted(red_offsets, int_offsets, side='right') - 1, 0)
+        tm_offsets = red_offsets[idxs_tm]
+        tm_bpms = red_bpms[idxs_tm]
+
+        # same operations in the same order as `get_real_offset()`
+        int_deltas = np.abs(int_offsets - tm_offsets)
+        signs = np.where(int_offsets - tm_offsets > 0, 1.0, -1.0)
+        t_unit_cnts = np.rint(int_deltas * tm_bpms * 24 / T_MINUTE) # round half to even, as `round()`
+        beat_cnts = t_unit_cnts / 24
+        values[selected] = tm_offsets + beat_cnts * T_MINUTE * signs / tm_bpms
+
+    def get_hitnote_type(self, sound: int, column: int):
+        is_dai = bool(sound & HITSND_FINISH)
+        if self.column_count <= 1: # Purely keysounded
+            is_katsu = bool(sound & (HITSND_CLAP | HITSND_WHISTLE))
+        else: # Donkey Konga (KD) / Taiko (KDDK) layout
+            n_cols_ka_l = int(math.ceil(self.column_count / 4))
+            n_cols_ka_r = int(self.column_count / 4)
+            is_katsu = (column < n_cols_ka_l or self.column_count - 1 - column < n_cols_ka_r)
+        return ((ONP_KATSU_DAI if is_katsu else ONP_DON_DAI) if is_dai
+            else ONP_KATSU if is_katsu else ONP_DON)
+
+    def should_convert_slider_to_hits(self, tm, curve_len: float, reverse_cnt: int) -> Tuple[bool, int, float]:
+        isForCurrentRuleset = (self.gamemode_idx == GAMEMODE_TAIKO)
+
+        # DO NOT CHANGE OR REFACTOR ANYTHING IN HERE WITHOUT TESTING AGAINST _ALL_ BEATMAPS.
+        # Some of these calculations look redundant, but they are not - extremely small floating point errors are introduced to maintain 1:1 compatibility with stable.
+        # Rounding cannot be used as an alternative since the error deltas have been observed to be between 1e-2 and 1e-6.
+
+        # The true distance, accounting for any repeats. This ends up being the drum roll distance later
+        spans: int = reverse_cnt or 1
+        distance: float = curve_len
+
+        # Do not combine the following two lines!
+        distance *= VELOCITY_MULTIPLIER
+        distance *= spans
+
+        timingPoint = tm
+
+        beatLength: float
+
+        if timingPoint.scroll != 1.0:
+            beatLength = get_precision_adjusted_beat_length(timingPoint.scroll, timingPoint)
+        else:
+            beatLength = timingPoint.mspb
+
+        assert self.slider_multiplier is not None and self.slider_tick_rate is not None
+        sliderScoringPointDistance: float = osu_base_scoring_distance * (self.slider_multiplier * VELOCITY_MULTIPLIER) / self.slider_tick_rate
+
+        # The velocity and duration of the taiko hit object - calculated as the velocity of a drum roll.
+        taikoVelocity: float = sliderScoringPointDistance * self.slider_tick_rate
+        taikoDuration = int(distance / taikoVelocity * beatLength)
+
+        if isForCurrentRuleset:
+            tickSpacing = 0
+            return (False, taikoDuration, tickSpacing)
+
+        osuVelocity: float = taikoVelocity * (1000.0 / beatLength)
+
+        # osu-stable always uses the speed-adjusted beatlength to determine the osu! velocity, but only uses it for conversion if beatmap version < 8
+        if self.osu_format_ver >= 8:
+            beatLength = timingPoint.mspb
+
+        # If the drum roll is to be split into hit circles, assume the ticks are 1/8 spaced within the duration of one beat
+        tickSpacing = min(beatLength / self.slider_tick_rate, float(taikoDuration) / spans)
+
+        return (tickSpacing > 0
+                and distance / osuVelocity * 1000 < 2 * beatLength,
+                taikoDuration, tickSpacing)
+
+    def get_note(self, str_: str, od: float) -> List[Tuple[str, float, int, bool]]:
+        """Return the hit objects `(note type, offset, column, is_raw)` converted from an object line.
+        Raw offsets (`is_raw`) are yet to be snapped, which `snap_offsets()` does for all at once."""
+        ret: List[Tuple[str, float, int, bool]] = []
+
+        if str_ is None:
+            return ret
+        ps = str_.split(',')
+        if len(ps) < 5:
+            return ret
+
+        column = (min(max(math.floor(float(ps[0]) * self.column_count / 512), 0), self.column_count - 1)
+            if self.gamemode_idx == GAMEMODE_MANIA
+            else 0)
+        type = int(ps[3])
+        sound = int(ps[4])
+        raw_offset = float(ps[2])
+        if type & OSU_NOTE_CIRCLE:  # circle
+            ret.append((self.get_hitnote_type(sound, column), raw_offset, column, True))
+            return ret
+        offset = self.get_real_offset(raw_offset)
+
+        if type & OSU_NOTE_SLIDER:  # slider, reverse??
+            tm = self.timing_index.at(offset)
+            curve_len = float(ps[7])
+            reverse_cnt = int(ps[6])
+            (should_convert, taiko_duration, tick_spacing) = self.should_convert_slider_to_hits(tm, curve_len, reverse_cnt)
+
+            assert reverse_cnt + 1 == len(get_slider_sound(str_))
+            if should_convert:
+                notes = [self.get_hitnote_type(slider_sound, column) for slider_sound in get_slider_sound(str_)]
+                ticks = self.get_tick_offsets(str_, offset, taiko_duration, tick_spacing)
+                ret.extend((note, j, column, True) for note, j in zip(itertools.cycle(notes), ticks))
             else:
-                assert False, "BAR END POS ERROR"
+                if sound & HITSND_FINISH:
+                    ret.append((ONP_RENDA_DAI, offset, column, False))
+                else:
+                    ret.append((ONP_RENDA, offset, column, False))
+                ret.append((ONP_END, offset + taiko_duration, column, False))
+
+        elif type & OSU_NOTE_HOLD:  # hold, converted to circle because overlapping notes are not supported
+            tmr = self.timing_index.red_at(offset)
+            offset_end = int(ps[5].split(':', 1)[0])
+            taiko_duration = offset_end - offset
+            tick_spacing = min(tmr.mspb / self.slider_tick_rate, float(taiko_duration))
+            note = self.get_hitnote_type(sound, column)
+            ticks = self.get_tick_offsets(str_, offset, taiko_duration, tick_spacing)
+            ret.extend((note, j, column, True) for j in ticks)
+
+        elif type & OSU_NOTE_SPINNER:  # spinner
+            ret.append((ONP_BALLOON, offset, column, False))
+            ret.append((ONP_END, self.get_real_offset(int(ps[5])), column, False))
+            # how many hit will break a ballon
+            hit_multiplier = (5 - 2 * (5 - od) / 5 if od < 5
+                else 5 + 2.5 * (od - 5) / 5 if od > 5
+                else 5) * swell_hit_multiplier
+            hits = int(max(1, (ret[-1][1] - ret[-2][1]) / 1000 * hit_multiplier))
+            self.balloons.append(hits)
+
+        return ret
+
+    # handle an incomplete bar
+    # use #MEASURE to write a bar, and use #DELAY to fix the remaining time error.
+    def write_incomplete_bar(self, tm, bar_data, begin, end, tja_contents):
+        if int(math.floor(begin)) == int(math.floor(end)) and len(bar_data) == 0 and not self.has_pending_cmds():
+            return
+
+        mspb = T_MINUTE / tm.bpm
+        my_beat_cnt = 1.0 * (end - begin) * tm.bpm / T_MINUTE
+
+        # this is accurate
+        time_bar_data_last = bar_data[-1][1] if len(bar_data) > 0 else begin
+        min_beat_cnt = 1.0 * tm.bpm * (time_bar_data_last - begin) / T_MINUTE
 
+        # force guess measure?
+        for beat_cnt, numerator, denominator in (measure_table if not self.guess_measure else []):
+            if beat_cnt > min_beat_cnt and \
+                    abs(beat_cnt - my_beat_cnt) < 1 / 384 and \
+                    abs(int(math.floor(begin + 1.0 * beat_cnt * mspb)) - int(math.floor(end))) <= 25:
+                break
         else:
-            if next_obj[1] < bar_offset_begin:
-                bar_data.append((next_obj[0], bar_offset_begin))
+            # Missing all, guess a measure here!
+            fraction = Fraction(my_beat_cnt / 4).limit_denominator(48 * 48)
+            (numerator, denominator) = get_tsign(fraction)
+
+            # avoid the last note to be divided into the next bar
+            if min_beat_cnt > 0 and numerator <= min_beat_cnt * denominator:
+                numerator = int(min_beat_cnt * denominator) + 1
+                # re-simplify the fraction
+                (numerator, denominator) = get_tsign(Fraction(numerator, denominator))
+            # TaikoJiro does not support 0/x measures. Use a <= 1ms measure instead.
+            # Note: numerator and denominator can both have decimal places
+            elif numerator == 0:
+                (numerator, denominator) = (1, 4 * max(1, mspb))
+
+            beat_cnt = 4 * numerator / denominator
+
+        tja_contents.append(make_cmd(FMT_MEASURECHANGE, numerator, denominator))
+        self.write_bar_data(tm, bar_data, begin, begin + beat_cnt * mspb, tja_contents)
+        delay_time = int(math.floor(end)) - int(math.floor(begin + beat_cnt * mspb))
+        # Note: #DELAY value can be in any sign
+
+        # jiro will ignore delays shorter than 0.001s
+        if abs(delay_time) >= 1:
+            tja_contents.append(make_cmd(FMT_DELAY, delay_time / 1000.0))
+
+    def has_pending_cmds(self) -> bool:
+        return self.idx_cmd_next < len(self.commands_within)
+
+    def write_bar_data(self, tm, bar_data, begin, end, tja_contents):
+        if int(math.floor(begin)) == int(math.floor(end)) and len(bar_data) == 0 and not self.has_pending_cmds():
+            return
+
+        # ms per 1/96th note; quantize to 1/96th
+        t_unit = 60.0 * 1000 / tm.bpm / 24
+
+        # ignore past-end notes
+        n_bar_data = len(bar_data)
+        while n_bar_data > 0 and get_dt_unit_cnt(t_unit, bar_data[n_bar_data - 1][1], int(math.floor(end))) <= 0:
+            self.tail_fix = True
+            n_bar_data -= 1
+        if n_bar_data < len(bar_data) and int(math.floor(begin)) == int(math.floor(end)) \
+                and n_bar_data == 0 and not self.has_pending_cmds():
+            return
+
+        # ignore past-end commands
+        idx_cmd_begin = self.idx_cmd_next
+        idx_cmd_limit = bisect_left(self.commands_within, int(math.floor(end)), lo=idx_cmd_begin, key=lambda cmd: cmd[0])
+
+        # build offset data
+        offset_list = sorted(set(itertools.chain(
+            [int(math.floor(begin))],
+            (self.commands_within[i][0] for i in range(idx_cmd_begin, idx_cmd_limit)), # in-range commands
+            (bar_data[i][1] for i in range(n_bar_data)),
+            [int(math.floor(end))],
+        )))
+
+        # calculate beat division (no known efficient general solution exists (integer factor problem); do heuristics here)
+        delta_list = [get_dt_unit_cnt(t_unit, offset_list[i], offset_list[i + 1])
+            for i in range(len(offset_list) - 1)]
+        delta_list_non_zero = [d for d in delta_list if d != 0] # ignore sub-quantization intervals
+        delta_gcd = gcd_of_list(delta_list_non_zero) if len(delta_list_non_zero) != 0 else 1
+
+        # build notechart definition bar string
+        bar_strs: List[str] = []
+        idx_cmd = idx_cmd_begin
+        idx_bar_data = 0
+        # floating number offset should match exactly here since they are in the list as-is
+        # use <= in case bad things happen
+        for offset, delta_n_symbols in zip(offset_list, delta_list): # in range(len(offset_list) - 1)
+            # Insert commands
+            while idx_cmd < len(self.commands_within) and self.commands_within[idx_cmd][0] <= offset:
+                bar_strs.append("\n")
+                bar_strs.append(make_cmd(*self.commands_within[idx_cmd][1:]))
+                bar_strs.append("\n")
+                idx_cmd += 1
+
+            if delta_n_symbols > 0:
+                # Insert a note (simultaneous notes are not supported)
+                note = ONP_NONE
+                while idx_bar_data < n_bar_data and bar_data[idx_bar_data][1] <= offset:
+                    note = bar_data[idx_bar_data][0]
+                    idx_bar_data += 1
+                if note in (ONP_DON, ONP_KATSU, ONP_DON_DAI, ONP_KATSU_DAI):
+                    self.combo_cnt += 1
+                bar_strs.append(note)
+
+                # Insert blanks (if needed)
+                bar_strs.append("0" * int(delta_n_symbols / delta_gcd - 1))
+
+        # skip processed notechart objects
+        self.idx_cmd_next = idx_cmd
+        # bar_data = bar_data[idx_bar_data:] # useless
+
+        # bar-terminating symbol (1-symbol beat length if comes solely, otherwise zero length)
+        bar_strs.append(',')
+        bar_str = ''.join(bar_strs)
+
+        if self.show_head_info:  # show debug info?
+            head = "%4d %6d %s %2d " % (self.combo_cnt,
+                                        format_time(int(math.floor(begin))), repr(delta_gcd/24.0), len(bar_str))
+            print_with_pended(head + bar_str, file=sys.stderr)
+
+        tja_contents.append(bar_str)
+
+    def convert(self, fp: IO[str], course: Union[str, int], level: Union[int, float], audio_name: Optional[str]) -> osu2tja_result_t:
+        self.reset()
+        laps = lap_timer(self.timings)
+
+        tja_heads_meta: List[str] = []
+        tja_heads_sync: List[str] = []
+        tja_heads_diff: List[str] = []
+        tja_contents: List[str] = []
+
+        # data structures to hold information
+        audio = ""
+        title = ""
+        subtitle = ""
+        creator = ""
+        artist = ""
+        version = ""
+        preview = 0
+        hitobjects = HitObjects()
+        hitobject_run_ends = array('L')
+        hitobject_raw_mask = array('B') # 1 for offsets yet to be snapped
+
+        preimage = None
+        bgmovie = None
+        movieoffset = 0.0
+
+        # state vars
+        osu_ver_str = ""
+        # read data, streaming
+        for curr_sec, line in read_osu_sections(fp):
+            # check osu file format version
+            if osu_ver_str == "":
+                osu_ver_str = line
+                self.osu_format_ver = int(line.partition(OSU_VER_STR_PREFIX)[2])
+                if self.osu_format_ver not in OSU_VER_SUPPORT:
+                    str_vers_support = "/".join((str(i) for i in OSU_VER_SUPPORT))
+                    print_with_pended(f"Warning: found osu file format v{self.osu_format_ver}, but only v{str_vers_support} are supported at this moment. The conversion will be performed but might fail.",
+                          file=sys.stderr)
+
+            # varible? Parse variable
+            vname, vval = get_var(line)
+
+            # read in useful infomation in following sections
+            if curr_sec == "General":
+                if vname == "AudioFilename":
+                    root, ext = os.path.splitext(vval)
+                    if ext.lower() not in [".ogg", ".mp3"]:
+                        vval = root+".ogg"
+                    audio = vval
+                elif vname == "PreviewTime":
+                    preview = int(vval)
+                elif vname == "Mode":
+                    self.gamemode_idx = int(vval)
+
+            elif curr_sec == "Metadata":
+                if vname in ("Title", "TitleUnicode"):
+                    title = vval or title
+                elif vname == "Creator":
+                    creator = vval
+                elif vname == "Version":
+                    version = vval
+                elif vname == "Source":
+                    subtitle = vval
+                elif vname in ("Artist", "ArtistUnicode"):
+                    artist = vval or artist
+            elif curr_sec == "Difficulty":
+                if vname == "CircleSize":
+                    if self.gamemode_idx == GAMEMODE_MANIA:
+                        self.column_count = int(vval)
+                elif vname == "SliderMultiplier":
+                    self.slider_multiplier = float(vval)
+                elif vname == "SliderTickRate":
+                    self.slider_tick_rate = float(vval)
+                elif vname == "OverallDifficulty":
+                    overall_difficulty = math.floor(float(vval)) # accuracy, not the actual star rating
+            elif curr_sec == "Events":
+                data = get_event(line)
+                if data:
+                    if data["event_type"] == OSU_EVENT_BG:
+                        if preimage is None and data["x_offset"] == 0 and data["y_offset"] == 0:
+                            preimage = data["filename"]
+                    elif data["event_type"] == OSU_EVENT_VIDEO:
+                        if bgmovie is None and data["x_offset"] == 0 and data["y_offset"] == 0:
+                            bgmovie = data["filename"]
+                            movieoffset = data["start_time"] / 1000
+            elif curr_sec == "TimingPoints":
+                prev_timing_point = self.timingpoints and self.timingpoints[-1] or None
+                data = self.get_timing_point(line, prev_timing_point)
+                if data:
+                    self.timingpoints.append(data)
+                    self.timing_index.append(data)
+            elif curr_sec == "HitObjects":
+                data = self.get_note(line, overall_difficulty)
+                if data:
+                    for note, offset, column, is_raw in data:
+                        hitobjects.append(note, offset, column)
+                        hitobject_raw_mask.append(is_raw)
+                    hitobject_run_ends.append(len(hitobjects))
+        laps.lap("parse")
+
+        # [HitObjects] is the last section; all timing points are known here
+        self.snap_offsets(hitobjects.offsets, hitobject_raw_mask)
+        del hitobject_raw_mask
+
+        # fix out-of-order objects for converted osu!mania holds
+        merge_hitobject_runs(hitobjects, hitobject_run_ends)
+        del hitobject_run_ends
+        assert len(hitobjects) > 0
+        laps.lap("snap")
+
+        # The music starts at 0ms and the bar line starts too.
+        # add an initial timing point at whole beats non-after the music
+        if self.timingpoints[0].offset > 0:
+            tm_first = self.timingpoints[0]
+            init_beats = int(math.ceil(tm_first.offset / tm_first.mspb))
+            (init_whole_bars, init_frac_bar_beats) = divmod(init_beats, tm_first.beats)
+            new_tms = []
+
+            # timing point for the first beat, if not a whole bar
+            if init_frac_bar_beats != 0:
+                new_tm_first_frac = tm_first.copy()
+                new_tm_first_frac.offset = self.get_real_offset(
+                    tm_first.offset - init_beats * tm_first.mspb)
+                new_tm_first_frac.beats = init_frac_bar_beats
+                new_tms.append(new_tm_first_frac)
+
+            # timing point for the first whole bar, if any
+            if init_whole_bars != 0:
+                new_tm_first_whole = tm_first.copy()
+                new_tm_first_whole.offset = self.get_real_offset(
+                    tm_first.offset - init_whole_bars * tm_first.beats * tm_first.mspb)
+                new_tm_first_whole.beats = tm_first.beats
+                new_tms.append(new_tm_first_whole)
+
+            if len(new_tms) != 0:
+                self.timingpoints = new_tms + self.timingpoints
+                self.timing_index = TimingIndex(self.timingpoints)
+
+        # collect all #SCROLL #GOGOSTART #GOGOEND commands
+        # these commands will not be broken by #BPMCHANGE or # MEASURE
+        assert self.slider_multiplier is not None
+        sv_err_max = 0.00025
+        # Ranked osu!taiko beatmaps uses SV 1.40. tja2osu uses SV 1.44. Allows up-to SV 1.47.
+        base_scroll = (1.0 if 1.40 - sv_err_max <= self.slider_multiplier <= 1.47 + sv_err_max
+            else self.slider_multiplier / 1.40)
+        cur_scroll = 1.0
+        cur_ggt = False
+        for tm in self.timingpoints:
+            scroll = tm.scroll * base_scroll
+            if scroll != cur_scroll:
+                self.commands_within.append(
+                    (tm.offset, FMT_SCROLLCHANGE, scroll))
+            if tm.GGT != cur_ggt:
+                self.commands_within.append((tm.offset,
+                                             tm.GGT and FMT_GOGOSTART or FMT_GOGOEND))
+            cur_scroll = scroll
+            cur_ggt = tm.GGT
+
+        BPM = self.timingpoints[0].bpm
+        ms_osu_total_offset = MS_OSU_MUSIC_OFFSET
+        if self.osu_format_ver < 5:
+            ms_osu_total_offset += MS_OSU_PRE_V5_MUSIC_OFFSET
+        OFFSET = (-self.timingpoints[0].offset - ms_osu_total_offset) / 1000.0
+        DEMOSTART = (preview + ms_osu_total_offset) / 1000.0
+        MOVIEOFFSET = (movieoffset + ms_osu_total_offset) / 1000.0
+
+        scroll = self.timingpoints[0].scroll
+        tm_idx = 0  # current timing point index
+        obj_idx = 0  # current hit object index
+        measure = self.timingpoints[0].beats  # current measure
+        curr_bpm = BPM  # current bpm
+
+        bar_data = []  # current bar data
+
+        bar_offset_begin = self.timingpoints[0].offset
+        bar_max_length = 1.0 * measure * T_MINUTE / curr_bpm  # current bar length
+
+        bar_cnt = 1
+        tja_heads_meta.append(WATER_MARK)
+        tja_heads_meta.append("TITLE:%s" % title)
+        if subtitle != "" and artist != "":
+            subtitle = f"{artist} ｢{subtitle}｣より"
+        tja_heads_meta.append("SUBTITLE:--%s" % (subtitle or artist))
+        tja_heads_meta.append("WAVE:%s" % (audio_name or audio))
+        tja_heads_meta.append("MAKER:%s" % creator) # for TJAP2fPC-based sims
+        tja_heads_meta.append("AUTHOR:%s" % creator) # for Malody
+
+        tja_heads_meta.append("DEMOSTART:%s" % repr(DEMOSTART))
+
+        if preimage:
+            tja_heads_meta.append("PREIMAGE:%s" % preimage)
+            self.chart_resources[preimage] = 'preview image'
+        if bgmovie:
+            tja_heads_meta.append("BGMOVIE:%s" % bgmovie)
+            tja_heads_meta.append("MOVIEOFFSET:%s" % repr(MOVIEOFFSET))
+            self.chart_resources[bgmovie] = 'background video'
+
+        tja_heads_sync.append("BPM:%s" % repr(self.timingpoints[0].bpm))
+        tja_heads_sync.append("OFFSET:%s" % repr(OFFSET))
+
+        str_info_diff_orig = f"// osu! difficulty: {version}"
+        if self.gamemode_idx != GAMEMODE_TAIKO:
+            str_mode = GAMEMODE_TO_STR.get(self.gamemode_idx, f"game mode {self.gamemode_idx}")
+            str_info_diff_orig += f" ({str_mode} convert)"
+        tja_heads_diff.append(str_info_diff_orig)
+        tja_heads_diff.append(f"COURSE:{course}") # TODO: GUESS DIFFICULTY
+        if level is None:
+            level = osu2tja_level(overall_difficulty)
+        tja_heads_diff.append(f"LEVEL:{level}")  # TODO: GUESS LEVEL
+
+        # don't write score init and score diff
+        # taiko jiro will calculate score automatically
+        tja_heads_diff.append("BALLOON:%s" % ','.join(map(repr, self.balloons)))
+
+        tja_contents.append("#START")
+
+        def is_new_measure(timing_point):
+            bpm = timing_point.bpm
+            _measure = timing_point.beats
+            return bpm != curr_bpm or measure != _measure or timing_point.redline
+
+        # check if all notes align ok
+        for i in range(len(hitobjects) - 1):
+            ho1, ho2 = hitobjects[i], hitobjects[i + 1]
+            # allows simultaneous notes in different columns
+            if ho1[1] > ho2[1] or (ho1[1] == ho2[1] and ho1[2] == ho2[2]):
+                print_with_pended(f"Warning: Hit object {i}: {ho1} occurs non-before hit object {i + 1}: {ho2}.", file=sys.stderr)
+
+        while obj_idx < len(hitobjects):
+            # get next object to process
+            next_obj = hitobjects[obj_idx]
+            next_obj_offset = int(math.floor(next_obj[1]))
+
+            # get next measure offset to compare
+            if tm_idx < len(self.timingpoints):
+                next_measure_offset = self.timingpoints[tm_idx].offset
+            else:
+                next_measure_offset = bar_offset_begin + bar_max_length + 1
+
+            # skip volumn change and kiai
+            if tm_idx < len(self.timingpoints) and \
+                    not is_new_measure(self.timingpoints[tm_idx]):
+                tm_idx += 1
+                continue
+
+            # check if this object falls into this measure
+            end = min(bar_offset_begin + bar_max_length, next_measure_offset)
+
+            if next_obj_offset >= int(math.floor(end)):
+                # write_a_measure()
+                if int(math.floor(end)) == int(math.floor(bar_offset_begin + bar_max_length)):
+                    tm = self.timing_index.at(bar_offset_begin)
+                    self.write_bar_data(tm, bar_data, bar_offset_begin,
+                                        end, tja_contents)
+                    bar_data = []
+                    bar_cnt += 1
+                    bar_offset_begin = self.get_real_offset(end)
+                    bar_max_length = measure * time_per_beat
+                elif int(math.floor(end)) == int(math.floor(next_measure_offset)):  # collect an incomplete bar?
+                    if tm_idx > 0: # not the start of the initial bar
+                        self.write_incomplete_bar(self.timing_index.at(bar_offset_begin),
+                                                  bar_data, bar_offset_begin, end, tja_contents)
+                    bar_data = []
+                    measure = self.timingpoints[tm_idx].beats
+                    if self.timingpoints[tm_idx].redline:
+                        curr_bpm = self.timingpoints[tm_idx].bpm
+                        bar_offset_begin = next_measure_offset
+                        tja_contents.append(make_cmd(FMT_BPMCHANGE, curr_bpm))
+                    else:
+                        bar_offset_begin = end
+                    time_per_beat = (60 * 1000) / curr_bpm
+                    bar_max_length = measure * time_per_beat
+
+                    if self.tail_fix:
+                        self.tail_fix = False
+                        obj_idx -= 1
+                        hitobjects.offsets[obj_idx] = bar_offset_begin
+
+                    # add new commands
+                    tja_contents.append(make_cmd(FMT_MEASURECHANGE, measure, 4))
+
+                    tm_idx += 1
+                else:
+                    assert False, "BAR END POS ERROR"
+
             else:
-                bar_data.append(next_obj)
-            obj_idx += 1
+                if next_obj[1] < bar_offset_begin:
+                    bar_data.append((next_obj[0], bar_offset_begin))
+                else:
+                    bar_data.append(next_obj)
+                obj_idx += 1
+
+        # flush buffer
+        if len(bar_data) > 0:
+            self.write_bar_data(self.timing_index.at(bar_offset_begin),
+                                bar_data, bar_offset_begin, end, tja_contents)
+
+        tja_contents.append("#END")
+        laps.lap("bars")
+        return tja_heads_meta, tja_heads_sync, tja_heads_diff, tja_contents, self.chart_resources
+
 
-    # flush buffer
-    if len(bar_data) > 0:
-        write_bar_data(get_base_timing_point(timingpoints, bar_offset_begin),
-                       bar_data, bar_offset_begin, end, tja_contents)
+def osu2tja(fp: IO[str], course: Union[str, int], level: Union[int, float], audio_name: Optional[str],
+        timings: Optional[StageTimings] = None) -> osu2tja_result_t:
+    """`timings`: where to add the times of the conversion stages, or `None` not to time them"""
+    return Osu2TjaConverter(timings=timings).convert(fp, course, level, audio_name)
 
-    tja_contents.append("#END")
-    init_debug_globals()
-    return tja_heads_meta, tja_heads_sync, tja_heads_diff, tja_contents, chart_resources
+
+def osu2tja_many(jobs: Iterable[Sequence], max_workers: Optional[int] = None,
+        show_head_info: bool = False, guess_measure: bool = False,
+        max_ticks: int = MAX_TICKS_PER_OBJECT) -> List[osu2tja_result_t]:
+    """Convert multiple .osu streams on a thread pool.
+
+    Each job is the `(fp, course, level, audio_name)` arguments of `osu2tja()`.
+    The results are in the order of `jobs`, same as converting them one by one.
+    """
+    def convert_one(job: Sequence) -> osu2tja_result_t:
+        return Osu2TjaConverter(show_head_info, guess_measure, max_ticks).convert(*job)
+
+    with ThreadPoolExecutor(max_workers) as executor:
+        return list(executor.map(convert_one, jobs))
+
+
+def positive_int(str_: str) -> int:
+    value = int(str_)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"should be at least 1, got {value}")
+    return value
 
 
 def main():
@@ -965,21 +1145,23 @@ def main():
         help="display extra info")
     parser.add_argument("-g", "--guess-measure", "--guess", action="store_true",
         help="force skipping predefined integer ratio look-up for bar length")
+    parser.add_argument("--max-ticks", type=positive_int, default=MAX_TICKS_PER_OBJECT, metavar="N",
+        help=f"convert at most N notes from a single slider or hold (default: {MAX_TICKS_PER_OBJECT})")
+    parser.add_argument("--timings", metavar="FILE", default=None,
+        help="write the wall & CPU times of each conversion stage to FILE as JSON and print them")
     args = parser.parse_args()
 
-    global show_head_info, guess_measure
-    show_head_info = args.debug
-    guess_measure = args.guess_measure
-
     # check filename
     if not args.filename.lower().endswith(".osu"):
         print("Input file should be Osu file!(*.osu): \n\t[[ %s ]]" % args.filename, file=sys.stderr)
         return
 
+    timings = StageTimings() if args.timings is not None else None
+
     # try to open file
     try:
         fp = codecs.open(args.filename, "r", "utf8")
-        head_meta, head_sync, head_diff, diff_content, recs = osu2tja(fp, 3, 9, None) # defaulted course and level
+        head_meta, head_sync, head_diff, diff_content, recs = Osu2TjaConverter(args.debug, args.guess_measure, args.max_ticks, timings).convert(fp, 3, 9, None) # defaulted course and level
         head_sync_main = head_sync
     except IOError:
         print("Can't open file `%s`" % args.filename, file=sys.stderr)
@@ -994,6 +1176,10 @@ def main():
     print("\n")
     print("\n".join(diff_content))
 
+    if timings is not None:
+        write_timings(args.timings, {args.filename: timings.stages})
+        print_timings_table({args.filename: timings.stages}, file=sys.stderr)
+
 
 if __name__ == "__main__":
     main()
@@ -1,16 +1,23 @@
 import argparse
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext, redirect_stderr, redirect_stdout
+import hashlib
+import json
 import shutil
+import threading
 import textwrap
+import time
 import traceback
 from common.utils import print_with_pended, print_pend, print_unpend
-from osu2tja.osu2tja import OSU_VER_STR_PREFIX, osu2tja
-from tja2osu.tja2osu_file_dvide import tja2osus
+from osu2tja.osu2tja import OSU_VER_STR_PREFIX, osu2tja, osu2tja_result_t
+from tja2osu.tja2osu_file_dvide import osz_files_t, tja2osus, write_osz
+from timings import StageTimings, print_timings_table, stage_times_t, timed, write_timings
 from zipfile import ZipFile, is_zipfile
-from typing import Dict, List, Literal
+from typing import Callable, Dict, Iterator, List, Literal, Optional, Sequence, Set, Tuple, TypeVar
 from os import path
 import os
 import sys
-from io import TextIOWrapper
+from io import TextIOBase, TextIOWrapper
 import subprocess
 
 def extract_osu_file_info(file) -> Dict[str, object]:
@@ -42,62 +49,350 @@ def extract_osu_file_info(file) -> Dict[str, object]:
     return result
 
 
-def convert_to_ogg(audio_root: str, audio_name: str) -> str:
-    fname, ext = os.path.splitext(audio_name)
-    audio_name_ogg = f"{fname}.ogg"
-    audio_path = os.path.join(audio_root, audio_name)
-    audio_path_ogg = os.path.join(audio_root, audio_name_ogg)
-
-    if ext.lower() != ".ogg":
+ffmpeg_candidates = ["ffmpeg", "./ffmpeg", "./ffmpeg.exe"]
+ffmpeg_ogg_args = ["-hide_banner", "-loglevel", "error"]
+
+def find_ffmpeg() -> Optional[str]:
+    for ffmpeg in ffmpeg_candidates:
+        if shutil.which(ffmpeg) is not None:
+            return ffmpeg
+    return None
+
+
+def hash_file(fpath: str, hasher=None) -> str:
+    """Return the hex digest of the contents of `fpath`, appended to what is already in `hasher` (default: a new SHA-256)"""
+    hasher = hasher or hashlib.sha256()
+    with open(fpath, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def link_or_copy(src: str, dst: str) -> None:
+    """Hard-link `src` to `dst`, or copy it if the file system does not support that. `dst` is replaced if existing."""
+    os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class TranscodeCache:
+    """An on-disk cache of converted audio files, keyed by the hash of the source audio and the ffmpeg arguments.
+
+    The least recently used files are removed once the total size exceeds `size_limit` bytes.
+    """
+    def __init__(self, cache_dir: str, size_limit: int) -> None:
+        self.cache_dir = cache_dir
+        self.size_limit = size_limit
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, src_path: str, args: List[str]) -> str:
+        hasher = hashlib.sha256("\0".join(args).encode("utf-8"))
+        hasher.update(b"\0")
+        return hash_file(src_path, hasher)
+
+    def path_of(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.ogg")
+
+    def fetch(self, key: str, dst_path: str) -> bool:
+        """Place the cached file of `key` at `dst_path`. Return whether it is cached."""
+        cached_path = self.path_of(key)
+        try:
+            os.utime(cached_path) # mark as recently used
+            # copied rather than linked, so that editing the output never changes the cache
+            # and evicting the file frees the space
+            shutil.copyfile(cached_path, dst_path)
+        except FileNotFoundError:
+            self.misses += 1
+            return False
+        self.hits += 1
+        return True
+
+    def store(self, key: str, src_path: str) -> None:
+        # copy to a temporary file first so that other processes never see a partial file
+        tmp_path = f"{self.path_of(key)}.{os.getpid()}-{threading.get_ident()}.tmp"
+        try:
+            shutil.copyfile(src_path, tmp_path)
+            os.replace(tmp_path, self.path_of(key))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def evict(self) -> None:
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".ogg"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError: # removed by another process
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry_path in sorted(entries):
+            if total_size <= self.size_limit:
+                break
+            try:
+                os.remove(entry_path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+
+class AudioTranscoder:
+    """Converts audio files into `.ogg` with at most `max_procs` ffmpeg processes in the background.
+
+    The results are reported in submission order by `wait()`, which is also called on exiting the `with` block.
+    With `cache`, converted files are reused across runs.
+    """
+    def __init__(self, max_procs: int = 2, cache: Optional[TranscodeCache] = None) -> None:
+        self.ffmpeg = find_ffmpeg()
+        self.cache = cache
+        self.executor = ThreadPoolExecutor(max_procs, thread_name_prefix="ffmpeg")
+        # (audio root, audio name, shared roots, conversion); no conversion for cached files
+        self.pending: List[Tuple[str, str, Sequence[str], Optional[Future]]] = []
+
+    def __enter__(self) -> "AudioTranscoder":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.wait()
+        self.executor.shutdown()
+
+    def submit(self, audio_root: str, audio_name: str, shared_roots: Sequence[str] = ()) -> str:
+        """Start converting `audio_name` and return the audio name to be used in the `.tja` file.
+
+        The resulting audio file is also placed into each of `shared_roots` once available.
+        If the conversion fails, the original audio file is kept and shared instead; see `wait()`.
+        """
+        fname, ext = os.path.splitext(audio_name)
+        audio_name_ogg = f"{fname}.ogg"
+        audio_path = os.path.join(audio_root, audio_name)
+        audio_path_ogg = os.path.join(audio_root, audio_name_ogg)
+
+        if ext.lower() == ".ogg":
+            self.share(audio_root, audio_name, shared_roots)
+            return audio_name
         if os.path.exists(audio_path_ogg):
+            self.share(audio_root, audio_name_ogg, shared_roots)
             return audio_name_ogg
-        print(f"Converting `{audio_path}` -> `{audio_path_ogg}` ...", end="", flush=True)
-        print_pend()
-        for ffmpeg in ["ffmpeg", "./ffmpeg", "./ffmpeg.exe"]:
+
+        if self.ffmpeg is None:
+            print_with_pended("Cannot found ffmpeg. Will not convert to `.ogg`.", file=sys.stderr)
+            self.share(audio_root, audio_name, shared_roots)
+            return audio_name
+
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(audio_path, [".ogg", *ffmpeg_ogg_args])
+            if self.cache.fetch(key, audio_path_ogg):
+                self.share(audio_root, audio_name_ogg, shared_roots)
+                self.pending.append((audio_root, audio_name, shared_roots, None))
+                return audio_name_ogg
+
+        def transcode_and_share() -> subprocess.CompletedProcess:
+            proc = self.transcode(audio_path, audio_path_ogg, key)
+            if proc.returncode == 0:
+                self.share(audio_root, audio_name_ogg, shared_roots)
+            return proc
+
+        future = self.executor.submit(transcode_and_share)
+        self.pending.append((audio_root, audio_name, shared_roots, future))
+        return audio_name_ogg
+
+    def transcode(self, audio_path: str, audio_path_ogg: str, key: Optional[str]) -> subprocess.CompletedProcess:
+        assert self.ffmpeg is not None
+        # convert into a file of this job only and move it into place once complete,
+        # so that a failure never leaves or removes a file written by another task
+        tmp_path_ogg = f"{os.path.splitext(audio_path_ogg)[0]}.{os.getpid()}-{threading.get_ident()}.tmp.ogg"
+        try:
+            # never wait for the console input or overwrite
+            proc = subprocess.run([self.ffmpeg, "-nostdin", "-n", "-i", audio_path, tmp_path_ogg, *ffmpeg_ogg_args],
+                stdin=subprocess.DEVNULL, capture_output=True, text=True)
+            if proc.returncode == 0:
+                if self.cache is not None and key is not None:
+                    self.cache.store(key, tmp_path_ogg)
+                os.replace(tmp_path_ogg, audio_path_ogg)
+        finally:
+            if os.path.exists(tmp_path_ogg):
+                os.remove(tmp_path_ogg) # incomplete
+        return proc
+
+    @staticmethod
+    def share(audio_root: str, audio_name: str, shared_roots: Sequence[str]) -> None:
+        for shared_root in shared_roots:
+            link_or_copy(os.path.join(audio_root, audio_name), os.path.join(shared_root, audio_name))
+
+    def wait(self) -> List[Tuple[str, str]]:
+        """Wait for all pending conversions and report the results.
+
+        Return the original and the `.ogg` audio names of the failed conversions,
+        whose original audio files are shared instead, so that the charts can refer to them back.
+        """
+        failed: List[Tuple[str, str]] = []
+        for audio_root, audio_name, shared_roots, future in self.pending:
+            audio_name_ogg = f"{os.path.splitext(audio_name)[0]}.ogg"
+            audio_path = os.path.join(audio_root, audio_name)
+            audio_path_ogg = os.path.join(audio_root, audio_name_ogg)
+            if future is None:
+                os.remove(audio_path) # no longer needed
+                print(f"Converting `{audio_path}` -> `{audio_path_ogg}` done! (cached)")
+                continue
             try:
-                proc = subprocess.run([ffmpeg, "-i", audio_path, audio_path_ogg, "-hide_banner", "-loglevel", "error"])
+                proc = future.result()
                 if proc.returncode == 0:
                     os.remove(audio_path) # no longer needed
-                    print_unpend()
-                    print(f"\rConverting `{audio_path}` -> `{audio_path_ogg}` done!")
-                    return audio_name_ogg
-                print_with_pended(proc.stderr, file=sys.stderr)
-                print("Convert audio failed. Continued.", file=sys.stderr)
-                break
-            except FileNotFoundError:
-                continue
-        else:
-            print_with_pended("Cannot found ffmpeg. Will not convert to `.ogg`.", file=sys.stderr)
-
-    return audio_name
+                    print(f"Converting `{audio_path}` -> `{audio_path_ogg}` done!")
+                    continue
+                print_with_pended(proc.stderr.rstrip("\n"), file=sys.stderr)
+            except Exception:
+                print_with_pended(traceback.format_exc(), file=sys.stderr)
+            self.share(audio_root, audio_name, shared_roots)
+            print(f"Convert audio `{audio_path}` failed. Kept the original audio. Continued.", file=sys.stderr)
+            failed.append((audio_name, audio_name_ogg))
+        self.pending.clear()
+        return failed
+
+
+class CapturedOutput(TextIOBase):
+    """Records the text written to a standard stream, in order with other captured streams."""
+    def __init__(self, chunks: List[Tuple[str, str]], stream_name: str) -> None:
+        self.chunks = chunks
+        self.stream_name = stream_name
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, s: str) -> int:
+        self.chunks.append((self.stream_name, s))
+        return len(s)
+
+T = TypeVar('T')
+
+def run_captured(task: Callable[..., T], *args) -> Tuple[T, List[Tuple[str, str]]]:
+    chunks: List[Tuple[str, str]] = []
+    with redirect_stdout(CapturedOutput(chunks, "stdout")), redirect_stderr(CapturedOutput(chunks, "stderr")):
+        result = task(*args)
+    return result, chunks
+
+def replay_captured(chunks: List[Tuple[str, str]], pended: bool = False) -> None:
+    # `pended`: the task output starts with `print_with_pended()` while the pended line is in this process
+    if pended and chunks:
+        print_with_pended(end="", file=getattr(sys, chunks[0][0]))
+    for stream_name, s in chunks:
+        stream = getattr(sys, stream_name)
+        stream.write(s)
+        stream.flush()
+
+def map_captured(executor: Optional[Executor], task: Callable[..., T], args_list: List[Tuple],
+        pended: bool = False) -> Iterator[T]:
+    """Yield the result of `task` for each item of `args_list` in order.
+
+    With an executor, the console output of each task is collected and printed as a whole
+    once the task and all the tasks before it are done, the same as running them one by one.
+    """
+    if executor is None:
+        for args in args_list:
+            yield task(*args)
+        return
+
+    futures = [executor.submit(run_captured, task, *args) for args in args_list]
+    for future in futures:
+        result, chunks = future.result()
+        replay_captured(chunks, pended)
+        yield result
+
+def start_process_pool(max_workers: int, initializer: Optional[Callable[[], object]] = None) -> ProcessPoolExecutor:
+    """Return a process pool whose workers are all started now.
+
+    Workers are otherwise started on the first submission; with the "fork" start method,
+    forking after other threads (e.g., of `AudioTranscoder`) have started risks deadlocks on their locks.
+    """
+    executor = ProcessPoolExecutor(max_workers, initializer=initializer)
+    executor.submit(int).result() # with "fork", all the workers are started at the first submission
+    return executor
+
+def replace_tja_wave(tja_fpath: str, enc: str, wave_old: str, wave_new: str) -> None:
+    """Replace the `WAVE:` header of the written `.tja` file, in the same encoding if possible."""
+    with open(tja_fpath, "r", encoding=enc) as f:
+        contents = f.read()
+    # the watermark is always the first line
+    contents = contents.replace(f"\nWAVE:{wave_old}\n", f"\nWAVE:{wave_new}\n", 1)
+    for enc_new in dict.fromkeys([enc, "utf-8-sig"]):
+        try:
+            with open(tja_fpath, "w", encoding=enc_new) as f:
+                f.write(contents)
+            break
+        except UnicodeEncodeError:
+            assert enc_new != "utf-8-sig", "Found invalid UTF-8 characters during conversion."
 
 bad_chars_for_path = {'\\', '/', ':', '*', '?', '"', '<', '>', '|', '.', '{', '}'}
 
-
-def convert_osz2tja(osus_fpath: str, target_path: str) -> None:
+def title_for_path_of(osu_info: Dict[str, object]) -> str:
+    return ''.join((
+        ch if ch not in bad_chars_for_path else '_'
+        for ch in osu_info["title_ascii"]))
+
+def osz_title_for_path(osus_fpath: str) -> Optional[str]:
+    """Return the title naming the output folders of the .osz file, or `None` if it cannot be read."""
+    try:
+        with ZipFile(osus_fpath, "r") as osu_zip:
+            # the first map names the folders; see `convert_osz2tja()`
+            filename = next(filename for filename in osu_zip.namelist() if filename.endswith(".osu"))
+            with TextIOWrapper(osu_zip.open(filename, "r"), encoding="utf-8") as fp:
+                return title_for_path_of(extract_osu_file_info(fp))
+    except Exception:
+        return None
+
+
+def convert_osu_diff(osus_fpath: str, filename: str, diff: str, level: int, audio_name: str, version: str, folder_name: str,
+        with_timings: bool = False) -> Tuple[Optional[osu2tja_result_t], Optional[stage_times_t]]:
+    """Return the result and, if `with_timings`, the stage times, which are passed back as-is from the worker processes."""
+    # Note: all outputs start with `print_with_pended()`
+    timings = StageTimings() if with_timings else None
+    stages = timings.stages if timings is not None else None
+    try:
+        # stream the .osu file from the archive to keep the memory usage bounded
+        with ZipFile(osus_fpath, "r") as osu_zip, \
+                TextIOWrapper(osu_zip.open(filename, "r"), encoding="utf-8") as diff_fp:
+            return osu2tja(diff_fp, diff, level, audio_name, timings), stages
+    except Exception:
+        print_with_pended(traceback.format_exc(), file=sys.stderr)
+        print(f"Error processing {diff} [{version}] difficulty of `{folder_name}`. Continued.", file=sys.stderr)
+        return None, stages
+
+
+def convert_osz2tja(osus_fpath: str, target_path: str, jobs: int = 1, audio_cache: Optional[TranscodeCache] = None,
+        timings: Optional[StageTimings] = None) -> List[str]:
+    """Return the paths of the created folders. The times of the conversion stages are added to `timings` if specified."""
     if not is_zipfile(osus_fpath):
         raise ValueError(f"{osus_fpath} is not a valid zip file")
     osus_fname = os.path.basename(osus_fpath)
 
-    osu_zip: ZipFile = ZipFile(osus_fpath, "r")
-    osu_files = [filename for filename in osu_zip.namelist() if filename.endswith(".osu")]
-    if not osu_files:
-        raise ValueError(f"No .osu files found in {osus_fpath}")
-
-    osu_infos_by_song: Dict[str, List] = {}
-    for filename in osu_files:
-        fp = TextIOWrapper(osu_zip.open(filename, "r"), encoding="utf-8")
-        osu_info = extract_osu_file_info(fp)
-        fp.close()
-        osu_info["filename"] = filename
-        assert type(osu_info["audio"]) == str
-        osu_infos_by_song.setdefault(osu_info["audio"], []).append(osu_info)
+    with timed(timings, "read_zip"):
+        osu_zip: ZipFile = ZipFile(osus_fpath, "r")
+        osu_files = [filename for filename in osu_zip.namelist() if filename.endswith(".osu")]
+        if not osu_files:
+            raise ValueError(f"No .osu files found in {osus_fpath}")
+
+        osu_infos_by_song: Dict[str, List] = {}
+        for filename in osu_files:
+            # only the beginning of the .osu file is decompressed and decoded
+            with TextIOWrapper(osu_zip.open(filename, "r"), encoding="utf-8") as fp:
+                osu_info = extract_osu_file_info(fp)
+            osu_info["filename"] = filename
+            assert type(osu_info["audio"]) == str
+            osu_infos_by_song.setdefault(osu_info["audio"], []).append(osu_info)
 
     osu_info_first = next(iter(osu_infos_by_song.values()))[0]
     title = osu_info_first["title"] # Use the title of the first map for naming
-    title_for_path = ''.join((
-        ch if ch not in bad_chars_for_path else '_'
-        for ch in osu_info_first["title_ascii"]))
+    title_for_path = title_for_path_of(osu_info_first)
 
     n_diffs_max_per_tja = 5
     will_split_tja = (
@@ -106,137 +401,463 @@ def convert_osz2tja(osus_fpath: str, target_path: str) -> None:
     )
 
     n_tjas = 0
-    for song_audio, osu_infos in osu_infos_by_song.items():
-        osu_infos.sort(key=lambda x: x["difficulty"])
-        for start_idx in range(0, len(osu_infos), n_diffs_max_per_tja):
-            # Get the subset of difficulties for this folder
-            selected_infos = osu_infos[start_idx:start_idx + n_diffs_max_per_tja]
+    created_paths: List[str] = []
+    # convert difficulties in parallel
+    # Note: the pended line belongs to this process; the workers must not inherit it. See `replay_captured()`
+    n_jobs = min(jobs, len(osu_files))
+    # audio files are converted while converting the charts
+    # the worker processes are started before the transcoder threads
+    with (start_process_pool(n_jobs, initializer=print_unpend) if n_jobs > 1 else nullcontext()) as executor, \
+            AudioTranscoder(cache=audio_cache) as transcoder:
+        # the first extracted copy of each resource file, to be shared by the other folders
+        extracted_resources: Dict[str, Tuple[str, str]] = {}
+        # song audio -> the written .tja files and their encodings, to be fixed if the audio conversion fails
+        tja_files_by_audio: Dict[str, List[Tuple[str, str]]] = {}
+        for song_audio, osu_infos in osu_infos_by_song.items():
+            osu_infos.sort(key=lambda x: x["difficulty"])
+            start_idxs = range(0, len(osu_infos), n_diffs_max_per_tja)
 
             # 1 directory per .tja file for maximum compatibility
-            n_tjas += 1
-            folder_name = f"{title_for_path} - {n_tjas}" if will_split_tja else title_for_path
+            folder_names = []
+            for _ in start_idxs:
+                n_tjas += 1
+                folder_names.append(f"{title_for_path} - {n_tjas}" if will_split_tja else title_for_path)
+            storage_paths = [path.join(target_path, folder_name) for folder_name in folder_names]
+            for storage_path in storage_paths:
+                os.makedirs(storage_path, exist_ok=True)
+            created_paths.extend(storage_paths)
 
             # Extract audio first
-            storage_path = path.join(target_path, folder_name)
-            os.makedirs(storage_path, exist_ok=True)
+            # The audio is extracted and converted only once and then shared with the other folders of the song
             try:
-                osu_zip.extract(song_audio, storage_path)
-                song_audio_tja = convert_to_ogg(storage_path, song_audio)
+                with timed(timings, "extract_audio"):
+                    osu_zip.extract(song_audio, storage_paths[0])
+                    song_audio_tja = transcoder.submit(storage_paths[0], song_audio, storage_paths[1:])
             except KeyError:
                 print(f"Warning: song audio `{song_audio}` not found. Neither copied nor converted.", file=sys.stderr)
                 song_audio_tja = song_audio
 
-            # Collect other chart resources
-            resources: Dict[str, str] = {}
-
-            tja_fname = f"{folder_name}.tja"
-            tja_fpath = path.join(storage_path, tja_fname)
-            print(f"Converting `{osus_fname}` to `{tja_fname}` ...", end="", flush=True)
-            print_pend()
-
-            # Adjust difficulties for this folder
-            difficulties = ["Edit", "Oni", "Hard", "Normal", "Easy"]
-            if len(selected_infos) <= 4:
-                difficulties = difficulties[1:1+len(selected_infos)]
-
-            head_meta: List[str] = []
-            head_sync_main: List[str] = []
-            head_syncs: Dict[str, List[str]] = {diff: [] for diff in difficulties}
-            head_diffs: Dict[str, List[str]] = {diff: [] for diff in difficulties}
-            diff_contents: Dict[str, List[str]] = {diff: [] for diff in difficulties}
-
-            # process in descending difficulties
-            # Note: `selected_infos` is in ascending OverallDifficulty
-            head_sync_main_printed = False
-            for diff, info in zip(difficulties, reversed(selected_infos)):
-                try:
-                    with TextIOWrapper(osu_zip.open(info["filename"]), encoding="utf-8") as diff_fp:
-                        level = int(info["difficulty"])
-                        head_meta, head_syncs[diff], head_diffs[diff], diff_contents[diff], rescs = (
-                            osu2tja(diff_fp, diff, level, song_audio_tja)
-                        )
-                        resources.update(rescs)
-                        if len(head_sync_main) == 0:
-                            head_sync_main = head_syncs[diff]
-                        elif head_syncs[diff] != head_sync_main:
-                            if not head_sync_main_printed:
-                                print_with_pended(f"Warning: Main sync headers: {head_sync_main}", file=sys.stderr)
-                                head_sync_main_printed = True
-                            print(f"Warning: Generated a different sync header for {diff}: {head_syncs[diff]}", file=sys.stderr)
-                except Exception:
-                    print_with_pended(traceback.format_exc(), file=sys.stderr)
-                    print(f"Error processing {diff} [{info['version']}] difficulty of `{folder_name}`. Continued.", file=sys.stderr)
-
-            # Save .tja file
-            for enc in ["shift-jis", "utf-8-sig"]:
-                try:
-                    with open(tja_fpath, "w+", encoding=enc) as f:
-                        f.write("\n".join(head_meta))
-                        f.write("\n")
-                        f.write("\n".join(head_sync_main))
-                        f.write("\n")
-                        for diff in difficulties:
-                            if diff_contents[diff]:
-                                f.write("\n")
-                                f.write("\n".join(head_diffs[diff]))
-                                f.write("\n")
-                                f.write("\n".join(head_syncs[diff]))
-                                f.write("\n\n")
-                                f.write("\n".join(diff_contents[diff]))
-                                f.write("\n")
-                    break
-                except UnicodeEncodeError:
-                    assert enc != "utf-8-sig", "Found invalid UTF-8 characters during conversion."
-
-            print_unpend()
-            print(f"\rConverting `{osus_fname}` to `{tja_fname}` done!")
-
-            # Extract other resources
-            for rfname, rtype in resources.items():
-                try:
-                    osu_zip.extract(rfname, storage_path)
-                except KeyError:
-                    print_with_pended(f"Warning: Referenced {rtype} file `{rfname}` not found. Not copied.", file=sys.stderr)
+            for start_idx, folder_name, storage_path in zip(start_idxs, folder_names, storage_paths):
+                # Get the subset of difficulties for this folder
+                selected_infos = osu_infos[start_idx:start_idx + n_diffs_max_per_tja]
+
+                # Collect other chart resources
+                resources: Dict[str, str] = {}
+
+                tja_fname = f"{folder_name}.tja"
+                tja_fpath = path.join(storage_path, tja_fname)
+                print(f"Converting `{osus_fname}` to `{tja_fname}` ...", end="", flush=True)
+                print_pend()
+
+                # Adjust difficulties for this folder
+                difficulties = ["Edit", "Oni", "Hard", "Normal", "Easy"]
+                if len(selected_infos) <= 4:
+                    difficulties = difficulties[1:1+len(selected_infos)]
+
+                head_meta: List[str] = []
+                head_sync_main: List[str] = []
+                head_syncs: Dict[str, List[str]] = {diff: [] for diff in difficulties}
+                head_diffs: Dict[str, List[str]] = {diff: [] for diff in difficulties}
+                diff_contents: Dict[str, List[str]] = {diff: [] for diff in difficulties}
+
+                # process in descending difficulties
+                # Note: `selected_infos` is in ascending OverallDifficulty
+                diff_args = [
+                    (osus_fpath, info["filename"], diff, int(info["difficulty"]), song_audio_tja, info["version"], folder_name,
+                        timings is not None)
+                    for diff, info in zip(difficulties, reversed(selected_infos))]
+                head_sync_main_printed = False
+                for diff, (result, stages) in zip(difficulties, map_captured(executor, convert_osu_diff, diff_args, pended=True)):
+                    if timings is not None and stages is not None:
+                        timings.merge(stages)
+                    if result is None:
+                        continue
+                    head_meta, head_syncs[diff], head_diffs[diff], diff_contents[diff], rescs = result
+                    resources.update(rescs)
+                    if len(head_sync_main) == 0:
+                        head_sync_main = head_syncs[diff]
+                    elif head_syncs[diff] != head_sync_main:
+                        if not head_sync_main_printed:
+                            print_with_pended(f"Warning: Main sync headers: {head_sync_main}", file=sys.stderr)
+                            head_sync_main_printed = True
+                        print(f"Warning: Generated a different sync header for {diff}: {head_syncs[diff]}", file=sys.stderr)
+
+                # Save .tja file
+                for enc in ["shift-jis", "utf-8-sig"]:
+                    try:
+                        with timed(timings, "write_tja"), open(tja_fpath, "w+", encoding=enc) as f:
+                            f.write("\n".join(head_meta))
+                            f.write("\n")
+                            f.write("\n".join(head_sync_main))
+                            f.write("\n")
+                            for diff in difficulties:
+                                if diff_contents[diff]:
+                                    f.write("\n")
+                                    f.write("\n".join(head_diffs[diff]))
+                                    f.write("\n")
+                                    f.write("\n".join(head_syncs[diff]))
+                                    f.write("\n\n")
+                                    f.write("\n".join(diff_contents[diff]))
+                                    f.write("\n")
+                        break
+                    except UnicodeEncodeError:
+                        assert enc != "utf-8-sig", "Found invalid UTF-8 characters during conversion."
+                tja_files_by_audio.setdefault(song_audio, []).append((tja_fpath, enc))
+                del diff_contents # written; free it before converting the next folder
+
+                print_unpend()
+                print(f"\rConverting `{osus_fname}` to `{tja_fname}` done!")
+
+                # Extract other resources
+                for rfname, rtype in resources.items():
+                    try:
+                        with timed(timings, "resources"):
+                            if rfname in extracted_resources:
+                                # `ZipFile.extract()` sanitizes the path; reuse it
+                                extracted_root, extracted_path = extracted_resources[rfname]
+                                link_or_copy(extracted_path,
+                                    path.join(storage_path, path.relpath(extracted_path, extracted_root)))
+                            else:
+                                extracted_resources[rfname] = (storage_path, osu_zip.extract(rfname, storage_path))
+                    except KeyError:
+                        print_with_pended(f"Warning: Referenced {rtype} file `{rfname}` not found. Not copied.", file=sys.stderr)
+
+        # the remaining audio conversions; otherwise waited for on exiting the `with` block
+        with timed(timings, "ffmpeg"):
+            audio_failed = transcoder.wait()
+        # refer to the kept original audio instead
+        for song_audio, song_audio_ogg in audio_failed:
+            for tja_fpath, enc in tja_files_by_audio.get(song_audio, []):
+                replace_tja_wave(tja_fpath, enc, song_audio_ogg, song_audio)
 
     osu_zip.close()
+    return created_paths
+
+
+converter_sources = ["osz2tja.py", "osu2tja/osu2tja.py", "tja2osu/tja2osu.py", "tja2osu/tja2osu_file_dvide.py", "common/utils.py"]
+
+def converter_version() -> str:
+    """Return the fingerprint of the converter source files, so that outputs are regenerated after upgrades."""
+    root = path.dirname(path.abspath(__file__))
+    hasher = hashlib.sha256()
+    for source in converter_sources:
+        fpath = path.join(root, source)
+        if path.exists(fpath):
+            hasher.update(f"{source}\0".encode("utf-8"))
+            hash_file(fpath, hasher)
+    return hasher.hexdigest()
+
+
+class BatchManifest:
+    """Records the converted input files of a batch conversion and their outputs, for incremental conversion.
+
+    Stored as JSON in the output folder. Paths are relative to the input and output folders, respectively.
+    During a batch, it is saved by `save_if_due()` every `save_every` changed entries or `save_interval` seconds,
+    rather than after every input.
+    """
+    save_every = 100
+    save_interval = 10.0 # seconds
+
+    def __init__(self, input_folder: str, output_folder: str, name: str) -> None:
+        self.input_folder = input_folder
+        self.output_folder = output_folder
+        self.manifest_path = path.join(output_folder, name)
+        self.version = converter_version()
+        self.entries: Dict[str, Dict] = {}
+        self.n_unsaved = 0
+        self.t_saved = time.monotonic()
+        if path.exists(self.manifest_path):
+            try:
+                with open(self.manifest_path, "r", encoding="utf-8") as f:
+                    self.entries = json.load(f)["inputs"]
+            except (ValueError, KeyError):
+                print(f"Warning: Invalid manifest `{self.manifest_path}`. Everything will be converted.", file=sys.stderr)
+
+    def is_unchanged(self, input_path: str) -> bool:
+        entry = self.entries.get(path.relpath(input_path, self.input_folder))
+        if entry is None or entry["version"] != self.version:
+            return False
+        if not all(path.exists(path.join(self.output_folder, output)) for output in entry["outputs"]):
+            return False
+        stat = os.stat(input_path)
+        if stat.st_size != entry["size"]:
+            return False
+        if stat.st_mtime_ns != entry["mtime"]:
+            if hash_file(input_path) != entry["hash"]:
+                return False
+            entry["mtime"] = stat.st_mtime_ns # touched only
+        return True
+
+    def record(self, input_path: str, output_paths: List[str]) -> List[str]:
+        """Return the outputs of the previous conversion of `input_path` no longer produced by any input,
+        relative to the output folder. They are no longer recorded; see `remove_outputs()`.
+        """
+        key = path.relpath(input_path, self.input_folder)
+        entry_old = self.entries.get(key)
+        stat = os.stat(input_path)
+        self.entries[key] = {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "hash": hash_file(input_path),
+            "version": self.version,
+            "outputs": sorted({path.relpath(output, self.output_folder) for output in output_paths}),
+        }
+        self.n_unsaved += 1
+        if entry_old is None:
+            return []
+        return self.unreferenced(set(entry_old["outputs"]).difference(self.entries[key]["outputs"]))
+
+    def forget(self, input_path: str) -> None:
+        self.entries.pop(path.relpath(input_path, self.input_folder), None)
+        self.n_unsaved += 1
+
+    def unreferenced(self, outputs: Set[str]) -> List[str]:
+        if not outputs:
+            return []
+        # outputs may be shared by several inputs
+        outputs_kept = {output for entry in self.entries.values() for output in entry["outputs"]}
+        return sorted(outputs - outputs_kept)
+
+    def prune(self, input_paths: List[str]) -> List[str]:
+        """Remove the entries and the outputs of the inputs not in `input_paths`. Return the removed output paths."""
+        existing = {path.relpath(input_path, self.input_folder) for input_path in input_paths}
+        outputs_deleted = set()
+        for deleted in [key for key in self.entries if key not in existing]:
+            outputs_deleted.update(self.entries.pop(deleted)["outputs"])
+        return self.remove_outputs(self.unreferenced(outputs_deleted))
+
+    def remove_outputs(self, outputs: List[str]) -> List[str]:
+        """Remove `outputs`, relative to the output folder, if existing. Return the removed output paths."""
+        removed = []
+        for output in outputs:
+            output_path = path.join(self.output_folder, output)
+            if path.isdir(output_path):
+                shutil.rmtree(output_path)
+            elif path.exists(output_path):
+                os.remove(output_path)
+            else:
+                continue
+            removed.append(output_path)
+        return removed
+
+    def save(self) -> None:
+        os.makedirs(self.output_folder, exist_ok=True)
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"inputs": self.entries}, f, ensure_ascii=False, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+        self.n_unsaved = 0
+        self.t_saved = time.monotonic()
+
+    def save_if_due(self) -> None:
+        if self.n_unsaved >= self.save_every or (
+                self.n_unsaved > 0 and time.monotonic() - self.t_saved >= self.save_interval):
+            self.save()
+
+
+def run_tasks(task: Callable[..., T], args_list: List[Tuple], jobs: Optional[int] = None) -> Iterator[T]:
+    """Run `task` for each item of `args_list` and yield the results in order.
+
+    With more than 1 job, tasks are run on a process pool. See `map_captured()`.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    if jobs <= 1 or len(args_list) <= 1:
+        yield from map_captured(None, task, args_list)
+        return
+
+    with ProcessPoolExecutor(min(jobs, len(args_list))) as executor:
+        yield from map_captured(executor, task, args_list)
+
+# the created folders (`None` if not converted), the numbers of audio cache hits and misses, and the stage times
+osz2tja_task_result_t = Tuple[Optional[List[str]], int, int, Optional[stage_times_t]]
+
+def convert_osz2tja_task(source_paths: List[str], output_folder: str, diff_jobs: int = 1,
+        audio_cache_opts: Optional[Tuple[str, int]] = None,
+        with_timings: bool = False) -> List[osz2tja_task_result_t]:
+    """Return the results of each of `source_paths`; the stage times only if `with_timings`."""
+    # .osz files with the same title share the output folders and are converted in order
+    results: List[osz2tja_task_result_t] = []
+    for source_path in source_paths:
+        filename = os.path.basename(source_path)
+        # one cache object per file, so that the statistics are per file in any process
+        audio_cache = TranscodeCache(*audio_cache_opts) if audio_cache_opts is not None else None
+        timings = StageTimings() if with_timings else None
+        outputs: Optional[List[str]] = None
+        try:
+            outputs = convert_osz2tja(source_path, output_folder, diff_jobs, audio_cache, timings)
+            print(f"Converted `{filename}` to TJAs.")
+        except Exception:
+            traceback.print_exc()
+            print(f"Error converting `{source_path}`. Continued.", file=sys.stderr)
+        stages = timings.stages if timings is not None else None
+        if audio_cache is None:
+            results.append((outputs, 0, 0, stages))
+        else:
+            results.append((outputs, audio_cache.hits, audio_cache.misses, stages))
+    return results
+
+def finish_timings(timings_path: str, times_by_file: Dict[str, stage_times_t]) -> None:
+    write_timings(timings_path, times_by_file)
+    print_timings_table(times_by_file)
+    print(f"Stage timings written to `{timings_path}`.")
+
+def remove_stale_outputs(manifest: BatchManifest, input_path: str, stale_outputs: List[str], prune: bool) -> None:
+    """Remove the outputs no longer produced by the reconverted `input_path` if `prune`; otherwise report them."""
+    if prune:
+        for removed in manifest.remove_outputs(stale_outputs):
+            print(f"Removed `{removed}` no longer produced by `{input_path}`.")
+        return
+    for output in stale_outputs:
+        output_path = path.join(manifest.output_folder, output)
+        if path.exists(output_path):
+            print(f"Warning: `{output_path}` is no longer produced by `{input_path}`. Kept. Use --prune to remove it.",
+                file=sys.stderr)
+
+def finish_manifest(manifest: BatchManifest, input_paths: List[str], n_unchanged: int, prune: bool) -> None:
+    if prune:
+        for removed in manifest.prune(input_paths):
+            print(f"Removed `{removed}` of deleted input.")
+    manifest.save()
+    print(f"\nUnchanged files: {n_unchanged} skipped.")
+
+def batch_convert_osz2tja(input_folder: str, output_folder: str, jobs: Optional[int] = None, diff_jobs: int = 1,
+        audio_cache_opts: Optional[Tuple[str, int]] = None, incremental: bool = False, prune: bool = False,
+        timings_path: Optional[str] = None):
+    """`audio_cache_opts`: the directory and the size limit in bytes of the audio cache, or `None` to disable it
+    `incremental`: skip the files unchanged since the last incremental conversion
+    `prune`: with `incremental`, also remove the outputs of the deleted files
+        and the outputs no longer produced by the changed files
+    `timings_path`: where to write the stage times of each converted file as JSON, or `None` not to time them
+    """
+    source_paths = [path.join(input_folder, filename)
+        for filename in os.listdir(input_folder) if filename.endswith(".osz")]
+
+    source_paths_by_title: Dict[str, List[str]] = {}
+    for source_path in source_paths:
+        title_for_path = osz_title_for_path(source_path)
+        # an unreadable file is converted alone to report the error
+        source_paths_by_title.setdefault(
+            title_for_path if title_for_path is not None else f"\0{source_path}", []).append(source_path)
+
+    manifest = BatchManifest(input_folder, output_folder, ".osz2tja-manifest.json") if incremental else None
+    # .osz files with the same title are reconverted together since they share the outputs
+    changed_groups = [group_paths for group_paths in source_paths_by_title.values()
+        if manifest is None or not all(manifest.is_unchanged(source_path) for source_path in group_paths)]
 
-def batch_convert_osz2tja(input_folder: str, output_folder: str):
     skipped_files = []
-    for filename in os.listdir(input_folder):
-        if filename.endswith(".osz"):
-            source_path = path.join(input_folder, filename)
-            try:
-                convert_osz2tja(source_path, output_folder)
-                print(f"Converted `{filename}` to TJAs.")
-            except Exception:
-                traceback.print_exc()
-                print(f"Error converting `{source_path}`. Continued.", file=sys.stderr)
-                skipped_files.append(source_path)
+    cache_hits = cache_misses = 0
+    times_by_file: Dict[str, stage_times_t] = {}
+    args_list = [(group_paths, output_folder, diff_jobs, audio_cache_opts, timings_path is not None)
+        for group_paths in changed_groups]
+    try:
+        for group_paths, results in zip(changed_groups, run_tasks(convert_osz2tja_task, args_list, jobs)):
+            for source_path, (outputs, hits, misses, stages) in zip(group_paths, results):
+                if outputs is None:
+                    skipped_files.append(source_path)
+                cache_hits += hits
+                cache_misses += misses
+                if stages is not None:
+                    times_by_file[source_path] = stages
+                if manifest is not None:
+                    if outputs is None:
+                        manifest.forget(source_path)
+                    else:
+                        remove_stale_outputs(manifest, source_path, manifest.record(source_path, outputs), prune)
+            if manifest is not None:
+                manifest.save_if_due()
+    finally:
+        if manifest is not None:
+            manifest.save() # keep the progress, also on interruption
+
+    if audio_cache_opts is not None:
+        print(f"\nAudio cache: {cache_hits} hit(s), {cache_misses} miss(es).")
+
+    if timings_path is not None:
+        finish_timings(timings_path, times_by_file)
+
+    if manifest is not None:
+        n_unchanged = len(source_paths) - sum(len(group_paths) for group_paths in changed_groups)
+        finish_manifest(manifest, source_paths, n_unchanged, prune)
 
     if skipped_files:
         print("\nSkipped files:")
         for file in skipped_files:
             print(f"- {file}")
 
-def batch_convert_tja2osz(input_folder: str, output_folder: str):
+def convert_tja2osz_task(paths_tja: List[str], output_folder: str, write_folder: bool = True,
+        with_timings: bool = False) -> Tuple[List[str], Dict[str, stage_times_t]]:
+    """Return the skipped files and, if `with_timings`, the stage times of each file."""
+    # .tja files with the same name share the same output folder and are converted in order
     skipped_files = []
+    times_by_file: Dict[str, stage_times_t] = {}
+    osz_files: osz_files_t = {} # .osz contents accumulated from the .tja files with the same name
+    for path_tja in paths_tja:
+        fname, ext = os.path.splitext(os.path.basename(path_tja))
+        timings = StageTimings() if with_timings else None
+        try:
+            tja2osus(path_tja, output_folder, osz_files=osz_files, write_folder=write_folder, timings=timings)
+            dir_out = os.path.join(output_folder, fname)
+            if write_folder:
+                print(f"Converted `{path_tja}` to `{fname}/*.osu`s.")
+            os.makedirs(output_folder, exist_ok=True)
+            with timed(timings, "write_osz"):
+                write_osz(f"{dir_out}.osz", osz_files)
+            print(f"Converted `{path_tja}` to `{fname}.osz`.")
+        except Exception:
+            traceback.print_exc()
+            print(f"Error converting `{path_tja}`. Continued.", file=sys.stderr)
+            skipped_files.append(path_tja)
+        if timings is not None:
+            times_by_file[path_tja] = timings.stages
+    return skipped_files, times_by_file
+
+def batch_convert_tja2osz(input_folder: str, output_folder: str, jobs: Optional[int] = None,
+        incremental: bool = False, prune: bool = False, write_folder: bool = True, timings_path: Optional[str] = None):
+    """See `batch_convert_osz2tja()` for `incremental`, `prune`, and `timings_path`.
+    `write_folder`: also write the contents of the .osz files into "<output_folder>/<song_folder>/"
+    """
+    paths_tja_by_name: Dict[str, List[str]] = {}
     for dirpath, dirnames, names in os.walk(input_folder):
         for filename in names:
             path_tja = os.path.join(dirpath, filename)
             fname, ext = os.path.splitext(filename)
             if ext != ".tja":
                 continue
-            try:
-                tja2osus(path_tja, output_folder)
-                dir_out = os.path.join(output_folder, fname)
-                print(f"Converted `{path_tja}` to `{fname}/*.osu`s.")
-                shutil.make_archive(dir_out, 'zip', dir_out)
-                os.rename(f"{dir_out}.zip", f"{dir_out}.osz")
-                print(f"Converted `{dir_out}/` to `{fname}.osz`.")
-            except Exception:
-                traceback.print_exc()
-                print(f"Error converting `{path_tja}`. Continued.", file=sys.stderr)
-                skipped_files.append(path_tja)
+            paths_tja_by_name.setdefault(fname, []).append(path_tja)
+
+    manifest = BatchManifest(input_folder, output_folder, ".tja2osz-manifest.json") if incremental else None
+    # .tja files with the same name are reconverted together since they share the outputs
+    changed_groups = [paths_tja for paths_tja in paths_tja_by_name.values()
+        if manifest is None or not all(manifest.is_unchanged(path_tja) for path_tja in paths_tja)]
+
+    skipped_files = []
+    times_by_file: Dict[str, stage_times_t] = {}
+    args_list = [(paths_tja, output_folder, write_folder, timings_path is not None) for paths_tja in changed_groups]
+    try:
+        for paths_tja, (skipped, times) in zip(changed_groups, run_tasks(convert_tja2osz_task, args_list, jobs)):
+            skipped_files.extend(skipped)
+            times_by_file.update(times)
+            if manifest is not None:
+                for path_tja in paths_tja:
+                    if path_tja in skipped:
+                        manifest.forget(path_tja)
+                        continue
+                    fname, ext = os.path.splitext(os.path.basename(path_tja))
+                    dir_out = os.path.join(output_folder, fname)
+                    outputs = [dir_out, f"{dir_out}.osz"] if write_folder else [f"{dir_out}.osz"]
+                    remove_stale_outputs(manifest, path_tja, manifest.record(path_tja, outputs), prune)
+                manifest.save_if_due()
+    finally:
+        if manifest is not None:
+            manifest.save() # keep the progress, also on interruption
+
+    if manifest is not None:
+        input_paths = [path_tja for paths_tja in paths_tja_by_name.values() for path_tja in paths_tja]
+        n_unchanged = len(input_paths) - sum(len(paths_tja) for paths_tja in changed_groups)
+        finish_manifest(manifest, input_paths, n_unchanged, prune)
+
+    if timings_path is not None:
+        finish_timings(timings_path, times_by_file)
 
     if skipped_files:
         print("\nSkipped files:")
@@ -257,15 +878,41 @@ def osz2tja2osz_main(mode: Literal['osz2tja', 'tja2osz']) -> None:
         help=f'where your {ext_in} files are located (default: Songs)')
     parser.add_argument('output_folder', nargs='?', default='Output',
         help=f'where the converted {ext_out} files will be saved (default: Output)')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+        help=f'number of {ext_in} files to convert in parallel (default: the number of CPUs)')
+    if mode == 'osz2tja':
+        parser.add_argument('--diff-jobs', type=int, default=1,
+            help='number of difficulties of each .osz file to convert in parallel (default: 1)')
+        parser.add_argument('--audio-cache', metavar='DIR', default=None,
+            help='where to keep the converted .ogg files for reuse in later runs (default: no cache)')
+        parser.add_argument('--audio-cache-size', metavar='MB', type=int, default=1024,
+            help='size limit of the audio cache in MiB; the least recently used files are removed first (default: 1024)')
+    if mode == 'tja2osz':
+        parser.add_argument('--osz-only', action='store_true',
+            help='write only the .osz files, without the song folders')
+    parser.add_argument('-i', '--incremental', action='store_true',
+        help=f'skip the {ext_in} files unchanged since the last incremental run, '
+            'according to the manifest in <output_folder>')
+    parser.add_argument('--prune', action='store_true',
+        help=f'with --incremental, also remove the outputs of the deleted {ext_in} files '
+            'and the outputs no longer produced by the changed ones')
+    parser.add_argument('--timings', metavar='FILE', default=None,
+        help=f'write the wall & CPU times of each conversion stage of each {ext_in} file to FILE as JSON, '
+            'and print the totals at the end')
     args = parser.parse_args()
 
     print(f"Input folder: {args.input_folder}")
     print(f"Output folder: {args.output_folder}")
 
     if mode == "tja2osz":
-        batch_convert_tja2osz(args.input_folder, args.output_folder)
+        batch_convert_tja2osz(args.input_folder, args.output_folder, args.jobs, args.incremental, args.prune,
+            not args.osz_only, args.timings)
     else:
-        batch_convert_osz2tja(args.input_folder, args.output_folder)
+        audio_cache_opts = None
+        if args.audio_cache is not None:
+            audio_cache_opts = (args.audio_cache, args.audio_cache_size * 1024 * 1024)
+        batch_convert_osz2tja(args.input_folder, args.output_folder, args.jobs, args.diff_jobs, audio_cache_opts,
+            args.incremental, args.prune, args.timings)
 
 if __name__ == "__main__":
     osz2tja2osz_main('osz2tja')
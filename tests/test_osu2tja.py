@@ -0,0 +1,55 @@
+import io
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from corpus_gen import make_osu
+from osu2tja.osu2tja import GAMEMODE_MANIA, GAMEMODE_STD, GAMEMODE_TAIKO, HitObjects, merge_hitobject_runs, osu2tja, osu2tja_many
+
+
+class MergeHitObjectRunsTest(unittest.TestCase):
+    def test_one_unsorted_run(self):
+        hitobjects = HitObjects()
+        # (offset, note type to tell the objects apart) of each run
+        runs = [
+            [(0, "1"), (100, "2"), (200, "3")],
+            [(150, "4"), (50, "5"), (50, "6")], # malformed; out of offset order
+            [(50, "7"), (120, "8"), (300, "9")],
+            [(100, "A")],
+        ]
+        run_ends = []
+        for run in runs:
+            for offset, note in run:
+                hitobjects.append(note, offset, 0)
+            run_ends.append(len(hitobjects))
+
+        merge_hitobject_runs(hitobjects, run_ends)
+
+        self.assertEqual([chr(note) for note in hitobjects.types], ["1", "5", "6", "7", "2", "A", "8", "4", "3", "9"])
+        self.assertEqual(list(hitobjects.offsets), [0, 50, 50, 50, 100, 100, 120, 150, 200, 300])
+
+
+class Osu2TjaManyTest(unittest.TestCase):
+    def test_parallel_equals_serial(self):
+        osu_texts = [
+            make_osu(0, n_notes=300),
+            make_osu(1, n_notes=200, mode=GAMEMODE_MANIA, columns=7),
+            make_osu(2, n_notes=250, mode=GAMEMODE_STD),
+            make_osu(3, n_notes=400, mode=GAMEMODE_TAIKO, n_red=4, sv_density=0.5),
+            make_osu(4, n_notes=150, mode=GAMEMODE_MANIA, columns=4, hold_ratio=0.5),
+        ]
+        courses = ["Oni", "Hard", "Normal", "Easy", "Edit"]
+        args_list = [(course, 5 + i, "audio.ogg") for i, course in enumerate(courses)]
+        with mock.patch("sys.stdout"), mock.patch("sys.stderr"):
+            results_serial = [osu2tja(io.StringIO(text), *args) for text, args in zip(osu_texts, args_list)]
+            results_parallel = osu2tja_many(
+                [(io.StringIO(text), *args) for text, args in zip(osu_texts, args_list)], max_workers=4)
+
+        self.assertEqual(results_parallel, results_serial)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,149 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from typing import Dict, List
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from corpus_gen import write_osz
+import osz2tja
+
+
+def read_wave(tja_fpath: str) -> str:
+    with open(tja_fpath, "rb") as f:
+        for line in f.read().decode("utf-8-sig").splitlines():
+            if line.startswith("WAVE:"):
+                return line[len("WAVE:"):]
+    raise AssertionError(f"No WAVE: header in `{tja_fpath}`")
+
+
+class FailingFfmpegTest(unittest.TestCase):
+    def convert_with_failing_ffmpeg(self, dir_tmp: str, written_by_other: bool = False) -> List[str]:
+        def run_failing(args, **kwargs):
+            self.assertIs(kwargs.get("stdin"), subprocess.DEVNULL)
+            audio_path_ogg_tmp = args[args.index("-i") + 2]
+            with open(audio_path_ogg_tmp, "wb") as f:
+                f.write(b"incomplete")
+            if written_by_other:
+                with open(os.path.join(os.path.dirname(audio_path_ogg_tmp), "audio.ogg"), "wb") as f:
+                    f.write(b"other")
+            return subprocess.CompletedProcess(args, 1, "", "simulated ffmpeg failure")
+
+        osz_fpath = os.path.join(dir_tmp, "song.osz")
+        # more than 5 difficulties; split into 2 folders sharing the audio
+        write_osz(osz_fpath, 0, [dict(n_notes=50)] * 6, audio_name="audio.mp3")
+        out_dir = os.path.join(dir_tmp, "out")
+        with mock.patch.object(osz2tja, "find_ffmpeg", return_value="ffmpeg"), \
+                mock.patch.object(osz2tja.subprocess, "run", run_failing), \
+                mock.patch("sys.stdout"), mock.patch("sys.stderr"):
+            return osz2tja.convert_osz2tja(osz_fpath, out_dir)
+
+    def test_charts_refer_to_the_kept_original_audio(self):
+        with tempfile.TemporaryDirectory() as dir_tmp:
+            created_paths = self.convert_with_failing_ffmpeg(dir_tmp)
+
+            self.assertEqual(len(created_paths), 2)
+            for created_path in created_paths:
+                fname_tja = f"{os.path.basename(created_path)}.tja"
+                self.assertEqual(read_wave(os.path.join(created_path, fname_tja)), "audio.mp3")
+                self.assertEqual(sorted(os.listdir(created_path)), sorted(["audio.mp3", fname_tja]))
+
+    def test_keeps_the_audio_written_by_others(self):
+        with tempfile.TemporaryDirectory() as dir_tmp:
+            created_paths = self.convert_with_failing_ffmpeg(dir_tmp, written_by_other=True)
+
+            with open(os.path.join(created_paths[0], "audio.ogg"), "rb") as f:
+                self.assertEqual(f.read(), b"other")
+
+
+class TranscodeCacheTest(unittest.TestCase):
+    def test_fetched_file_is_a_copy(self):
+        with tempfile.TemporaryDirectory() as dir_tmp:
+            cache = osz2tja.TranscodeCache(os.path.join(dir_tmp, "cache"), 1 << 20)
+            src_path = os.path.join(dir_tmp, "src.ogg")
+            with open(src_path, "wb") as f:
+                f.write(b"cached")
+            cache.store("key", src_path)
+            dst_path = os.path.join(dir_tmp, "dst.ogg")
+            self.assertTrue(cache.fetch("key", dst_path))
+            with open(dst_path, "wb") as f:
+                f.write(b"edited")
+
+            with open(cache.path_of("key"), "rb") as f:
+                self.assertEqual(f.read(), b"cached")
+
+    def test_no_misses_without_ffmpeg(self):
+        with tempfile.TemporaryDirectory() as dir_tmp:
+            osz_fpath = os.path.join(dir_tmp, "song.osz")
+            write_osz(osz_fpath, 0, [dict(n_notes=50)], audio_name="audio.mp3")
+            cache = osz2tja.TranscodeCache(os.path.join(dir_tmp, "cache"), 1 << 20)
+            with mock.patch.object(osz2tja, "find_ffmpeg", return_value=None), \
+                    mock.patch("sys.stdout"), mock.patch("sys.stderr"):
+                osz2tja.convert_osz2tja(osz_fpath, os.path.join(dir_tmp, "out"), audio_cache=cache)
+
+            self.assertEqual((cache.hits, cache.misses), (0, 0))
+
+
+def read_tree(root: str) -> Dict[str, bytes]:
+    contents = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            fpath = os.path.join(dirpath, filename)
+            with open(fpath, "rb") as f:
+                contents[os.path.relpath(fpath, root)] = f.read()
+    return contents
+
+
+class SameTitleBatchTest(unittest.TestCase):
+    def test_parallel_equals_serial(self):
+        with tempfile.TemporaryDirectory() as dir_tmp:
+            in_dir = os.path.join(dir_tmp, "in")
+            os.makedirs(in_dir)
+            # the same title from the same seed; both converted into the same folder
+            for name in ["a", "b"]:
+                write_osz(os.path.join(in_dir, f"{name}.osz"), 0, [dict(n_notes=50)], audio_name=f"{name}.mp3")
+            # make the file converted first finish last if run concurrently
+            name_first = os.path.splitext(os.listdir(in_dir)[0])[0]
+            write_osz(os.path.join(in_dir, f"{name_first}.osz"), 0, [dict(n_notes=5000)] * 3,
+                audio_name=f"{name_first}.mp3")
+            trees = []
+            for jobs in [1, 2]:
+                out_dir = os.path.join(dir_tmp, f"out-{jobs}")
+                with mock.patch("sys.stdout"), mock.patch("sys.stderr"):
+                    osz2tja.batch_convert_osz2tja(in_dir, out_dir, jobs=jobs)
+                trees.append(read_tree(out_dir))
+
+            self.assertEqual(trees[0], trees[1])
+            self.assertIn(os.path.join("Synthetic 0", "a.mp3"), trees[1])
+            self.assertIn(os.path.join("Synthetic 0", "b.mp3"), trees[1])
+
+
+
+class IncrementalStaleOutputsTest(unittest.TestCase):
+    def convert_shrunk(self, dir_tmp: str, prune: bool) -> List[str]:
+        in_dir = os.path.join(dir_tmp, "in")
+        os.makedirs(in_dir)
+        out_dir = os.path.join(dir_tmp, "out")
+        osz_fpath = os.path.join(in_dir, "song.osz")
+        with mock.patch("sys.stdout"), mock.patch("sys.stderr"):
+            # more than 5 difficulties; split into 2 folders
+            write_osz(osz_fpath, 0, [dict(n_notes=50)] * 6)
+            osz2tja.batch_convert_osz2tja(in_dir, out_dir, jobs=1, incremental=True, prune=prune)
+            write_osz(osz_fpath, 0, [dict(n_notes=50)] * 2)
+            osz2tja.batch_convert_osz2tja(in_dir, out_dir, jobs=1, incremental=True, prune=prune)
+        return sorted(name for name in os.listdir(out_dir) if not name.startswith("."))
+
+    def test_removes_stale_outputs_with_prune(self):
+        with tempfile.TemporaryDirectory() as dir_tmp:
+            self.assertEqual(self.convert_shrunk(dir_tmp, prune=True), ["Synthetic 0"])
+
+    def test_keeps_stale_outputs_without_prune(self):
+        with tempfile.TemporaryDirectory() as dir_tmp:
+            self.assertEqual(self.convert_shrunk(dir_tmp, prune=False),
+                ["Synthetic 0", "Synthetic 0 - 1", "Synthetic 0 - 2"])
+
+if __name__ == "__main__":
+    unittest.main()
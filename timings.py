@@ -0,0 +1,126 @@
+import json
+import sys
+import time
+from contextlib import nullcontext
+from typing import ContextManager, Dict, List, Optional, TextIO, Union
+
+# stage name -> [wall time, CPU time, number of timed intervals]; times in seconds
+stage_times_t = Dict[str, List[float]]
+
+def add_stage_time(stages: stage_times_t, name: str, wall: float, cpu: float, count: int = 1) -> None:
+    acc = stages.setdefault(name, [0.0, 0.0, 0])
+    acc[0] += wall
+    acc[1] += cpu
+    acc[2] += count
+
+
+class StageTimer:
+    """Adds the wall & CPU times of its `with` block to a stage."""
+    __slots__ = ("stages", "name", "wall_begin", "cpu_begin")
+
+    def __init__(self, stages: stage_times_t, name: str) -> None:
+        self.stages = stages
+        self.name = name
+
+    def __enter__(self) -> "StageTimer":
+        self.wall_begin = time.perf_counter()
+        self.cpu_begin = time.thread_time()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        add_stage_time(self.stages, self.name,
+            time.perf_counter() - self.wall_begin, time.thread_time() - self.cpu_begin)
+
+
+class LapTimer:
+    """Times consecutive stages of straight-line code; each `lap()` ends the current stage and starts the next one."""
+    __slots__ = ("stages", "wall_begin", "cpu_begin")
+
+    def __init__(self, stages: stage_times_t) -> None:
+        self.stages = stages
+        self.wall_begin = time.perf_counter()
+        self.cpu_begin = time.thread_time()
+
+    def lap(self, name: str) -> None:
+        wall_end = time.perf_counter()
+        cpu_end = time.thread_time()
+        add_stage_time(self.stages, name, wall_end - self.wall_begin, cpu_end - self.cpu_begin)
+        self.wall_begin = wall_end
+        self.cpu_begin = cpu_end
+
+
+class NoLapTimer:
+    __slots__ = ()
+
+    def lap(self, name: str) -> None:
+        pass
+
+
+class StageTimings:
+    """Accumulates the wall & CPU times of the stages of converting a file.
+
+    CPU times are of the timing thread only; the time spent in subprocesses such as ffmpeg counts only as wall time.
+    """
+    def __init__(self) -> None:
+        self.stages: stage_times_t = {}
+
+    def stage(self, name: str) -> StageTimer:
+        return StageTimer(self.stages, name)
+
+    def laps(self) -> LapTimer:
+        return LapTimer(self.stages)
+
+    def merge(self, stages: stage_times_t) -> None:
+        """Add the times of `stages`, e.g., timed in another process."""
+        for name, (wall, cpu, count) in stages.items():
+            add_stage_time(self.stages, name, wall, cpu, int(count))
+
+
+no_timer = nullcontext()
+no_lap_timer = NoLapTimer()
+
+def timed(timings: Optional[StageTimings], name: str) -> ContextManager:
+    """Time the `with` block as the stage `name` into `timings`; do nothing if `timings` is `None`."""
+    if timings is None:
+        return no_timer
+    return timings.stage(name)
+
+def lap_timer(timings: Optional[StageTimings]) -> Union[LapTimer, NoLapTimer]:
+    """Start timing consecutive stages into `timings`; do nothing if `timings` is `None`."""
+    if timings is None:
+        return no_lap_timer
+    return timings.laps()
+
+# ----------------------
+# reporting
+# ----------------------
+
+def total_stage_times(times_by_file: Dict[str, stage_times_t]) -> stage_times_t:
+    total = StageTimings()
+    for stages in times_by_file.values():
+        total.merge(stages)
+    return total.stages
+
+def stages_to_json(stages: stage_times_t) -> Dict[str, Dict[str, float]]:
+    return {name: {"wall": wall, "cpu": cpu, "count": count} for name, (wall, cpu, count) in stages.items()}
+
+def write_timings(fpath: str, times_by_file: Dict[str, stage_times_t]) -> None:
+    """Write the stage times of each file and their totals as JSON."""
+    with open(fpath, "w", encoding="utf-8") as f:
+        json.dump({
+            "files": {fname: stages_to_json(stages) for fname, stages in times_by_file.items()},
+            "total": stages_to_json(total_stage_times(times_by_file)),
+        }, f, ensure_ascii=False, indent=1)
+
+def print_timings_table(times_by_file: Dict[str, stage_times_t], file: Optional[TextIO] = None) -> None:
+    """Print the total stage times of all files, in the order the stages first occur, to `file` (default: `sys.stdout`)."""
+    if file is None:
+        file = sys.stdout # resolved here to follow redirections
+    total = total_stage_times(times_by_file)
+    wall_sum = sum(wall for wall, _, _ in total.values())
+    print(f"\nStage timings of {len(times_by_file)} file(s):", file=file)
+    print(f"{'stage':<16} {'count':>7} {'wall (s)':>10} {'CPU (s)':>10} {'wall %':>7}", file=file)
+    for name, (wall, cpu, count) in total.items():
+        share = wall / wall_sum * 100 if wall_sum > 0 else 0.0
+        print(f"{name:<16} {count:>7} {wall:10.4f} {cpu:10.4f} {share:6.1f}%", file=file)
+    print(f"{'total':<16} {'':>7} {wall_sum:10.4f} {sum(cpu for _, cpu, _ in total.values()):10.4f}", file=file)
@@ -6,86 +6,17 @@ import sys
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 
 from common.utils import print_with_pended
+from timings import StageTimings, lap_timer, print_timings_table, write_timings
 
+from array import array
 import argparse
 from bisect import bisect_right
+from functools import lru_cache
 import codecs
+import io
 import math
 import sys
-from typing import Dict, Optional, OrderedDict, TextIO, Tuple, TypeVar, cast
-
-chart_resources: Dict[str, str] # {'filename': 'type', ...}
-
-def init_globals() -> None:
-    global ENCODING, TITLE, SUBTITLE, BPM, WAVE, OFFSET, DEMOSTART
-    global MAKER, AUTHOR, CREATOR, SONGVOL, SEVOL, COURSE
-    global PREIMAGE, BGIMAGE, BGMOVIE, MOVIEOFFSET
-    # jiro data
-    ENCODING = None
-    TITLE = "NO TITLE"
-    SUBTITLE = "NO SUBTITLE"
-    BPM = 0.0
-    WAVE = None
-    OFFSET = 0.0
-    DEMOSTART = 0.0
-    MAKER = None
-    AUTHOR = None
-    CREATOR = None
-    SONGVOL = 100.0
-    SEVOL = 100.0
-    COURSE = "Oni"
-    PREIMAGE = None
-    BGIMAGE = None
-    BGMOVIE = None
-    MOVIEOFFSET = 0.0
-
-    global AudioFilename, Title, Source, Tags, Artist, Artist, Creator, Version
-    global AudioLeadIn, CountDown, SampleSet, StackLeniency, Mode, LetterboxInBreaks, PreviewTime
-    global TimingPoints, TimingPointsRed, HitObjects
-    global HPDrainRate, CircleSize, OverallDifficulty, ApproachRate, SliderMultiplier, SliderTickRate, CircleX, CircleY
-    # osu data
-    AudioFilename = ""
-    Title = ""
-    Source = ""
-    Tags = "taiko jiro tja"
-    Artist = "unknown"
-    Creator = "unknown"
-    Version = "Oni"
-    AudioLeadIn = 0
-    CountDown = 0
-    SampleSet = "Normal"
-    StackLeniency = 0.7
-    Mode = 1
-    LetterboxInBreaks = 0
-    PreviewTime = -1
-    TimingPoints = []
-    TimingPointsRed = []
-    HitObjects = []
-    HPDrainRate = 7
-    CircleSize = 5
-    OverallDifficulty = 8.333
-    ApproachRate = 5
-    SliderMultiplier = 1.44
-    SliderTickRate = 4
-    CircleX = 256
-    CircleY = 192
-
-    global chart_resources
-    chart_resources = {}
-
-    global has_started, curr_time, bar_data, lasting_note
-    has_started = False
-    curr_time = 0.0
-    bar_data = []
-    lasting_note = None
-
-def init_debug_globals() -> None:
-    global debug_mode, last_debug, print_each_note
-    debug_mode = False
-    last_debug = None
-    print_each_note = False #(int(curr_time) == 112814)
-
-init_debug_globals()
+from typing import Dict, Iterator, List, Optional, OrderedDict, TextIO, Tuple, TypeVar, cast
 
 # const_data
 BRANCH = "BRANCH"
@@ -121,6 +52,22 @@ def convert_str(bytes_: bytes, enc_guessed: Optional[str] = None) -> str:
     _, decoded = try_decode(bytes_, enc_guessed)
     return decoded
 
+@lru_cache(maxsize=64)
+def detect_encoding(sample: bytes, enc_guessed: Optional[str] = None) -> Optional[str]:
+    """Guess the encoding of all the text in `sample` together.
+    Cached, as the notecharts split from the same .tja file share most of their headers."""
+    enc, _ = try_decode(sample, enc_guessed)
+    return enc
+
+def decode_str(bytes_: bytes, encoding: Optional[str]) -> str:
+    """Decode `bytes_` with the detected `encoding`, or guess again if failed."""
+    if encoding is not None:
+        try:
+            return bytes_.decode(encoding)
+        except UnicodeError:
+            pass
+    return convert_str(bytes_, encoding)
+
 def check_unsupported(filename):
     return
     assert isinstance(filename, str)
@@ -149,59 +96,82 @@ def parse_tja_header(line: Str) -> Tuple[Optional[Str], Str]:
         return vname, vval
     return None, type(line)()
 
-def get_meta_data(filename):
-    global ENCODING, TITLE, SUBTITLE, WAVE, OFFSET, DEMOSTART, MAKER, AUTHOR, CREATOR, SONGVOL, SEVOL, COURSE, BPM
-    global PREIMAGE, BGIMAGE, BGMOVIE, MOVIEOFFSET
-    assert isinstance(filename, str)
-    rtassert(filename.endswith(".tja"), "filename should ends with .tja")
-    try: fobj = open(filename, "rb")
-    except IOError: rtassert(False, "can't open tja file.")
+def parse_tja_cmd(line: str) -> Optional[Tuple]:
+    """Parse a comment-less command line in a notechart. Return `None` for unsupported commands."""
+    if ("#"+BPMCHANGE) in line:
+        bpm = float(line.partition('#'+BPMCHANGE)[2][1:].strip())
+        return (BPMCHANGE, bpm)
+    elif ("#"+MEASURE) in line:
+        arg_str = line.partition('#'+MEASURE)[2][1:].strip()
+        arg1, arg2 = arg_str.split('/')
+        return (MEASURE, 4.0*float(arg1.strip()) / float(arg2.strip()))
+    elif ("#"+SCROLL) in line:
+        arg_str = line.partition('#'+SCROLL)[2][1:].strip()
+        return (SCROLL, float(arg_str))
+    elif ("#"+GOGOSTART) in line:
+        return (GOGOSTART,)
+    elif ("#"+GOGOEND) in line:
+        return (GOGOEND,)
+    elif ("#"+BARLINEOFF) in line:
+        return (BARLINEOFF,)
+    elif ("#"+BARLINEON) in line:
+        return (BARLINEON,)
+    elif ("#"+DELAY) in line:
+        arg_str = line.partition('#'+DELAY)[2][1:].strip()
+        return (DELAY, float(arg_str))
+    return None
+
+# tja events
+TJA_HEADER = "HEADER" # (TJA_HEADER, name, value); `bytes`s in the original encoding
+TJA_CREATOR = "CREATOR" # (TJA_CREATOR, creator); `bytes` in the original encoding, from `//created by` comments
+TJA_CMD = "CMD" # (TJA_CMD, cmd); `cmd` from `parse_tja_cmd()`
+TJA_NOTES = "NOTES" # (TJA_NOTES, notes); comment-less `str` of note symbols & bar ends
+
+TJA_META_HEADERS = {b"TITLE", b"SUBTITLE", b"BPM", b"WAVE", b"OFFSET", b"DEMOSTART", b"MAKER", b"AUTHOR",
+    b"SONGVOL", b"SEVOL", b"COURSE", b"PREIMAGE", b"BGIMAGE", b"BGMOVIE", b"MOVIEOFFSET"}
+
+def tokenize_tja(fobj: io.BufferedReader) -> Tuple[Optional[str], List[Tuple]]:
+    """Read a single-notechart branch-less .tja file in one pass.
+
+    Return the encoding if known from the BOM, and the events in the file order.
+    Headers are from the whole file, and commands & notes are from the first `#START` to the next `#END`.
+    """
+    encoding = None
     if fobj.peek(len(codecs.BOM_UTF8)).startswith(codecs.BOM_UTF8):
-        ENCODING = "utf-8-sig"
-        fobj.seek(len(codecs.BOM_UTF8)) # ignore UTF-8 BOM
-    for line in fobj:
-        vname, vval = parse_tja_header(line)
-        if vname == b"TITLE": TITLE = convert_str(vval, ENCODING)
-        elif vname == b"SUBTITLE": SUBTITLE = convert_str(vval, ENCODING)
-        elif vname == b"BPM": BPM = float(vval)
-        elif vname == b"WAVE": WAVE = convert_str(vval, ENCODING)
-        elif vname == b"OFFSET": OFFSET = float(vval)
-        elif vname == b"DEMOSTART": DEMOSTART = float(vval)
-        elif vname == b"MAKER": MAKER = convert_str(vval, ENCODING)
-        elif vname == b"AUTHOR": AUTHOR = convert_str(vval, ENCODING)
-        elif vname == b"SONGVOL": SONGVOL = float(vval)
-        elif vname == b"SEVOL": SEVOL = float(vval)
-        elif vname == b"COURSE": COURSE = convert_str(vval, ENCODING)
-        elif vname == b"PREIMAGE": PREIMAGE = convert_str(vval, ENCODING)
-        elif vname == b"BGIMAGE": BGIMAGE = convert_str(vval, ENCODING)
-        elif vname == b"BGMOVIE": BGMOVIE = convert_str(vval, ENCODING)
-        elif vname == b"MOVIEOFFSET": MOVIEOFFSET = float(vval)
-        else: # try metadata in comments
-            creator = line.partition(b"//created by ")[2].strip()
-            if creator: CREATOR = convert_str(creator, ENCODING)
+        encoding = "utf-8-sig"
+        fobj.read(len(codecs.BOM_UTF8)) # ignore UTF-8 BOM
+
+    events: List[Tuple] = []
+    chart_state = "before" # "before" `#START`, "in" the notechart, or "after" `#END`
+    for line_bytes in fobj:
+        vname, vval = parse_tja_header(line_bytes)
+        if vname is not None:
+            events.append((TJA_HEADER, vname, vval))
+        if vname not in TJA_META_HEADERS: # try metadata in comments
+            creator = line_bytes.partition(b"//created by ")[2].strip()
+            if creator: events.append((TJA_CREATOR, creator))
+
+        if chart_state == "after":
+            continue
+        line = rm_jiro_comment(line_bytes.decode("latin-1").strip())
+        if chart_state == "before":
+            if ("#"+START) in line:
+                chart_state = "in"
+            continue
+        if ("#"+END) in line:
+            chart_state = "after"
+        elif "#" in line:
+            cmd = parse_tja_cmd(line)
+            if cmd is not None: events.append((TJA_CMD, cmd))
+        else:
+            events.append((TJA_NOTES, line))
+    return encoding, events
 
 MS_OSU_MUSIC_OFFSET = 15
 """Ranked osu! beatmaps have late music / early chart sync. osu!'s new audio engine applies a global 15ms chart delay.
 <https://github.com/ppy/osu/issues/24625>
 """
 
-def add_default_timing_point():
-    global curr_time
-
-    tm = {}
-    tm["offset"] = -(OFFSET * 1000.0 + MS_OSU_MUSIC_OFFSET)
-    tm["redline"] = True
-    tm["scroll"] = 1.0
-    tm["measure"] = 4.0
-    tm["GGT"] = False
-    tm["hidefirst"] = False
-    tm["bpm"] = BPM
-
-    TimingPoints.append(tm)
-    TimingPointsRed.append(tm)
-
-    curr_time = tm["offset"]
-
 CIRCLE = 1
 SLIDER = 2
 SPINNER = 12 
@@ -213,19 +183,6 @@ CLAP = 8
 FINISH = 4
 WHISTLE = 2 
 
-def get_osu_type(snd):
-    snd = int(snd)
-    assert snd != 0
-    if snd in (1, 2, 3, 4): return CIRCLE
-    if snd in (5, 6): return SLIDER
-    if snd in (7, 9): return SPINNER
-    if snd == 8:
-        if lasting_note == SLIDER:
-            return SLIDER_END
-        elif lasting_note == SPINNER:
-            return SPINNER_END
-    assert False, repr(snd) + repr(lasting_note)
-
 def get_osu_sound(snd):
     snd = int(snd)
     assert snd != 0
@@ -241,427 +198,582 @@ def get_osu_sound(snd):
     else: assert False
 
 
-def get_all(filename):
-    global has_started, curr_time
-    try: fobj = open(filename, "rb")
-    except IOError: rtassert(False, "can't open tja file.")
-    if fobj.peek(len(codecs.BOM_UTF8)).startswith(codecs.BOM_UTF8):
-        fobj.seek(len(codecs.BOM_UTF8)) # ignore UTF-8 BOM
-
-    has_started = False
-    add_default_timing_point()
-    for line in fobj:
-        line = line.decode("latin-1").strip()
-        line = rm_jiro_comment(line)
-        if not has_started and ("#"+START) in line:
-            has_started = True
-            continue
-        if not has_started: continue
-        if ("#"+END) in line:
-            break
-        if ("#" in line): handle_cmd(line)
-        else: handle_note(line)
-    # prevent bar lines at and after #END (probably missing and implicit)
-    tm = get_last_red_tm()
-    real_do_cmd((MEASURE, max(tm["measure"], math.ceil(tm["bpm"])))) # insert a >= 1 minute measure
-    real_do_cmd((BARLINEOFF,)) # hide its bar line
-
-def get_real_offset(int_offset):
-    if debug_mode:
-        print_with_pended("INTOffset", int_offset, file=sys.stderr)
-    tm = get_red_tm_at(int_offset)
-    tpb = 60000 / tm["bpm"]
-    int_delta = abs(int_offset - tm["offset"])
-    sign = (int_offset - tm["offset"] > 0 and 1 or -1)
-
-    t_unit_cnt = round(int_delta * tm["bpm"] * 24 / 60000)
-
-    beat_cnt = t_unit_cnt / 24
-    ret = tm["offset"] + beat_cnt * 60000 * sign / tm["bpm"]
-    
-    if debug_mode:
-        print_with_pended(tm, file=sys.stderr)
-        print(t_unit_cnt, file=sys.stderr)
-        print("DELTA = ", int_delta, file=sys.stderr)
-        print("GET BEAT CNT", int_delta/tpb, t_unit_cnt/24, file=sys.stderr)
-        print(int_offset, "-->", tm["offset"] + beat_cnt * 60000 / tm["bpm"], file=sys.stderr)
-        print(int(tm["offset"] + beat_cnt * 60000 / tm["bpm"]), file=sys.stderr)
-
-        print("CMP", int(tm["offset"]+beat_cnt * 60000 * sign / tm["bpm"]), int(2663+60000/tm["bpm"]*beat_cnt), file=sys.stderr)
-        
-    return ret     
-   
-def handle_cmd(line: str) -> None:
-    cmd = None
-    if ("#"+BPMCHANGE) in line:
-        bpm = float(line.partition('#'+BPMCHANGE)[2][1:].strip())
-        cmd = (BPMCHANGE, bpm)
-    elif ("#"+MEASURE) in line:
-        arg_str = line.partition('#'+MEASURE)[2][1:].strip()
-        arg1, arg2 = arg_str.split('/')
-        cmd = (MEASURE, 4.0*float(arg1.strip()) / float(arg2.strip()))
-    elif ("#"+SCROLL) in line:
-        arg_str = line.partition('#'+SCROLL)[2][1:].strip()
-        cmd = (SCROLL, float(arg_str))        
-    elif ("#"+GOGOSTART) in line:
-        cmd = (GOGOSTART,)
-    elif ("#"+GOGOEND) in line:
-        cmd = (GOGOEND,)
-    elif ("#"+BARLINEOFF) in line:
-        cmd = (BARLINEOFF,)
-    elif ("#"+BARLINEON) in line:
-        cmd = (BARLINEON,)
-    elif ("#"+DELAY) in line:
-        arg_str = line.partition('#'+DELAY)[2][1:].strip()
-        cmd = (DELAY, float(arg_str))
-    else:
-        return
-
-    if bar_data == []:
-        real_do_cmd(cmd)
-    else:
-        bar_data.append(cmd)
+class TimingPoint:
+    """A timing point; `bpm` is of the last uninherited (red) timing point for inherited ones."""
+    __slots__ = ("offset", "redline", "scroll", "measure", "GGT", "hidefirst", "bpm")
+
+    def __init__(self, offset: float = 0.0, redline: bool = False, scroll: float = 1.0, measure: float = 4.0,
+            GGT: bool = False, hidefirst: bool = False, bpm: float = 0.0) -> None:
+        self.offset = offset
+        self.redline = redline
+        self.scroll = scroll
+        self.measure = measure
+        self.GGT = GGT
+        self.hidefirst = hidefirst
+        self.bpm = bpm
+
+    def __repr__(self) -> str:
+        return "TimingPoint(%s)" % ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+
+
+class HitObjects:
+    """Hit objects `(osu! type, osu! sound, offset)` stored in parallel arrays."""
+    __slots__ = ("types", "sounds", "offsets")
+
+    def __init__(self) -> None:
+        self.types = array('b')
+        self.sounds = array('B')
+        self.offsets = array('d')
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def __getitem__(self, idx: int) -> Tuple[int, int, float]:
+        return (self.types[idx], self.sounds[idx], self.offsets[idx])
+
+    def __iter__(self) -> Iterator[Tuple[int, int, float]]:
+        return zip(self.types, self.sounds, self.offsets)
+
+    def append(self, type_: int, sound: int, offset: float) -> None:
+        self.types.append(type_)
+        self.sounds.append(sound)
+        self.offsets.append(offset)
+
+
+class Tja2OsuConverter:
+    """Holds the state of a single .tja to .osu conversion.
+
+    Each instance is independent, so separate instances can convert in parallel.
+    """
+    def __init__(self, debug_mode: bool = False, print_each_note: bool = False,
+            timings: Optional[StageTimings] = None) -> None:
+        self.debug_mode = debug_mode
+        self.print_each_note = print_each_note
+        self.timings = timings
+        self.reset()
+
+    def reset(self) -> None:
+        # jiro data
+        self.ENCODING = None
+        self.TITLE = "NO TITLE"
+        self.SUBTITLE = "NO SUBTITLE"
+        self.BPM = 0.0
+        self.WAVE = None
+        self.OFFSET = 0.0
+        self.DEMOSTART = 0.0
+        self.MAKER = None
+        self.AUTHOR = None
+        self.CREATOR = None
+        self.SONGVOL = 100.0
+        self.SEVOL = 100.0
+        self.COURSE = "Oni"
+        self.PREIMAGE = None
+        self.BGIMAGE = None
+        self.BGMOVIE = None
+        self.MOVIEOFFSET = 0.0
+        # osu data
+        self.AudioFilename = ""
+        self.Title = ""
+        self.Source = ""
+        self.Tags = "taiko jiro tja"
+        self.Artist = "unknown"
+        self.Creator = "unknown"
+        self.Version = "Oni"
+        self.AudioLeadIn = 0
+        self.CountDown = 0
+        self.SampleSet = "Normal"
+        self.StackLeniency = 0.7
+        self.Mode = 1
+        self.LetterboxInBreaks = 0
+        self.PreviewTime = -1
+        self.TimingPoints: List[TimingPoint] = []
+        self.TimingPointsRed: List[TimingPoint] = []
+        self.HitObjects = HitObjects()
+        self.HPDrainRate = 7
+        self.CircleSize = 5
+        self.OverallDifficulty = 8.333
+        self.ApproachRate = 5
+        self.SliderMultiplier = 1.44
+        self.SliderTickRate = 4
+        self.CircleX = 256
+        self.CircleY = 192
+        self.chart_resources: Dict[str, str] = {}
+        self.curr_time = 0.0
+        self.bar_data = []
+        self.lasting_note = None
+        self.last_debug = None
+
+    def get_meta_data(self, encoding: Optional[str], events: List[Tuple]):
+        # detect the encoding once from all the non-ASCII text
+        texts = [event[-1] for event in events if event[0] in (TJA_HEADER, TJA_CREATOR)]
+        self.ENCODING = detect_encoding(b"\n".join(text for text in texts if not text.isascii()), encoding)
+        for event in events:
+            if event[0] == TJA_CREATOR:
+                self.CREATOR = decode_str(event[1], self.ENCODING)
+                continue
+            if event[0] != TJA_HEADER:
+                continue
+            _, vname, vval = event
+            if vname == b"TITLE": self.TITLE = decode_str(vval, self.ENCODING)
+            elif vname == b"SUBTITLE": self.SUBTITLE = decode_str(vval, self.ENCODING)
+            elif vname == b"BPM": self.BPM = float(vval)
+            elif vname == b"WAVE": self.WAVE = decode_str(vval, self.ENCODING)
+            elif vname == b"OFFSET": self.OFFSET = float(vval)
+            elif vname == b"DEMOSTART": self.DEMOSTART = float(vval)
+            elif vname == b"MAKER": self.MAKER = decode_str(vval, self.ENCODING)
+            elif vname == b"AUTHOR": self.AUTHOR = decode_str(vval, self.ENCODING)
+            elif vname == b"SONGVOL": self.SONGVOL = float(vval)
+            elif vname == b"SEVOL": self.SEVOL = float(vval)
+            elif vname == b"COURSE": self.COURSE = decode_str(vval, self.ENCODING)
+            elif vname == b"PREIMAGE": self.PREIMAGE = decode_str(vval, self.ENCODING)
+            elif vname == b"BGIMAGE": self.BGIMAGE = decode_str(vval, self.ENCODING)
+            elif vname == b"BGMOVIE": self.BGMOVIE = decode_str(vval, self.ENCODING)
+            elif vname == b"MOVIEOFFSET": self.MOVIEOFFSET = float(vval)
+
+    def add_default_timing_point(self):
+        tm = TimingPoint()
+        tm.offset = -(self.OFFSET * 1000.0 + MS_OSU_MUSIC_OFFSET)
+        tm.redline = True
+        tm.scroll = 1.0
+        tm.measure = 4.0
+        tm.GGT = False
+        tm.hidefirst = False
+        tm.bpm = self.BPM
+
+        self.TimingPoints.append(tm)
+        self.TimingPointsRed.append(tm)
+
+        self.curr_time = tm.offset
+
+    def get_osu_type(self, snd):
+        snd = int(snd)
+        assert snd != 0
+        if snd in (1, 2, 3, 4): return CIRCLE
+        if snd in (5, 6): return SLIDER
+        if snd in (7, 9): return SPINNER
+        if snd == 8:
+            if self.lasting_note == SLIDER:
+                return SLIDER_END
+            elif self.lasting_note == SPINNER:
+                return SPINNER_END
+        assert False, repr(snd) + repr(self.lasting_note)
+
+    def get_all(self, events: List[Tuple]):
+        self.add_default_timing_point()
+        for event in events:
+            if event[0] == TJA_CMD: self.handle_cmd(event[1])
+            elif event[0] == TJA_NOTES: self.handle_note(event[1])
+        # prevent bar lines at and after #END (probably missing and implicit)
+        tm = self.get_last_red_tm()
+        self.real_do_cmd((MEASURE, max(tm.measure, math.ceil(tm.bpm)))) # insert a >= 1 minute measure
+        self.real_do_cmd((BARLINEOFF,)) # hide its bar line
+
+    def get_real_offset(self, int_offset):
+        if self.debug_mode:
+            print_with_pended("INTOffset", int_offset, file=sys.stderr)
+        tm = self.get_red_tm_at(int_offset)
+        tpb = 60000 / tm.bpm
+        int_delta = abs(int_offset - tm.offset)
+        sign = (int_offset - tm.offset > 0 and 1 or -1)
+
+        t_unit_cnt = round(int_delta * tm.bpm * 24 / 60000)
+
+        beat_cnt = t_unit_cnt / 24
+        ret = tm.offset + beat_cnt * 60000 * sign / tm.bpm
+
+        if self.debug_mode:
+            print_with_pended(tm, file=sys.stderr)
+            print(t_unit_cnt, file=sys.stderr)
+            print("DELTA = ", int_delta, file=sys.stderr)
+            print("GET BEAT CNT", int_delta/tpb, t_unit_cnt/24, file=sys.stderr)
+            print(int_offset, "-->", tm.offset + beat_cnt * 60000 / tm.bpm, file=sys.stderr)
+            print(int(tm.offset + beat_cnt * 60000 / tm.bpm), file=sys.stderr)
+
+            print("CMP", int(tm.offset+beat_cnt * 60000 * sign / tm.bpm), int(2663+60000/tm.bpm*beat_cnt), file=sys.stderr)
+
+        return ret     
+
+    def handle_cmd(self, cmd: Tuple) -> None:
+        if self.bar_data == []:
+            self.real_do_cmd(cmd)
+        else:
+            self.bar_data.append(cmd)
+
+    def real_do_cmd(self, cmd):
+        if self.debug_mode:
+            print_with_pended("handle cmd", cmd, file=sys.stderr)
+
+        # handle delay, no timing point change
+        if cmd[0] == DELAY:
+            self.curr_time += cmd[1] * 1000
+            return
+
+        # handel timing point change command    
+        if cmd[0] == BPMCHANGE:
+            self.get_or_create_curr_red_tm().bpm = cmd[1]
+        elif cmd[0] == MEASURE:
+            assert len(self.bar_data) == 0, "can't change measure within a bar"
+            self.get_or_create_curr_red_tm().measure = cmd[1]
+        elif cmd[0] == SCROLL:
+            self.get_or_create_curr_tm().scroll = cmd[1]
+        elif cmd[0] == GOGOSTART:
+            self.get_or_create_curr_tm().GGT = True
+        elif cmd[0] == GOGOEND:
+            self.get_or_create_curr_tm().GGT = False
+        elif cmd[0] == BARLINEOFF:
+            self.get_or_create_curr_tm().hidefirst = True
+        elif cmd[0] == BARLINEON:
+            self.get_or_create_curr_tm().hidefirst = False
+        else:
+            assert False, "unknown or unsupported command"
+
+    def add_a_note(self, snd, offset):
+        snd = int(snd)
+        self.HitObjects.append(self.get_osu_type(snd), get_osu_sound(snd), offset)
+        if self.get_osu_type(snd) in (SLIDER, SPINNER):
+            self.lasting_note = self.get_osu_type(snd)
+        if self.get_osu_type(snd) in (SLIDER_END, SPINNER_END):
+            self.lasting_note = None
+        if self.debug_mode:
+            print_with_pended(self.HitObjects[-1], file=sys.stderr)
+
+    def get_last_tm(self):
+        return self.TimingPoints[-1]
+
+    def get_last_red_tm(self):
+        return self.TimingPointsRed[-1]
+
+    def get_tm_at(self, t):
+        assert len(self.TimingPoints) > 0, "Need at least one timing point"
+        return self.TimingPoints[max(0, bisect_right(self.TimingPoints, t, key=lambda tm: tm.offset) - 1)]
+
+    def get_red_tm_at(self, t):
+        assert len(self.TimingPointsRed) > 0, "Need at least one uninherited timing point"
+        return self.TimingPointsRed[max(0, bisect_right(self.TimingPointsRed, int(t), key=lambda tm: tm.offset) - 1)]
+
+    def create_new_tm(self, has_red: bool = False):
+        last_tm = self.get_last_tm()
+        last_red_tm = self.get_last_red_tm()
+
+        tm = TimingPoint()
+        tm.offset = int(self.curr_time)
+        if self.debug_mode:
+            print_with_pended("CREATE NEW TM", tm.offset, file=sys.stderr)
+        tm.redline = has_red # can upgrade to red + green later if not having red
+        tm.scroll = last_tm and last_tm.scroll or 1.0
+        tm.measure = last_tm.measure
+        tm.GGT = last_tm.GGT
+        tm.hidefirst = last_tm.hidefirst
+        tm.bpm = last_red_tm.bpm
+
+        self.TimingPoints.append(tm)
+        if has_red:
+            self.TimingPointsRed.append(tm)
+            self.curr_time = int(tm.offset)
+
+        return tm
+
+    def get_or_create_curr_tm(self, need_red: bool = False):
+        tm = self.get_last_tm()
+        if int(self.curr_time) != tm.offset:
+            tm = self.create_new_tm(need_red)
+        elif need_red and not tm.redline: # needs to upgrade to red + green
+            tm.redline = True
+            self.TimingPointsRed.append(tm)
+            self.curr_time = int(tm.offset)
+        return tm
+
+    def get_or_create_curr_red_tm(self):
+        return self.get_or_create_curr_tm(True)
+
+    def get_t_unit(self, tm, tot_note):
+        if self.debug_mode:
+            print_with_pended(tm.bpm, tot_note, file=sys.stderr)
+        return tm.measure * 60000.0 / (tm.bpm * tot_note)
+
+    def handle_a_bar(self):
+        #debug
+        if self.last_debug is None:
+            self.last_debug = self.TimingPoints[0].offset
+        #debug
+
+        tot_note = 0
+        for data in self.bar_data:
+            if isinstance(data, str):
+                tot_note += 1
+
+        if self.debug_mode:
+            print_with_pended("TOT_NOTE", tot_note, file=sys.stderr)
+            pure_data = [x for x in self.bar_data if x[0].isdigit()]
+            p1= "%6d %2.1f %2d %s" % (int(self.curr_time), \
+                    self.get_last_red_tm().measure, len(pure_data), \
+                    "".join(pure_data))
+
+            p2= "%s %s" % (repr(self.get_last_red_tm().bpm), \
+                    repr(self.get_t_unit(self.get_last_red_tm(), max(1, tot_note)) * max(1, tot_note)))
+            print_with_pended(p1, file=sys.stderr)
+
+        #debug
+        self.last_debug = self.curr_time
+        bak_curr_time = self.curr_time
+        note_cnt = -1
+        #debug
+
+        if not tot_note: # empty or command-only measure
+            self.curr_time += self.get_t_unit(self.get_last_red_tm(), 1)
+        else:
+            for data in self.bar_data:
+                if isinstance(data, str): #note
+                    note_cnt += 1
+                    if data == "0" or \
+                        (self.lasting_note != None and data != '8'):
+                        self.curr_time += self.get_t_unit(self.get_last_red_tm(), tot_note)
+                        continue
+                    self.add_a_note(data, self.curr_time)
+                    if self.print_each_note:
+                        print_with_pended(note_cnt, data, self.curr_time,
+                            bak_curr_time + note_cnt * self.get_t_unit(self.get_last_red_tm(), tot_note),
+                            self.get_t_unit(self.get_last_red_tm(), tot_note),
+                            file=sys.stderr)
+                    self.curr_time += self.get_t_unit(self.get_last_red_tm(), tot_note)           
+                else: #cmd
+                    self.real_do_cmd(data)
+        self.bar_data = [] 
+
+        if self.print_each_note:
+            print_with_pended("after bar, curr_time= %f", self.curr_time, file=sys.stderr)
+        # handle bar line visibility
+        tmr = self.get_last_red_tm()
+        tm = self.get_last_tm()
+        if tm.hidefirst: # still hidden
+            self.real_do_cmd((MEASURE, tmr.measure)) # insert bar line
+            self.real_do_cmd((BARLINEOFF,)) # hide bar line
+        elif tmr.hidefirst: # no longer hidden
+            self.real_do_cmd((MEASURE, tmr.measure)) # insert bar line
+            self.real_do_cmd((BARLINEON,)) # unhide bar line
+        # convert x.x measure to incomplete measure
+        if abs(round(tmr.measure) - tmr.measure) > 0.001:
+            bak = tmr.measure
+            tmr.measure = math.ceil(round(bak, 3)) # a big enough measure for osu
+            self.real_do_cmd((MEASURE, bak)) # remeasure, for tja
+
+    def handle_note(self, line):
+        for ch in line:
+            if ch.isdigit():
+                self.bar_data.append(ch)
+            elif ch == ",":
+                self.handle_a_bar()
+
+    def write_fmt_ver_str(self, fout: TextIO) -> None:
+        lines = [
+            "osu file format v14",
+            "",
+        ]
+        fout.write("\n".join(lines) + "\n")
+
+    def write_General(self, fout: TextIO) -> None:
+        self.Title = self.TITLE
+        self.Source = self.SUBTITLE
+        if self.WAVE:
+            self.AudioFilename = self.WAVE
+            self.chart_resources[self.WAVE] = 'song audio'
+        else:
+            self.AudioFilename = ""
+        self.PreviewTime = self.DEMOSTART * 1000 - MS_OSU_MUSIC_OFFSET
+
+        lines = [
+            "[General]",
+            "AudioFilename: %s" % (self.AudioFilename,),
+            "AudioLeadIn: %d" % (round(self.AudioLeadIn)),
+            "PreviewTime: %d" % (round(self.PreviewTime)),
+            "CountDown: %d" % (self.CountDown,),
+            "SampleSet: %s" % (self.SampleSet,),
+            "StackLeniency: %s" % (repr(self.StackLeniency),),
+            "Mode: %d" % (self.Mode,),
+            "LetterboxInBreaks: %d" % (self.LetterboxInBreaks,),
+            "",
+        ]
+        fout.write("\n".join(lines) + "\n")
+
+    # no use, but required by osu
+    def write_Editor(self, fout: TextIO) -> None:
+        lines = [
+            "[Editor]",
+            "DistanceSpacing: 0.8",
+            "BeatDivisor: 4",
+            "GridSize: 4",
+            "",
+        ]
+        fout.write("\n".join(lines) + "\n")
+
+    def write_Metadata(self, fout: TextIO) -> None:
+        self.Title = self.TITLE
+        self.Source = self.SUBTITLE    
+        self.Creator = self.MAKER or self.AUTHOR or self.CREATOR or self.Creator
+        self.Version = self.COURSE
+        lines = [
+            "[Metadata]",
+            "Title:%s" % (self.Title,),
+            "Artist:%s" % (self.Artist,),
+            "Creator:%s" % (self.Creator,),
+            "Version:%s" % (self.Version,),
+            "Source:%s" % (self.Source,),
+            "Tags:%s" % (self.Tags,),
+            "",
+        ]
+        fout.write("\n".join(lines) + "\n")
+
+    def write_Difficulty(self, fout: TextIO) -> None:
+        lines = [
+            "[Difficulty]",
+            "HPDrainRate:%s" % (repr(self.HPDrainRate),),
+            "CircleSize:%s" % (repr(self.CircleSize),),
+            "OverallDifficulty:%s" % (repr(self.OverallDifficulty),),
+            "ApproachRate:%s" % (repr(self.ApproachRate),),
+            "SliderMultiplier:%s" % (repr(self.SliderMultiplier),),
+            "SliderTickRate:%s" % (repr(self.SliderTickRate),),
+            "",
+        ]
+        fout.write("\n".join(lines) + "\n")
+
+    def write_Events(self, fout: TextIO) -> None:
+        lines = [
+            "[Events]",
+            "//Background and Video events",
+        ]
+
+        # FIXME: What if the filename contains double quotes (")?
+        bg = self.BGIMAGE or self.PREIMAGE
+        if bg:
+            lines.append(f'0,0,"{bg}",0,0')
+            self.chart_resources[bg] = 'background image'
+        if self.BGMOVIE:
+            offset = int(round(self.MOVIEOFFSET * 1000)) - MS_OSU_MUSIC_OFFSET
+            lines.append(f'Video,{offset},"{self.BGMOVIE}",0,0')
+            self.chart_resources[self.BGMOVIE] = 'background video'
+
+        lines.extend([
+            "//Break Periods",
+            "//Storyboard Layer 0 (Background)",
+            "//Storyboard Layer 1 (Fail)",
+            "//Storyboard Layer 2 (Pass)",
+            "//Storyboard Layer 3 (Foreground)",
+            "//Storyboard Layer 4 (Overlay)",
+            "//Storyboard Sound Samples",
+            "",
+        ])
+        fout.write("\n".join(lines) + "\n")
+
+    def write_TimingPoints(self, fout: TextIO) -> None:
+        lines = ["[TimingPoints]"]
+        volume = int(round(min(100, 100 * abs(self.SEVOL) / max(1, abs(self.SONGVOL)))))
+        for tm in self.TimingPoints:
+            time = int(tm.offset)
+            meter = max(1, int(round(tm.measure)))
+            fx = tm.GGT + 8 * tm.hidefirst
+            if tm.redline:
+                beat_dur = 60000.0 / tm.bpm
+                lines.append(f"{time},{beat_dur},{meter},1,0,{volume},1,{fx}")
+            if not tm.redline or tm.scroll != 1.0:
+                beat_dur = -100 / tm.scroll
+                lines.append(f"{time},{beat_dur},{meter},1,0,{volume},0,{fx}")
+            tm.offset = int(tm.offset)
+        lines.append("")
+        fout.write("\n".join(lines) + "\n")
+
+    def write_HitObjects(self, fout: TextIO) -> None:
+        lines = ["[HitObjects]"]
+        lasting_note = None
+        for ho in self.HitObjects:
+            beg_offset = self.get_real_offset(ho[2])
+            if int(beg_offset) != int(ho[2]):
+                if self.debug_mode:
+                    print_with_pended("OFFSET FIXED", int(beg_offset), int(ho[2]), file=sys.stderr)
+            if ho[0] == CIRCLE:
+                rtassert(lasting_note is None, "this is abnormal")
+                lines.append("%d,%d,%d,%d,%d" % (self.CircleX, self.CircleY, beg_offset, ho[0], ho[1]))
+            elif ho[0] == SLIDER:
+                rtassert(lasting_note is None, "this is abnormal")
+                lasting_note = ho
+            elif ho[0] == SPINNER:
+                rtassert(lasting_note is None, "this is abnormal")
+                lasting_note = ho
+            elif ho[0] == SLIDER_END:
+                rtassert(lasting_note is not None and \
+                        lasting_note[0] == SLIDER)
+                ln = lasting_note
+                tmr = self.get_red_tm_at(int(ln[2]))
+                tmg = self.get_tm_at(int(ln[2])) # green if red + green, otherwise red
+                curve_len = 100 * (ho[2] - ln[2]) * tmr.bpm  * self.SliderMultiplier * tmg.scroll / 60000
+                lines.append("%d,%d,%d,%d,%d,L|%d:%d,%d,%f" % (self.CircleX, self.CircleY, \
+                        int(self.get_real_offset(ln[2])), ln[0], ln[1], \
+                        int(self.CircleX+curve_len), self.CircleY, 1, curve_len))
+                lasting_note = None
+            elif ho[0] == SPINNER_END:
+                rtassert(lasting_note is not None and \
+                        lasting_note[0] == SPINNER, "this is abnormal")
+                ln = lasting_note
+                lines.append("%d,%d,%d,%d,%d,%d" % (self.CircleX, self.CircleY, int(self.get_real_offset(ln[2])), \
+                        ln[0], ln[1], int(self.get_real_offset(ho[2]))))
+                lasting_note = None
+        lines.append("")
+        fout.write("\n".join(lines) + "\n")
+
+    def convert(self, filename: str, fout: TextIO, data: Optional[bytes] = None) -> Dict[str, str]:
+        """Convert the .tja file `filename`, or its contents `data` if specified (`filename` is then only a name)."""
+        self.reset()
+        laps = lap_timer(self.timings)
+        assert isinstance(filename, str)
+        rtassert(filename.endswith(".tja"), "filename should ends with .tja")
+        if data is None:
+            check_unsupported(filename)
+            try: fobj = open(filename, "rb")
+            except IOError: rtassert(False, "can't open tja file.")
+        else:
+            fobj = io.BufferedReader(io.BytesIO(data))
+
+        # real work
+        with fobj:
+            encoding, events = tokenize_tja(fobj)
+        laps.lap("tokenize")
+
+        # write the .osu file at once, except in debug mode to keep the order with the debug info
+        buf = fout if self.debug_mode else io.StringIO()
+        try:
+            self.get_meta_data(encoding, events)
+            laps.lap("parse")
+            self.write_fmt_ver_str(buf)
+            self.write_General(buf)
+            self.write_Editor(buf)
+            self.write_Metadata(buf)
+            self.write_Difficulty(buf)
+            self.write_Events(buf)
+            laps.lap("encode")
 
-def real_do_cmd(cmd):
-    global curr_time
+            self.get_all(events)
+            laps.lap("parse")
+            self.write_TimingPoints(buf)
+            self.write_HitObjects(buf)
+        finally: # also write the partial result on errors
+            if buf is not fout:
+                fout.write(buf.getvalue())
+        laps.lap("encode")
 
-    if debug_mode:
-        print_with_pended("handle cmd", cmd, file=sys.stderr)
-    
-    # handle delay, no timing point change
-    if cmd[0] == DELAY:
-        curr_time += cmd[1] * 1000
-        return
-    
-    # handel timing point change command    
-    if cmd[0] == BPMCHANGE:
-        get_or_create_curr_red_tm()["bpm"] = cmd[1]
-    elif cmd[0] == MEASURE:
-        assert len(bar_data) == 0, "can't change measure within a bar"
-        get_or_create_curr_red_tm()["measure"] = cmd[1]
-    elif cmd[0] == SCROLL:
-        get_or_create_curr_tm()["scroll"] = cmd[1]
-    elif cmd[0] == GOGOSTART:
-        get_or_create_curr_tm()["GGT"] = True
-    elif cmd[0] == GOGOEND:
-        get_or_create_curr_tm()["GGT"] = False
-    elif cmd[0] == BARLINEOFF:
-        get_or_create_curr_tm()["hidefirst"] = True
-    elif cmd[0] == BARLINEON:
-        get_or_create_curr_tm()["hidefirst"] = False
-    else:
-        assert False, "unknown or unsupported command"
-
-def add_a_note(snd, offset):
-    global lasting_note
-    snd = int(snd)
-    HitObjects.append((get_osu_type(snd), get_osu_sound(snd), offset))
-    if get_osu_type(snd) in (SLIDER, SPINNER):
-        lasting_note = get_osu_type(snd)
-    if get_osu_type(snd) in (SLIDER_END, SPINNER_END):
-        lasting_note = None
-    if debug_mode:
-        print_with_pended(HitObjects[-1], file=sys.stderr)
-
-def get_last_tm():
-    return TimingPoints[-1]
-
-def get_last_red_tm():
-    return TimingPointsRed[-1]
-        
-def get_tm_at(t):
-    assert len(TimingPoints) > 0, "Need at least one timing point"
-    return TimingPoints[max(0, bisect_right(TimingPoints, t, key=lambda tm: tm["offset"]) - 1)]
-
-def get_red_tm_at(t):
-    assert len(TimingPointsRed) > 0, "Need at least one uninherited timing point"
-    return TimingPointsRed[max(0, bisect_right(TimingPointsRed, int(t), key=lambda tm: tm["offset"]) - 1)]
-   
-def create_new_tm(has_red: bool = False):
-    global curr_time
-
-    last_tm = get_last_tm()
-    last_red_tm = get_last_red_tm()
-    
-    tm = {}
-    tm["offset"] = int(curr_time)
-    if debug_mode:
-        print_with_pended("CREATE NEW TM", tm["offset"], file=sys.stderr)
-    tm["redline"] = has_red # can upgrade to red + green later if not having red
-    tm["scroll"] = last_tm and last_tm["scroll"] or 1.0
-    tm["measure"] = last_tm["measure"]
-    tm["GGT"] = last_tm["GGT"]
-    tm["hidefirst"] = last_tm["hidefirst"]
-    tm["bpm"] = last_red_tm["bpm"]
-    
-    TimingPoints.append(tm)
-    if has_red:
-        TimingPointsRed.append(tm)
-        curr_time = int(tm["offset"])
-
-    return tm
-
-def get_or_create_curr_tm(need_red: bool = False):
-    global curr_time
-    tm = get_last_tm()
-    if int(curr_time) != tm["offset"]:
-        tm = create_new_tm(need_red)
-    elif need_red and not tm["redline"]: # needs to upgrade to red + green
-        tm["redline"] = True
-        TimingPointsRed.append(tm)
-        curr_time = int(tm["offset"])
-    return tm
-
-def get_or_create_curr_red_tm():
-    return get_or_create_curr_tm(True)
-
-def get_t_unit(tm, tot_note):
-    if debug_mode:
-        print_with_pended(tm["bpm"], tot_note, file=sys.stderr)
-    return tm["measure"] * 60000.0 / (tm["bpm"] * tot_note)
-
-def handle_a_bar():
-    global bar_data, curr_time
-    
-    #debug
-    global last_debug
-    if last_debug is None:
-        last_debug = TimingPoints[0]["offset"]
-    #debug
-
-    tot_note = 0
-    for data in bar_data:
-        if isinstance(data, str):
-            tot_note += 1
-
-    if debug_mode:
-        print_with_pended("TOT_NOTE", tot_note, file=sys.stderr)
-        pure_data = [x for x in bar_data if x[0].isdigit()]
-        p1= "%6d %2.1f %2d %s" % (int(curr_time), \
-                get_last_red_tm()["measure"], len(pure_data), \
-                "".join(pure_data))
-
-        p2= "%s %s" % (repr(get_last_red_tm()["bpm"]), \
-                repr(get_t_unit(get_last_red_tm(), max(1, tot_note)) * max(1, tot_note)))
-        print_with_pended(p1, file=sys.stderr)
-
-    #debug
-    last_debug = curr_time
-    bak_curr_time = curr_time
-    note_cnt = -1
-    #debug
-    
-    if not tot_note: # empty or command-only measure
-        curr_time += get_t_unit(get_last_red_tm(), 1)
-    else:
-        for data in bar_data:
-            if isinstance(data, str): #note
-                note_cnt += 1
-                if data == "0" or \
-                    (lasting_note != None and data != '8'):
-                    curr_time += get_t_unit(get_last_red_tm(), tot_note)
-                    continue
-                add_a_note(data, curr_time)
-                if print_each_note:
-                    print_with_pended(note_cnt, data, curr_time,
-                        bak_curr_time + note_cnt * get_t_unit(get_last_red_tm(), tot_note),
-                        get_t_unit(get_last_red_tm(), tot_note),
-                        file=sys.stderr)
-                curr_time += get_t_unit(get_last_red_tm(), tot_note)           
-            else: #cmd
-                real_do_cmd(data)
-    bar_data = [] 
-    
-    if print_each_note:
-        print_with_pended("after bar, curr_time= %f", curr_time, file=sys.stderr)
-    # handle bar line visibility
-    tmr = get_last_red_tm()
-    tm = get_last_tm()
-    if tm["hidefirst"]: # still hidden
-        real_do_cmd((MEASURE, tmr["measure"])) # insert bar line
-        real_do_cmd((BARLINEOFF,)) # hide bar line
-    elif tmr["hidefirst"]: # no longer hidden
-        real_do_cmd((MEASURE, tmr["measure"])) # insert bar line
-        real_do_cmd((BARLINEON,)) # unhide bar line
-    # convert x.x measure to incomplete measure
-    if abs(round(tmr["measure"]) - tmr["measure"]) > 0.001:
-        bak = tmr["measure"]
-        tmr["measure"] = math.ceil(round(bak, 3)) # a big enough measure for osu
-        real_do_cmd((MEASURE, bak)) # remeasure, for tja
-
-def handle_note(line):
-    global bar_data
-    for ch in line:
-        if ch.isdigit():
-            bar_data.append(ch)
-        elif ch == ",":
-            handle_a_bar()
-
-def write_fmt_ver_str(fout: TextIO) -> None:
-    print("osu file format v14", file=fout)
-    print("", file=fout)
-
-def write_General(fout: TextIO) -> None:
-    global Title, Source, AudioFilename, PreviewTime
-    Title = TITLE
-    Source = SUBTITLE
-    if WAVE:
-        AudioFilename = WAVE
-        chart_resources[WAVE] = 'song audio'
-    else:
-        AudioFilename = ""
-    PreviewTime = DEMOSTART * 1000 - MS_OSU_MUSIC_OFFSET
-
-    print("[General]", file=fout)
-    print("AudioFilename: %s" % (AudioFilename,), file=fout)
-    print("AudioLeadIn: %d" % (round(AudioLeadIn)), file=fout)
-    print("PreviewTime: %d" % (round(PreviewTime)), file=fout)
-    print("CountDown: %d" % (CountDown,), file=fout)
-    print("SampleSet: %s" % (SampleSet,), file=fout)
-    print("StackLeniency: %s" % (repr(StackLeniency),), file=fout)
-    print("Mode: %d" % (Mode,), file=fout)
-    print("LetterboxInBreaks: %d" % (LetterboxInBreaks,), file=fout)
-    print("", file=fout)
-
-# no use, but required by osu
-def write_Editor(fout: TextIO) -> None:
-    print("[Editor]", file=fout)
-    print("DistanceSpacing: 0.8", file=fout)
-    print("BeatDivisor: 4", file=fout)
-    print("GridSize: 4", file=fout)
-    print("", file=fout)
-
-def write_Metadata(fout: TextIO) -> None:
-    global Title, Source, Creator, AudioFilename, PreviewTime, Version
-    Title = TITLE
-    Source = SUBTITLE    
-    Creator = MAKER or AUTHOR or CREATOR or Creator
-    Version = COURSE
-    print("[Metadata]", file=fout)
-    print("Title:%s" % (Title,), file=fout)
-    print("Artist:%s" % (Artist,), file=fout)
-    print("Creator:%s" % (Creator,), file=fout)
-    print("Version:%s" % (Version,), file=fout)
-    print("Source:%s" % (Source,), file=fout)
-    print("Tags:%s" % (Tags,), file=fout)
-    print("", file=fout)
-
-def write_Difficulty(fout: TextIO) -> None:
-    print("[Difficulty]", file=fout)
-    print("HPDrainRate:%s" % (repr(HPDrainRate),), file=fout)
-    print("CircleSize:%s" % (repr(CircleSize),), file=fout)
-    print("OverallDifficulty:%s" % (repr(OverallDifficulty),), file=fout)
-    print("ApproachRate:%s" % (repr(ApproachRate),), file=fout)
-    print("SliderMultiplier:%s" % (repr(SliderMultiplier),), file=fout)
-    print("SliderTickRate:%s" % (repr(SliderTickRate),), file=fout)
-    print("", file=fout)
-
-def write_Events(fout: TextIO) -> None:
-    print("[Events]", file=fout)
-    print("//Background and Video events", file=fout)
-
-    # FIXME: What if the filename contains double quotes (")?
-    bg = BGIMAGE or PREIMAGE
-    if bg:
-        print(f'0,0,"{bg}",0,0', file=fout)
-        chart_resources[bg] = 'background image'
-    if BGMOVIE:
-        offset = int(round(MOVIEOFFSET * 1000)) - MS_OSU_MUSIC_OFFSET
-        print(f'Video,{offset},"{BGMOVIE}",0,0', file=fout)
-        chart_resources[BGMOVIE] = 'background video'
-
-    print("//Break Periods", file=fout)
-    print("//Storyboard Layer 0 (Background)", file=fout)
-    print("//Storyboard Layer 1 (Fail)", file=fout)
-    print("//Storyboard Layer 2 (Pass)", file=fout)
-    print("//Storyboard Layer 3 (Foreground)", file=fout)
-    print("//Storyboard Layer 4 (Overlay)", file=fout)
-    print("//Storyboard Sound Samples", file=fout)
-    print("", file=fout)
-
-def write_TimingPoints(fout: TextIO) -> None:
-    print("[TimingPoints]", file=fout)
-    volume = int(round(min(100, 100 * abs(SEVOL) / max(1, abs(SONGVOL)))))
-    for tm in TimingPoints:
-        time = int(tm["offset"])
-        meter = max(1, int(round(tm["measure"])))
-        fx = tm["GGT"] + 8 * tm["hidefirst"]
-        if tm["redline"]:
-            beat_dur = 60000.0 / tm["bpm"]
-            print(f"{time},{beat_dur},{meter},1,0,{volume},1,{fx}", file=fout)
-        if not tm["redline"] or tm["scroll"] != 1.0:
-            beat_dur = -100 / tm["scroll"]
-            print(f"{time},{beat_dur},{meter},1,0,{volume},0,{fx}", file=fout)
-        tm["offset"] = int(tm["offset"])
-    print("", file=fout)
-
-def write_HitObjects(fout: TextIO) -> None:
-    print("[HitObjects]", file=fout)
-    lasting_note = None
-    for ho in HitObjects:
-        beg_offset = get_real_offset(ho[2])
-        if int(beg_offset) != int(ho[2]):
-            if debug_mode:
-                print_with_pended("OFFSET FIXED", int(beg_offset), int(ho[2]), file=sys.stderr)
-        if ho[0] == CIRCLE:
-            rtassert(lasting_note is None, "this is abnormal")
-            print("%d,%d,%d,%d,%d" % (CircleX, CircleY, beg_offset, ho[0], ho[1]),
-                file=fout)
-        elif ho[0] == SLIDER:
-            rtassert(lasting_note is None, "this is abnormal")
-            lasting_note = ho
-        elif ho[0] == SPINNER:
-            rtassert(lasting_note is None, "this is abnormal")
-            lasting_note = ho
-        elif ho[0] == SLIDER_END:
-            rtassert(lasting_note is not None and \
-                    lasting_note[0] == SLIDER)
-            ln = lasting_note
-            tmr = get_red_tm_at(int(ln[2]))
-            tmg = get_tm_at(int(ln[2])) # green if red + green, otherwise red
-            curve_len = 100 * (ho[2] - ln[2]) * tmr["bpm"]  * SliderMultiplier * tmg["scroll"] / 60000
-            print("%d,%d,%d,%d,%d,L|%d:%d,%d,%f" % (CircleX, CircleY, \
-                    int(get_real_offset(ln[2])), ln[0], ln[1], \
-                    int(CircleX+curve_len), CircleY, 1, curve_len),
-                file=fout)
-            lasting_note = None
-        elif ho[0] == SPINNER_END:
-            rtassert(lasting_note is not None and \
-                    lasting_note[0] == SPINNER, "this is abnormal")
-            ln = lasting_note
-            print("%d,%d,%d,%d,%d,%d" % (CircleX, CircleY, int(get_real_offset(ln[2])), \
-                    ln[0], ln[1], int(get_real_offset(ho[2]))),
-                file=fout)
-            lasting_note = None
-    print("", file=fout)
-
-def tja2osu(filename: str, fout: TextIO) -> Dict[str, str]:
-    init_globals()
-    assert isinstance(filename, str)
-    rtassert(filename.endswith(".tja"), "filename should ends with .tja")
-    check_unsupported(filename)
+        return self.chart_resources
 
-    # real work
-    get_meta_data(filename)
-    write_fmt_ver_str(fout)
-    write_General(fout)
-    write_Editor(fout)
-    write_Metadata(fout)
-    write_Difficulty(fout)
-    write_Events(fout)
 
-    get_all(filename)
-    write_TimingPoints(fout)
-    write_HitObjects(fout)
+def tja2osu(filename: str, fout: TextIO, data: Optional[bytes] = None,
+        timings: Optional[StageTimings] = None) -> Dict[str, str]:
+    """`timings`: where to add the times of the conversion stages, or `None` not to time them"""
+    return Tja2OsuConverter(timings=timings).convert(filename, fout, data)
 
-    init_debug_globals()
-    return chart_resources
 
+class TjaError(Exception):
+    pass
 
 def rtassert(b, str=""):
     if not b:
-        print_with_pended(str, file=sys.stderr)
-        exit()
+        raise TjaError(str)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -675,7 +787,15 @@ if __name__ == "__main__":
         help="display general debug info")
     parser.add_argument("-v", "--verbose", action="store_true",
         help="display debug info for each note")
+    parser.add_argument("--timings", metavar="FILE", default=None,
+        help="write the wall & CPU times of each conversion stage to FILE as JSON and print them")
     args = parser.parse_args()
-    debug_mode = args.debug or ("debug" in args.options)
-    print_each_note = args.verbose
-    tja2osu(args.filename, sys.stdout)
+    timings = StageTimings() if args.timings is not None else None
+    converter = Tja2OsuConverter(
+        debug_mode=args.debug or ("debug" in args.options),
+        print_each_note=args.verbose,
+        timings=timings)
+    converter.convert(args.filename, sys.stdout)
+    if timings is not None:
+        write_timings(args.timings, {args.filename: timings.stages})
+        print_timings_table({args.filename: timings.stages}, file=sys.stderr)
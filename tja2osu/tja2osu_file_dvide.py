@@ -8,15 +8,19 @@ try:
 except ImportError:
     import tja2osu.tja2osu
 from common.utils import print_with_pended, print_pend, print_unpend
+from timings import StageTimings, print_timings_table, timed, write_timings
 
 import argparse
 import codecs
+import io
+import locale
 import shutil
 import sys
 import os
 import textwrap
 import traceback
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple, Union
+from zipfile import ZIP_DEFLATED, ZipFile
 
 WATER_MARK = b"//Auto generated by osu2tja"
 
@@ -40,12 +44,21 @@ def get_style(str_: bytes) -> Optional[int]:
         return 2
     return None
 
-def divide_diff(path_tja: str, dir_out: str) -> List[str]:
+# (file name, contents) of split .tja files
+tja_files_t = List[Tuple[str, bytes]]
+
+def write_tja_files(dir_out: str, tja_files: tja_files_t) -> None:
+    os.makedirs(dir_out, exist_ok=True)
+    for fname, data in tja_files:
+        with open(os.path.join(dir_out, fname), "wb") as fout:
+            fout.write(data)
+
+def divide_diff(path_tja: str) -> tja_files_t:
     assert isinstance(path_tja, str)
     fname_base, ext = os.path.splitext(os.path.basename(path_tja))
     assert ext == ".tja"
 
-    fnames_by_course: Dict[Tuple[str, int, int], List[str]] = {}
+    fnames_by_course: Dict[Tuple[str, int, int], List[Tuple[str, bytes]]] = {}
     course = "Oni"
     style = 1
     player_side = 0
@@ -63,10 +76,8 @@ def divide_diff(path_tja: str, dir_out: str) -> List[str]:
         if len(fnames) > 0:
             course_suffixes.append(f"(No{len(fnames)})")
         fname = f"{fname_base} {course}{''.join(course_suffixes)}.tja"
-        fnames.append(fname)
-
-        fout = open(os.path.join(dir_out, fname), "wb")
 
+        fout = io.BytesIO()
         fout.write(bom + WATER_MARK + b"\n")
         for str_ in common_data:
             fout.write(str_)
@@ -76,7 +87,7 @@ def divide_diff(path_tja: str, dir_out: str) -> List[str]:
         for str_ in diff_data:
             fout.write(str_)
             fout.write(b"\n")
-        fout.close()
+        fnames.append((fname, fout.getvalue()))
 
         diff_data.clear()
 
@@ -114,17 +125,16 @@ def divide_diff(path_tja: str, dir_out: str) -> List[str]:
     if started: # missing #END; implicit #END at end-of-file
         write_chartdef()
 
-    return [fname for fnames in fnames_by_course.values() for fname in fnames]
+    return [tja_file for tja_files in fnames_by_course.values() for tja_file in tja_files]
 
-def divide_branch(path_tja: str, dir_out: str) -> List[str]:
-    assert isinstance(path_tja, str)
-    fname, ext = os.path.splitext(os.path.basename(path_tja))
+def divide_branch(fname_tja: str, data: bytes) -> tja_files_t:
+    """Split the contents `data` of the single-notechart .tja file `fname_tja` by branches.
+    Return an empty list if the notechart has no branches."""
+    assert isinstance(fname_tja, str)
+    fname, ext = os.path.splitext(fname_tja)
     assert ext == ".tja"
 
-    try:
-        fobj = open(path_tja, "rb")
-    except IOError:
-        assert False, "can't open tja file."
+    fobj = io.BufferedReader(io.BytesIO(data))
 
     bom = b""
     if fobj.peek(len(codecs.BOM_UTF8)).startswith(codecs.BOM_UTF8):
@@ -177,86 +187,131 @@ def divide_branch(path_tja: str, dir_out: str) -> List[str]:
         return []
 
     file_list = [f"{fname}(Kurouto).tja", f"{fname}(Futsuu).tja", f"{fname}(Tatsujin).tja"]
+    tja_files: tja_files_t = []
     i = 0
     for f in file_list:
-        fout = open(os.path.join(dir_out, f), "wb")
+        fout = io.BytesIO()
         fout.write(bom + WATER_MARK + b"\n")
         for str_ in branch_data[i]:
             fout.write(str_)
             fout.write(b"\n")
-        fout.close()
+        tja_files.append((f, fout.getvalue()))
         i += 1
 
-    return file_list
+    return tja_files
+
+
+# .osz entry name -> contents (`bytes`) or source file path (`str`)
+osz_files_t = Dict[str, Union[bytes, str]]
+
+def write_osz(fpath_osz: str, osz_files: osz_files_t) -> None:
+    with ZipFile(fpath_osz, "w", ZIP_DEFLATED) as osz:
+        for arcname, content in osz_files.items():
+            if isinstance(content, bytes):
+                osz.writestr(arcname, content)
+            else:
+                osz.write(content, arcname)
 
 
-def tja2osus(fpath_tja: str, target_path: str="out") -> None:
+def tja2osus(fpath_tja: str, target_path: str="out", dir_tmp: Optional[str]=None,
+        osz_files: Optional[osz_files_t]=None, write_folder: bool=True, timings: Optional[StageTimings]=None) -> None:
+    """Convert `fpath_tja` into "<target_path>/<song_folder>/" (if `write_folder`)
+    and/or into `osz_files` for `write_osz()`, without re-reading the written files.
+
+    The .tja file is split into single-notechart branch-less .tja files in memory.
+    They are also written into `dir_tmp` for debugging if specified.
+    The times of the conversion stages are added to `timings` if specified.
+    """
     dirname_dest, ext = os.path.splitext(os.path.basename(fpath_tja))
-    dir_tmp = os.path.join("tmp", dirname_dest)
-    os.makedirs(dir_tmp, exist_ok=True)
-    all_file_list = []
+    all_files: tja_files_t = []
+    all_branch_files: tja_files_t = []
     print(f"Splitting `{fpath_tja}` ...", end="", flush=True)
     print_pend()
-    try:
-        file_list = divide_diff(fpath_tja, dir_tmp)
-    except Exception:
-        print_with_pended(traceback.format_exc(), file=sys.stderr)
-        print(f"Error splitting `{fpath_tja}` into difficulties. Continued.", file=sys.stderr)
-        file_list: List[str] = []
-    for diff_file in file_list:
-        fpath_tja_diff = os.path.join(dir_tmp, diff_file)
+    with timed(timings, "split"):
         try:
-            branch_file_list = divide_branch(fpath_tja_diff, dir_tmp)
+            diff_files = divide_diff(fpath_tja)
         except Exception:
             print_with_pended(traceback.format_exc(), file=sys.stderr)
-            print(f"Error splitting difficulty TJA `{fpath_tja_diff}` into branches. Continued.", file=sys.stderr)
-            continue
-        if len(branch_file_list) > 0:
-            all_file_list.extend(branch_file_list)
-        else:
-            all_file_list.append(diff_file)
+            print(f"Error splitting `{fpath_tja}` into difficulties. Continued.", file=sys.stderr)
+            diff_files = []
+        for diff_file, diff_data in diff_files:
+            try:
+                branch_files = divide_branch(diff_file, diff_data)
+            except Exception:
+                print_with_pended(traceback.format_exc(), file=sys.stderr)
+                print(f"Error splitting difficulty TJA `{diff_file}` into branches. Continued.", file=sys.stderr)
+                continue
+            if len(branch_files) > 0:
+                all_files.extend(branch_files)
+                all_branch_files.extend(branch_files)
+            else:
+                all_files.append((diff_file, diff_data))
     print_unpend()
-    print(f"\rSplitting `{fpath_tja}` into `{'`, `'.join(all_file_list)}` done!")
+    print(f"\rSplitting `{fpath_tja}` into `{'`, `'.join(fname for fname, _ in all_files)}` done!")
+    if dir_tmp is not None:
+        write_tja_files(dir_tmp, [*diff_files, *all_branch_files])
 
     resources: Dict[str, str] = {}
 
     dir_out = os.path.join(target_path, dirname_dest)
-    os.makedirs(dir_out, exist_ok=True)
-    for fname_tja_i in all_file_list:
-        fpath_tja_i = os.path.join(dir_tmp, fname_tja_i)
+    if write_folder:
+        os.makedirs(dir_out, exist_ok=True)
+    for fname_tja_i, data_tja_i in all_files:
+        # for messages only; the file exists only with `dir_tmp`
+        fpath_tja_i = os.path.join(dir_tmp, fname_tja_i) if dir_tmp is not None else fname_tja_i
         fname, ext = os.path.splitext(fname_tja_i)
         tja_name_i, diff = fname.rsplit(None, 1)
         fname_osu_i = f"{tja_name_i}[{diff}].osu"
         fpath_osu_i = os.path.join(dir_out, fname_osu_i)
-        fout = open(fpath_osu_i, "w")
+        fout = io.StringIO()
         print(f"Converting `{fpath_tja_i}` to `{fname_osu_i}` ...", end="", flush=True)
         print_pend()
         try:
-            rescs = tja2osu.tja2osu(fpath_tja_i, fout)
+            rescs = tja2osu.tja2osu(fpath_tja_i, fout, data_tja_i, timings)
             resources.update(rescs)
         except Exception:
             print_with_pended(traceback.format_exc(), file=sys.stderr)
             print(f"Error processing {diff} difficulty of `{fpath_tja_i}`. Continued.", file=sys.stderr)
-        fout.close()
+        # with the same encoding & newline conversion as `open(fpath_osu_i, "w")`
+        data_osu = fout.getvalue().replace("\n", os.linesep).encode(locale.getpreferredencoding(False))
+        if write_folder:
+            with timed(timings, "write_osu"), open(fpath_osu_i, "wb") as f:
+                f.write(data_osu)
+        if osz_files is not None:
+            osz_files[fname_osu_i] = data_osu
         print_unpend()
         print(f"\rConverting `{fpath_tja_i}` to `{fname_osu_i}` done!")
 
     for rfname, rtype in resources.items():
         rfpath_src = os.path.join(os.path.dirname(fpath_tja), rfname)
         rfpath_desk = os.path.join(dir_out, rfname)
-        try:
-            shutil.copyfile(rfpath_src, rfpath_desk)
-        except FileNotFoundError:
+        if not os.path.isfile(rfpath_src):
             print(f"Warning: Referenced {rtype} file `{rfpath_src}` not found. Not copied.", file=sys.stderr)
+            continue
+        if write_folder:
+            with timed(timings, "resources"):
+                os.makedirs(os.path.dirname(rfpath_desk), exist_ok=True)
+                shutil.copyfile(rfpath_src, rfpath_desk)
+        if osz_files is not None:
+            osz_files[rfname] = rfpath_src
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description=textwrap.dedent('''\
         Convert a general .tja file to multiple .osu files and copy the audio to "out/<song_folder>/".
-        Intermediate single-notechart branch-less .tja files are written to "tmp/<song_folder>/"
+        With --write-tmp, intermediate single-notechart branch-less .tja files are written to "tmp/<song_folder>/"
         '''),
         formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument("filename",
         help="source .tja file. Allows multiple notechart definitions and branch commands.")
+    parser.add_argument("--write-tmp", action="store_true",
+        help='also write the intermediate single-notechart branch-less .tja files to "tmp/<song_folder>/" for debugging')
+    parser.add_argument("--timings", metavar="FILE", default=None,
+        help="write the wall & CPU times of each conversion stage to FILE as JSON and print them")
     args = parser.parse_args()
-    tja2osus(args.filename)
+    dirname_dest, _ = os.path.splitext(os.path.basename(args.filename))
+    timings = StageTimings() if args.timings is not None else None
+    tja2osus(args.filename, dir_tmp=os.path.join("tmp", dirname_dest) if args.write_tmp else None, timings=timings)
+    if timings is not None:
+        write_timings(args.timings, {args.filename: timings.stages})
+        print_timings_table({args.filename: timings.stages})